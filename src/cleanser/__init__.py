@@ -1,2 +1,2 @@
 from .constants import CS_MODEL_FILE, DC_MODEL_FILE
-from .guide_mixture import run
+from .guide_mixture import Progress, fit_guides_async, run
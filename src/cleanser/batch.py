@@ -0,0 +1,47 @@
+"""
+Manifests of the libraries fit together by `cleanser batch`.
+
+A manifest is a tab-separated file with a header and one row per library. Every row names the
+library's input matrix and its posterior and sample outputs, and optionally its diagnostics and
+triage outputs and a posterior store; an empty cell leaves that output out. Paths are relative to
+the current directory, like those given on the command line.
+"""
+
+import csv
+from typing import NamedTuple
+
+REQUIRED_COLUMNS = ["input", "posteriors", "samples"]
+OPTIONAL_COLUMNS = ["diagnostics", "triage", "posteriors store"]
+
+
+class ManifestEntry(NamedTuple):
+    input: str
+    posteriors: str
+    samples: str
+    diagnostics: str | None = None
+    triage: str | None = None
+    posteriors_store: str | None = None
+
+
+def read_manifest(path: str) -> list[ManifestEntry]:
+    """The libraries of a manifest, in order. Raises ValueError if a required column is missing or
+    empty, or if two libraries share an output."""
+    with open(path, newline="", encoding="utf-8") as manifest_file:
+        reader = csv.DictReader(manifest_file, delimiter="\t")
+        missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"Manifest {path} has no {', '.join(missing)} column")
+
+        entries = []
+        for line, row in enumerate(reader, start=2):
+            values = [(row.get(column) or "").strip() or None for column in REQUIRED_COLUMNS + OPTIONAL_COLUMNS]
+            if None in values[: len(REQUIRED_COLUMNS)]:
+                raise ValueError(f"Line {line} of manifest {path} is missing its input or an output")
+            entries.append(ManifestEntry(*values))
+
+    outputs = [output for entry in entries for output in entry[1:] if output is not None]
+    duplicates = sorted({output for output in outputs if outputs.count(output) > 1})
+    if duplicates:
+        raise ValueError(f"Libraries of manifest {path} share outputs: {', '.join(duplicates)}")
+
+    return entries
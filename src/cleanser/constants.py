@@ -3,11 +3,35 @@ from random import randint
 
 CS_MODEL_FILE = "cs-guide-mixture.stan"
 DC_MODEL_FILE = "dc-guide-mixture.stan"
+# Models that fit several independent guides in one Stan program
+BATCH_MODEL_FILES = {
+    CS_MODEL_FILE: "cs-guide-mixture-batch.stan",
+    DC_MODEL_FILE: "dc-guide-mixture-batch.stan",
+}
+# Scalar (per-guide) parameters of each model
+MODEL_PARAMETERS = {
+    CS_MODEL_FILE: ("r", "nbMean", "nbDisp", "lambda"),
+    DC_MODEL_FILE: ("r", "nbMean", "nbDisp", "n_nbMean", "n_nbDisp"),
+}
+ENGINES = ("stan", "em")
+INFERENCE_METHODS = ("nuts", "optimize", "laplace", "pathfinder", "advi")
 MAX_SEED_INT = 4_294_967_295  # 2^32 - 1, the largest seed allowed by STAN
 
+DEFAULT_BATCH_MAX_CELLS = 500
+DEFAULT_BATCH_SIZE = 1
 DEFAULT_CHAINS = 4
+DEFAULT_CORES = mp.cpu_count()
+DEFAULT_ENGINE = "stan"
+DEFAULT_INFERENCE = "nuts"
+DEFAULT_MAX_DIVERGENCES = 0
+DEFAULT_MAX_SAMPLE = 4000
 DEFAULT_NORM_LPF = 2
-DEFAULT_RUNS = mp.cpu_count()
+DEFAULT_PILOT_GUIDES = 2
+DEFAULT_RESULT_CACHE_GB = 20
 DEFAULT_SAMPLE = 1000
 DEFAULT_SEED = randint(0, MAX_SEED_INT)
+DEFAULT_TARGET_ESS = 400
+DEFAULT_TARGET_RHAT = 1.01
+DEFAULT_THREADS_PER_CHAIN = 1
+DEFAULT_WARM_WARMUP = 75
 DEFAULT_WARMUP = 300
@@ -0,0 +1,209 @@
+"""
+Convergence diagnostics and adaptation settings of NUTS fits.
+
+R-hat is the split R-hat of Gelman et al. (2013). Bulk and tail effective sample sizes follow
+Vehtari et al. (2021): bulk ESS is computed from rank-normalized split chains, tail ESS is the
+smaller ESS of the indicators of the 5% and 95% quantiles.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+from scipy.special import ndtri
+
+# A warm-started fit is refit with full adaptation when it does worse than this
+WARM_START_MAX_RHAT = 1.05
+WARM_START_MAX_DIVERGENT_FRACTION = 0.01
+# ...or when its bulk or tail ESS is below this fraction of its draws, as when its metric is poor
+WARM_START_MIN_ESS_FRACTION = 0.1
+DEFAULT_MAX_TREEDEPTH = 10
+# ESS is undefined for chains shorter than this
+MIN_ESS_DRAWS = 4
+
+
+class Adaptation(NamedTuple):
+    "Step size and diagonal inverse metric learned during warmup"
+
+    step_size: float
+    inv_metric: np.ndarray
+
+
+class Diagnostics(NamedTuple):
+    "Convergence summary of one guide's fit. R-hat and ESS are the worst over its parameters."
+
+    draws: int
+    max_rhat: float
+    min_ess_bulk: float
+    min_ess_tail: float
+    divergences: int
+    treedepth_hits: int
+    seconds: float = np.nan
+    rounds: int = 1
+
+    @property
+    def ess_per_second(self) -> float:
+        return self.min_ess_bulk / self.seconds if self.seconds > 0 else np.nan
+
+
+class ConvergenceTargets(NamedTuple):
+    "Targets a guide's fit must meet before sampling stops, and the most draws per chain to take"
+
+    max_rhat: float
+    min_ess: float
+    max_divergences: int
+    max_samples: int
+
+    def met(self, diagnostics: Diagnostics) -> bool:
+        return (
+            diagnostics.max_rhat <= self.max_rhat
+            and diagnostics.min_ess_bulk >= self.min_ess
+            and diagnostics.min_ess_tail >= self.min_ess
+            and diagnostics.divergences <= self.max_divergences
+        )
+
+
+def _split_chains(draws: np.ndarray) -> np.ndarray:
+    half = draws.shape[0] // 2
+    return np.concatenate([draws[:half], draws[-half:]], axis=1)
+
+
+def split_rhat(draws: np.ndarray) -> float:
+    """Split R-hat of one quantity from an (iterations, chains) array of draws"""
+    half = draws.shape[0] // 2
+    if half < 2:
+        return np.nan
+
+    chains = _split_chains(draws)
+    within = chains.var(axis=0, ddof=1).mean()
+    between = half * chains.mean(axis=0).var(ddof=1)
+    if within == 0:
+        return 1.0 if between == 0 else np.inf
+
+    return float(np.sqrt(((half - 1) / half * within + between / half) / within))
+
+
+def _autocovariance(chains: np.ndarray) -> np.ndarray:
+    """Autocovariance of each column of an (iterations, chains) array, for every lag"""
+    n = chains.shape[0]
+    centered = chains - chains.mean(axis=0)
+    size = 2 ** int(np.ceil(np.log2(2 * n)))
+    spectrum = np.fft.rfft(centered, n=size, axis=0)
+    return np.fft.irfft(spectrum * np.conj(spectrum), n=size, axis=0)[:n].T / n
+
+
+def ess(chains: np.ndarray) -> float:
+    """Effective sample size of an (iterations, chains) array, using Geyer's initial monotone
+    sequence of autocorrelation pairs"""
+    n, m = chains.shape
+    if n < MIN_ESS_DRAWS:
+        return np.nan
+
+    acov = _autocovariance(chains)
+    mean_var = acov[:, 0].mean() * n / (n - 1)
+    var_plus = mean_var * (n - 1) / n
+    if m > 1:
+        var_plus += chains.mean(axis=0).var(ddof=1)
+    if var_plus == 0:
+        return np.nan
+
+    rho = 1 - (mean_var - acov.mean(axis=0)) / var_plus
+    rho[0] = 1.0
+
+    # Sum autocorrelations in pairs while the pair sums stay positive and decreasing
+    pairs = rho[: 2 * ((n - 1) // 2)].reshape(-1, 2).sum(axis=1)
+    negative = np.flatnonzero(pairs <= 0)
+    pairs = pairs[: negative[0]] if len(negative) else pairs
+    pairs = np.minimum.accumulate(pairs)
+
+    tau = max(-1 + 2 * pairs.sum(), 1 / np.log10(n * m))
+    return float(n * m / tau)
+
+
+def bulk_ess(draws: np.ndarray) -> float:
+    """ESS of the rank-normalized draws of an (iterations, chains) array"""
+    if draws.shape[0] < 2 * MIN_ESS_DRAWS:
+        return np.nan
+    chains = _split_chains(draws)
+    ranks = np.argsort(np.argsort(chains, axis=None, kind="stable"), kind="stable").reshape(chains.shape) + 1
+    return ess(ndtri((ranks - 0.375) / (chains.size + 0.25)))
+
+
+def tail_ess(draws: np.ndarray) -> float:
+    """Smaller ESS of the 5% and 95% quantile indicators of an (iterations, chains) array"""
+    if draws.shape[0] < 2 * MIN_ESS_DRAWS:
+        return np.nan
+    chains = _split_chains(draws)
+    lower, upper = np.quantile(chains, [0.05, 0.95])
+    return _worst(min, [ess((chains <= lower).astype(float)), ess((chains <= upper).astype(float))])
+
+
+def parameter_draws(fit, parameters) -> dict[str, np.ndarray]:
+    """(iterations, chains, ...) draws of each of `parameters` from a NUTS fit. A parameter may
+    also be a single element, e.g. "p[2]"."""
+    draws = fit.draws(concat_chains=False)
+    columns = fit.column_names
+    result = {}
+    for name in parameters:
+        indices = [i for i, column in enumerate(columns) if column == name or column.startswith(f"{name}[")]
+        result[name] = draws[:, :, indices] if len(indices) > 1 else draws[:, :, indices[0]]
+    return result
+
+
+def _quantities(fit, parameters) -> list[np.ndarray]:
+    quantities = []
+    for draws in parameter_draws(fit, parameters).values():
+        draws = draws.reshape(draws.shape[0], draws.shape[1], -1)
+        quantities.extend(draws[:, :, i] for i in range(draws.shape[2]))
+    return quantities
+
+
+def _worst(reduce, values) -> float:
+    """`reduce` of the values that are defined, e.g. not from too few draws"""
+    values = [value for value in values if not np.isnan(value)]
+    return float(reduce(values)) if values else np.nan
+
+
+def fit_diagnostics(fit, parameters) -> Diagnostics:
+    """Convergence summary of a NUTS fit over the draws of `parameters`"""
+    quantities = _quantities(fit, parameters)
+    max_depth = fit.metadata.cmdstan_config.get("max_depth", DEFAULT_MAX_TREEDEPTH)
+    method_variables = fit.method_variables()
+
+    return Diagnostics(
+        draws=quantities[0].size,
+        max_rhat=_worst(max, [split_rhat(draws) for draws in quantities]),
+        min_ess_bulk=_worst(min, [bulk_ess(draws) for draws in quantities]),
+        min_ess_tail=_worst(min, [tail_ess(draws) for draws in quantities]),
+        divergences=int(method_variables["divergent__"].sum()),
+        treedepth_hits=int((method_variables["treedepth__"] >= max_depth).sum()),
+    )
+
+
+def adaptation(fit) -> Adaptation | None:
+    """The fit's adapted step size and metric, averaged over chains"""
+    inv_metric, step_size = fit.inv_metric, fit.step_size
+    if inv_metric is None or step_size is None:
+        return None
+    return Adaptation(float(np.mean(step_size)), np.mean(np.asarray(inv_metric), axis=0))
+
+
+def combine_adaptations(adaptations: list[Adaptation]) -> Adaptation | None:
+    """Median step size and inverse metric of several fits' adaptations"""
+    if not adaptations:
+        return None
+    return Adaptation(
+        float(np.median([a.step_size for a in adaptations])),
+        np.median([a.inv_metric for a in adaptations], axis=0),
+    )
+
+
+def warm_start_failed(fit, parameters, num_draws: int) -> bool:
+    """Whether a warm-started fit should be rerun with full adaptation"""
+    diagnostics = fit_diagnostics(fit, parameters)
+    min_ess = WARM_START_MIN_ESS_FRACTION * num_draws
+    return (
+        diagnostics.divergences > WARM_START_MAX_DIVERGENT_FRACTION * num_draws
+        or not diagnostics.max_rhat <= WARM_START_MAX_RHAT
+        or not diagnostics.min_ess_bulk >= min_ess
+        or not diagnostics.min_ess_tail >= min_ess
+    )
@@ -4,109 +4,1182 @@
 # Copyright (C)2023 Siyan Liu (siyan.liu432@duke.edu)
 # =========================================================================
 
-import concurrent.futures
-from collections import defaultdict
-from importlib.resources import files
+import asyncio
+import sys
+import tempfile
+import time
+from contextlib import aclosing
+from itertools import chain
 from operator import itemgetter
+from typing import Callable, NamedTuple
 
-from cmdstanpy import CmdStanModel
+import numpy as np
+from cmdstanpy import CmdStanMLE, CmdStanModel, CmdStanVB
 
 from .constants import (
+    BATCH_MODEL_FILES,
+    DEFAULT_BATCH_MAX_CELLS,
+    DEFAULT_BATCH_SIZE,
     DEFAULT_CHAINS,
+    DEFAULT_CORES,
+    DEFAULT_ENGINE,
+    DEFAULT_INFERENCE,
     DEFAULT_NORM_LPF,
-    DEFAULT_RUNS,
+    DEFAULT_PILOT_GUIDES,
     DEFAULT_SAMPLE,
     DEFAULT_SEED,
+    DEFAULT_THREADS_PER_CHAIN,
+    DEFAULT_WARM_WARMUP,
     DEFAULT_WARMUP,
     MAX_SEED_INT,
+    MODEL_PARAMETERS,
 )
+from .diagnostics import (
+    Adaptation,
+    ConvergenceTargets,
+    adaptation,
+    combine_adaptations,
+    fit_diagnostics,
+    warm_start_failed,
+)
+from .matrix_market import MMData
+from .mixture import fit_map, initial_params, posterior_probability
+from .model_cache import compiled_model
+from .profiling import Profiler, stage, stan_profile
+from .result_cache import ResultCache, result_key
+from .scheduler import ScheduleReport, Task, aiter_tasks, iter_tasks, task_cost, worker_count
+from .shards import shard_of
+from .triage import SEPARATED, is_decisive, triage_candidates
 
 MMLines = list[tuple[str, str, int]]
-CountData = dict[str, float]
 
+# Upper bound on the number of PZi values (draws × cells) computed or summarized at once
+PZI_CHUNK_VALUES = 1 << 22
+# Subsampling keeps at least this many rows of each count stratum (all of them if it has fewer)
+MIN_STRATUM_ROWS = 50
+# Counts up to this are strata of their own; larger counts are binned in quarter octaves
+EXACT_STRATUM_COUNTS = 32
 
-def mm_counts(mtx_lines: MMLines, norm_lpf: int) -> tuple[dict[str, int], dict[str, list[tuple[str, int]]]]:
-    cumulative_counts = {}
-    per_guide_counts = defaultdict(lambda: [])
 
-    for guide, cell_id, guide_count in mtx_lines:
-        if norm_lpf:
-            if cell_id not in cumulative_counts:
-                cumulative_counts[cell_id] = 0
+class GuideGroups(NamedTuple):
+    "Library entries grouped by guide. Guide i owns entries offsets[i] up to offsets[i + 1]."
 
-            if guide_count <= norm_lpf:
-                cumulative_counts[cell_id] += guide_count
-        else:
-            if cell_id not in cumulative_counts:
-                cumulative_counts[cell_id] = guide_count
-            else:
-                cumulative_counts[cell_id] += guide_count
+    guide_ids: np.ndarray
+    offsets: np.ndarray
+    cells: np.ndarray
+    cell_index: np.ndarray  # Position of each entry's cell in the library size array
+    counts: np.ndarray
 
-        per_guide_counts[guide].append((cell_id, guide_count))
 
-    for key, value in cumulative_counts.items():
-        if value == 0:
-            cumulative_counts[key] = 1
+class GuideCounts(NamedTuple):
+    "The cells a guide was seen in, its counts and the cells' normalized library sizes"
 
-    return cumulative_counts, per_guide_counts
+    cells: np.ndarray
+    counts: np.ndarray
+    lib_sizes: np.ndarray
 
 
-def normalize(count_data: dict[str, int]) -> CountData:
-    count = len(count_data)
-    total_size = sum(count_data.values())
-    avg_size = total_size / count
+def _string_rank(values: np.ndarray) -> np.ndarray:
+    """Rank of each value when the values are sorted as strings, which is the order the
+    tab-separated inputs and outputs have always used"""
+    rank = np.empty(len(values), dtype=np.int64)
+    rank[np.argsort(values.astype(str), kind="stable")] = np.arange(len(values))
+    return rank
 
-    norm_cell_counts = {cell_id: lib_size / avg_size for cell_id, lib_size in count_data.items()}
 
-    return norm_cell_counts
+def mm_counts(mm_data: MMData, norm_lpf: int) -> tuple[np.ndarray, GuideGroups]:
+    """Library size of every cell and the entries grouped by guide, in (guide, cell) order.
 
+    Library sizes only include counts up to `norm_lpf` (all counts when it is 0); cells whose
+    library size comes to 0 get a size of 1.
+    """
+    unique_guides, guide_index = np.unique(mm_data.guides, return_inverse=True)
+    unique_cells, cell_index = np.unique(mm_data.cells, return_inverse=True)
+    counts = np.asarray(mm_data.counts)
 
-def run_stan(stan_args):
-    model, guide_id, X, L, num_warmup, num_samples, chains, seed = stan_args
-    fit = model.sample(
-        data={"N": len(X), "X": X, "L": L},
-        iter_warmup=num_warmup,
-        iter_sampling=num_samples,
-        chains=chains,
-        seed=seed,
-        show_progress=False,
+    weights = np.where(counts <= norm_lpf, counts, 0) if norm_lpf else counts
+    library_sizes = np.bincount(cell_index, weights=weights, minlength=len(unique_cells))
+    library_sizes[library_sizes == 0] = 1
+
+    key = _string_rank(unique_guides)[guide_index] * len(unique_cells) + _string_rank(unique_cells)[cell_index]
+    order = np.argsort(key, kind="stable")
+    del key
+
+    guide_sizes = np.bincount(guide_index, minlength=len(unique_guides))
+    guide_order = np.argsort(_string_rank(unique_guides))
+    groups = GuideGroups(
+        guide_ids=unique_guides[guide_order],
+        offsets=np.concatenate(([0], np.cumsum(guide_sizes[guide_order]))),
+        cells=np.asarray(mm_data.cells)[order],
+        cell_index=cell_index[order],
+        counts=counts[order],
     )
-    return guide_id, fit
-
-
-async def run(
-    mm_lines: MMLines,
-    model_file: str,
-    chains: int = DEFAULT_CHAINS,
-    normalization_lpf: int = DEFAULT_NORM_LPF,
-    num_parallel_runs: int = DEFAULT_RUNS,
-    num_samples: int = DEFAULT_SAMPLE,
-    num_warmup: int = DEFAULT_WARMUP,
-    seed: int = DEFAULT_SEED,
+
+    return library_sizes, groups
+
+
+def normalize(library_sizes: np.ndarray) -> np.ndarray:
+    return library_sizes / library_sizes.mean()
+
+
+def per_guide_counts(groups: GuideGroups, normalized_sizes: np.ndarray) -> dict[str, GuideCounts]:
+    """Each guide's cells, counts and normalized library sizes, as views into shared arrays"""
+    lib_sizes = normalized_sizes[groups.cell_index]
+    offsets = groups.offsets
+
+    return {
+        str(guide_id): GuideCounts(
+            groups.cells[offsets[i] : offsets[i + 1]],
+            groups.counts[offsets[i] : offsets[i + 1]],
+            lib_sizes[offsets[i] : offsets[i + 1]],
+        )
+        for i, guide_id in enumerate(groups.guide_ids)
+    }
+
+
+def fit_variables(fit) -> dict[str, np.ndarray]:
+    """Variables of any cmdstanpy fit with a leading draws axis. Point estimates (optimize) are
+    returned as a single draw. Empty variables (per-cell quantities that were not generated) are
+    left out."""
+    if isinstance(fit, CmdStanVB):
+        variables = fit.stan_variables(mean=False)
+    elif isinstance(fit, CmdStanMLE):
+        variables = {name: np.asarray(value)[np.newaxis, ...] for name, value in fit.stan_variables().items()}
+    else:
+        variables = fit.stan_variables()
+    return {name: value for name, value in variables.items() if 0 not in value.shape[1:]}
+
+
+def compress_observations(X, L, tolerance: float = 0.0):
+    """Collapse identical (count, library size) observations into weighted rows.
+
+    Library sizes are binned to multiples of `tolerance` before grouping (exact matches when
+    `tolerance` is 0); each unique row takes the mean library size of its group. Returns the
+    unique counts, library sizes and multiplicity weights plus, for each original observation,
+    the index of the unique row it was collapsed into.
+    """
+    X = np.asarray(X)
+    L = np.asarray(L, dtype=float)
+    l_key = np.round(L / tolerance) if tolerance > 0 else L
+
+    keys = np.column_stack((X, l_key))
+    _, first, index, weights = np.unique(keys, axis=0, return_index=True, return_inverse=True, return_counts=True)
+    index = index.reshape(-1)
+    unique_L = np.bincount(index, weights=L) / weights if tolerance > 0 else L[first]
+
+    return X[first], unique_L, weights, index
+
+
+def count_strata(X) -> np.ndarray:
+    """Stratum of each count: the count itself up to EXACT_STRATUM_COUNTS, then a quarter-octave bin"""
+    X = np.asarray(X)
+    with np.errstate(divide="ignore"):
+        binned = EXACT_STRATUM_COUNTS + np.floor(4 * np.log2(np.maximum(X, 1) / EXACT_STRATUM_COUNTS))
+    return np.where(X <= EXACT_STRATUM_COUNTS, X, binned).astype(np.int64)
+
+
+def subsample_observations(X, L, W, max_rows: int, seed: int):
+    """A count-stratified random subsample of about `max_rows` of a guide's rows, reweighted so
+    that each stratum keeps its total weight.
+
+    Each stratum keeps a share of `max_rows` in proportion to its size, but at least
+    MIN_STRATUM_ROWS rows, so the rare large counts that pin down the native component are all
+    fit. Returns the subsample's counts, library sizes and weights.
+    """
+    X = np.asarray(X)
+    L = np.asarray(L, dtype=float)
+    W = np.asarray(W, dtype=float)
+    if len(X) <= max_rows:
+        return X, L, W
+
+    _, stratum, sizes = np.unique(count_strata(X), return_inverse=True, return_counts=True)
+    stratum = stratum.reshape(-1)
+    quotas = np.minimum(sizes, np.maximum(np.ceil(max_rows * sizes / len(X)), MIN_STRATUM_ROWS))
+
+    # Rank the rows of each stratum in a random order and keep the first `quota` of them
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(len(X)), stratum))
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    rank = np.empty(len(X), dtype=np.int64)
+    rank[order] = np.arange(len(X)) - np.repeat(starts, sizes)
+    keep = rank < quotas[stratum]
+
+    total_weight = np.bincount(stratum, weights=W, minlength=len(sizes))
+    kept_weight = np.bincount(stratum[keep], weights=W[keep], minlength=len(sizes))
+    return X[keep], L[keep], W[keep] * (total_weight / kept_weight)[stratum[keep]]
+
+
+class GuideSamples:
+    """Posterior draws of a single guide fit, keyed by Stan variable name.
+
+    Per-observation variables such as PZi hold one column per fitted row; `index` maps each cell
+    to its row when the observations were compressed. Reduced samples keep only the parameter
+    draws and a summary of each cell's PZi.
+    """
+
+    def __init__(self, draws: dict[str, np.ndarray], model_file: str | None = None, index=None, summary=None):
+        self.draws = draws
+        self.model_file = model_file
+        self.index = index
+        self.summary = summary  # (medians, quantiles) of each cell's PZi
+        self.info = {}  # Details of how the fit went, e.g. its NUTS adaptation
+
+    def stan_variable(self, var: str) -> np.ndarray:
+        value = self.draws[var]
+        if self.index is not None and value.ndim == 2:
+            return value[:, self.index]
+        return value
+
+    def pzi_chunks(self, X, L, chunk_values: int = PZI_CHUNK_VALUES):
+        """PZi draws of each cell, as (draws, cells) blocks of consecutive cells. When the fit did
+        not generate PZi it is computed from the parameter draws, one block at a time."""
+        if "PZi" in self.draws:
+            pzi = self.draws["PZi"]
+            step = max(1, chunk_values // len(pzi))
+            for start in range(0, len(X), step):
+                if self.index is None:
+                    yield pzi[:, start : start + step]
+                else:
+                    yield pzi[:, self.index[start : start + step]]
+            return
+
+        params = {name: self.draws[name][:, np.newaxis] for name in MODEL_PARAMETERS[self.model_file]}
+        step = max(1, chunk_values // len(params["r"]))
+        for start in range(0, len(X), step):
+            yield posterior_probability(self.model_file, params, X[start : start + step], L[start : start + step])
+
+    def pzi_summaries(self, X, L, quantiles=()):
+        """(medians, quantiles, draws) of the PZi of consecutive blocks of cells. Reduced samples
+        yield their stored summary as a single block, without draws."""
+        if self.summary is not None:
+            yield (*self.summary, None)
+            return
+
+        for pzi in self.pzi_chunks(X, L):
+            yield np.median(pzi, axis=0), np.quantile(pzi, quantiles, axis=0).T if quantiles else None, pzi
+
+    def reduced(self, X, L, quantiles=()) -> "GuideSamples":
+        """The parameter draws and each cell's PZi median and `quantiles`. `X` and `L` are the
+        fitted rows, so each unique row is only summarized once."""
+        rows = GuideSamples(self.draws, self.model_file)
+        blocks = list(rows.pzi_summaries(X, L, quantiles))
+        medians = np.concatenate([block_medians for block_medians, _, _ in blocks])
+        cell_quantiles = np.concatenate([block_quantiles for _, block_quantiles, _ in blocks]) if quantiles else None
+        if self.index is not None:
+            medians = medians[self.index]
+            cell_quantiles = cell_quantiles[self.index] if quantiles else None
+
+        parameters = {name: value for name, value in self.draws.items() if value.ndim == 1}
+        reduced = GuideSamples(parameters, self.model_file, summary=(medians, cell_quantiles))
+        reduced.info = self.info
+        return reduced
+
+    @classmethod
+    def from_fit(cls, fit, index=None) -> "GuideSamples":
+        return cls(fit_variables(fit), index=index)
+
+    @classmethod
+    def from_batch_fit(cls, fit, parameters, guide: int, start: int, size: int, index=None) -> "GuideSamples":
+        """Extract the draws of one guide from a batched fit. `parameters` are indexed by guide,
+        every other variable by observation."""
+        draws = {}
+        for name, value in fit_variables(fit).items():
+            if name in parameters:
+                draws[name] = value[:, guide]
+            else:
+                draws[name] = value[:, start : start + size]
+        return cls(draws, index=index)
+
+
+class FitOptions(NamedTuple):
+    "Settings shared by every fit of a run"
+
+    model_file: str
+    inference: str
+    num_warmup: int
+    num_samples: int
+    chains: int
+    threads_per_chain: int
+    generate_pzi: bool
+    keep_pzi_draws: bool
+    quantiles: tuple
+    warm_start: Adaptation | None = None  # Step size and metric to start NUTS from
+    warm_warmup: int = 0
+    targets: ConvergenceTargets | None = None  # Extend NUTS fits until they meet these
+    subsample: int = 0  # Fit single guides with more rows than this on a subsample of about this many
+    profile: bool = False  # Time the models' profile blocks
+    keep_adaptation: bool = False  # Return every NUTS fit's adaptation, for warm starting other guides
+
+
+def fit_model(
+    model: CmdStanModel,
+    data,
+    inference: str,
+    num_warmup: int,
+    num_samples: int,
+    chains: int,
+    seed: int,
+    threads_per_chain: int = DEFAULT_THREADS_PER_CHAIN,
+    output_dir: str | None = None,
+    warm_start: Adaptation | None = None,
+    inits: dict | None = None,
+    timings: dict | None = None,
+    save_profile: bool = False,
+):
+    """Run one of CmdStan's inference algorithms. The approximate methods draw as many samples
+    as `chains` NUTS chains would. A `warm_start` NUTS run samples with the given step size and
+    metric without adapting them, so its warmup iterations are only burn-in; CmdStan does not
+    report an adaptation for it. NUTS chains start from `inits` when given. The seconds CmdStan
+    ran are added to `timings["sample"]`.
+
+    With `save_profile`, the timings of the model's profile blocks are saved to `output_dir`."""
+    start_time = time.perf_counter()
+    if inference == "nuts":
+        warm_start_args = {}
+        if warm_start is not None:
+            warm_start_args = {
+                "step_size": warm_start.step_size,
+                "metric": {"inv_metric": warm_start.inv_metric.tolist()},
+                "adapt_engaged": False,
+            }
+        fit = model.sample(
+            data=data,
+            iter_warmup=num_warmup,
+            iter_sampling=num_samples,
+            chains=chains,
+            threads_per_chain=threads_per_chain,
+            seed=seed,
+            inits=inits,
+            output_dir=output_dir,
+            show_progress=False,
+            save_profile=save_profile,
+            **warm_start_args,
+        )
+    elif inference == "optimize":
+        fit = model.optimize(data=data, seed=seed, output_dir=output_dir, save_profile=save_profile)
+    elif inference == "laplace":
+        fit = model.laplace_sample(
+            data=data, draws=num_samples * chains, seed=seed, output_dir=output_dir, save_profile=save_profile
+        )
+    elif inference == "pathfinder":
+        fit = model.pathfinder(
+            data=data, draws=num_samples * chains, seed=seed, output_dir=output_dir, save_profile=save_profile
+        )
+    elif inference == "advi":
+        fit = model.variational(
+            data=data, draws=num_samples * chains, seed=seed, output_dir=output_dir, save_profile=save_profile
+        )
+    else:
+        raise ValueError(f"Unknown inference method {inference}")
+
+    if timings is not None:
+        timings["sample"] = timings.get("sample", 0.0) + time.perf_counter() - start_time
+    return fit
+
+
+def finish_samples(samples: GuideSamples, X, L, options: FitOptions) -> GuideSamples:
+    """Reduce a fit to what the outputs need before it is sent back to the parent process"""
+    samples.model_file = options.model_file
+    if options.keep_pzi_draws:
+        return samples
+    return samples.reduced(X, L, options.quantiles)
+
+
+def extend_fit(
+    fit,
+    model,
+    data,
+    options: FitOptions,
+    seed: int,
+    output_dir: str,
+    timings: dict | None = None,
+    fit_adaptation: Adaptation | None = None,
 ):
-    sorted_mm_lines = sorted(mm_lines, key=itemgetter(0, 1))
-    cumulative_counts, per_guide_counts = mm_counts(sorted_mm_lines, normalization_lpf)
-    normalized_counts = normalize(cumulative_counts)
-
-    stan_model = CmdStanModel(stan_file=files("cleanser").joinpath(model_file))
-
-    stan_params = [
-        (
-            stan_model,
-            guide_id,
-            [guide_count for _, guide_count in guide_counts],  # X
-            [normalized_counts[cell_id] for cell_id, _ in guide_counts],  # L
+    """Refit a guide with twice as many draws until it meets `options.targets` or reaches their
+    `max_samples`. Every refit samples with the first fit's adaptation (`fit_adaptation` when it
+    was warm started from one, otherwise what it adapted) and starts from the previous fit's
+    posterior means, so it only needs a short burn-in. Returns the last fit, its diagnostics and
+    the adaptation it sampled with, which is only read from the first fit when it is extended or
+    `options.keep_adaptation` is set."""
+    parameters = MODEL_PARAMETERS[options.model_file]
+    diagnostics = fit_diagnostics(fit, parameters)
+    targets = options.targets
+    num_samples = options.num_samples
+
+    def extending() -> bool:
+        return targets is not None and not targets.met(diagnostics) and num_samples < targets.max_samples
+
+    if fit_adaptation is None and (options.keep_adaptation or extending()):
+        fit_adaptation = adaptation(fit)
+    while extending():
+        num_samples = min(2 * num_samples, targets.max_samples)
+        fit = fit_model(
+            model,
+            data,
+            options.inference,
+            options.warm_warmup if fit_adaptation is not None else options.num_warmup,
+            num_samples,
+            options.chains,
+            (seed + diagnostics.rounds) % MAX_SEED_INT,
+            options.threads_per_chain,
+            output_dir,
+            fit_adaptation,
+            {name: float(np.mean(fit.stan_variable(name))) for name in parameters},
+            timings,
+            options.profile,
+        )
+        diagnostics = fit_diagnostics(fit, parameters)._replace(rounds=diagnostics.rounds + 1)
+
+    return fit, diagnostics, fit_adaptation
+
+
+def run_stan(stan_args):
+    exe_file, (guide_id, X, L, W, index), options, seed = stan_args
+
+    # A subsampled fit only samples the parameters; every cell's PZi is computed from their draws
+    fit_X, fit_L, fit_W = X, L, W
+    if options.subsample and len(X) > options.subsample:
+        fit_X, fit_L, fit_W = subsample_observations(X, L, W, options.subsample, seed)
+    subsampled = len(fit_X) < len(X)
+
+    model = CmdStanModel(exe_file=exe_file)
+    data = {
+        "N": len(fit_X),
+        "X": fit_X,
+        "L": fit_L,
+        "W": fit_W,
+        "grainsize": 1,
+        "generate_pzi": int(options.generate_pzi and not subsampled),
+    }
+    info = {"subsample": len(fit_X)} if subsampled else {}
+    timings = {}
+    start_time = time.perf_counter()
+
+    # CmdStan's CSV files are only needed until the draws are read
+    with tempfile.TemporaryDirectory() as output_dir:
+        if options.warm_start is not None:
+            inits = initial_params(options.model_file, fit_X, fit_L, fit_W, np.zeros(len(fit_X), dtype=np.int64), 1)
+            fit = fit_model(
+                model,
+                data,
+                options.inference,
+                options.warm_warmup,
+                options.num_samples,
+                options.chains,
+                seed,
+                options.threads_per_chain,
+                output_dir,
+                options.warm_start,
+                {name: float(value[0]) for name, value in inits.items()},
+                timings,
+                options.profile,
+            )
+            info["warm_start"] = not warm_start_failed(
+                fit, MODEL_PARAMETERS[options.model_file], options.num_samples * options.chains
+            )
+
+        if not info.get("warm_start"):
+            fit = fit_model(
+                model,
+                data,
+                options.inference,
+                options.num_warmup,
+                options.num_samples,
+                options.chains,
+                seed,
+                options.threads_per_chain,
+                output_dir,
+                timings=timings,
+                save_profile=options.profile,
+            )
+
+        if options.inference == "nuts":
+            fit, diagnostics, info["adaptation"] = extend_fit(
+                fit,
+                model,
+                data,
+                options,
+                seed,
+                output_dir,
+                timings,
+                options.warm_start if info.get("warm_start") else None,
+            )
+            info["diagnostics"] = diagnostics._replace(seconds=time.perf_counter() - start_time)
+        samples = GuideSamples.from_fit(fit, index)
+        samples.info = info
+        info["stan_profile"] = stan_profile(output_dir)
+        timings["read"] = time.perf_counter() - start_time - timings["sample"]
+
+    reduce_time = time.perf_counter()
+    samples = finish_samples(samples, X, L, options)
+    timings["reduce"] = time.perf_counter() - reduce_time
+    info["timings"] = timings
+    return guide_id, samples
+
+
+def run_stan_batch(batch_args):
+    exe_file, guides, options, seed = batch_args
+
+    sizes = [len(X) for _, X, _, _, _ in guides]
+    starts = np.cumsum([0] + sizes[:-1])
+    timings = {}
+    start_time = time.perf_counter()
+    with tempfile.TemporaryDirectory() as output_dir:
+        fit = fit_model(
+            CmdStanModel(exe_file=exe_file),
+            {
+                "G": len(guides),
+                "N": sum(sizes),
+                "guide_start": (starts + 1).tolist(),
+                "guide_size": sizes,
+                "X": list(chain.from_iterable(X for _, X, _, _, _ in guides)),
+                "L": list(chain.from_iterable(L for _, _, L, _, _ in guides)),
+                "W": list(chain.from_iterable(W for _, _, _, W, _ in guides)),
+                "generate_pzi": int(options.generate_pzi),
+            },
+            options.inference,
+            options.num_warmup,
+            options.num_samples,
+            options.chains,
+            seed,
+            output_dir=output_dir,
+            timings=timings,
+            save_profile=options.profile,
+        )
+        parameters = MODEL_PARAMETERS[options.model_file]
+        samples = [
+            GuideSamples.from_batch_fit(fit, parameters, i, start, size, index)
+            for i, ((_, _, _, _, index), start, size) in enumerate(zip(guides, starts, sizes))
+        ]
+        if options.inference == "nuts":
+            # Guides share the batch's divergences, tree depth hits and wall time
+            seconds = (time.perf_counter() - start_time) / len(guides)
+            for i, guide_samples in enumerate(samples):
+                guide_parameters = [f"{name}[{i + 1}]" for name in parameters]
+                guide_samples.info["diagnostics"] = fit_diagnostics(fit, guide_parameters)._replace(seconds=seconds)
+        # Profile blocks cover the whole batch, so each guide gets an equal share
+        profile = {name: seconds / len(guides) for name, seconds in stan_profile(output_dir).items()}
+        timings["read"] = time.perf_counter() - start_time - timings["sample"]
+
+    reduce_time = time.perf_counter()
+    results = [
+        (guide_id, finish_samples(guide_samples, X, L, options))
+        for (guide_id, X, L, _, _), guide_samples in zip(guides, samples)
+    ]
+    timings["reduce"] = time.perf_counter() - reduce_time
+    for _, guide_samples in results:
+        guide_samples.info.update(stan_profile=profile, timings=timings)
+    return results
+
+
+def run_em(model_file: str, guides) -> dict[str, GuideSamples]:
+    """Fit every guide at once with the NumPy MAP engine. Each guide's samples hold a single draw:
+    the point estimate of its parameters and the resulting PZi of each row."""
+    sizes = [len(X) for _, X, _, _, _ in guides]
+    starts = np.cumsum([0] + sizes)
+    guide_index = np.repeat(np.arange(len(guides)), sizes)
+    X = np.concatenate([X for _, X, _, _, _ in guides])
+    L = np.concatenate([L for _, _, L, _, _ in guides])
+    W = np.concatenate([W for _, _, _, W, _ in guides])
+
+    params = fit_map(model_file, X, L, W, guide_index, len(guides))
+    pzi = posterior_probability(model_file, params, X, L, guide_index)
+
+    fits = {}
+    for i, (guide_id, _, _, _, index) in enumerate(guides):
+        draws = {name: value[i : i + 1] for name, value in params.items()}
+        draws["PZi"] = pzi[np.newaxis, starts[i] : starts[i + 1]]
+        fits[guide_id] = GuideSamples(draws, model_file, index)
+
+    return fits
+
+
+def pack_guides(guides, batch_size: int, batch_max_cells: int):
+    """Split guides into those fit on their own and batches of up to `batch_size` small guides
+    (at most `batch_max_cells` observations each) that are fit together in one Stan program."""
+    if batch_size <= 1:
+        return guides, []
+
+    single = [guide for guide in guides if len(guide[1]) > batch_max_cells]
+    small = [guide for guide in guides if len(guide[1]) <= batch_max_cells]
+    batches = [small[i : i + batch_size] for i in range(0, len(small), batch_size)]
+
+    return single, batches
+
+
+def guide_data(guide_counts: GuideCounts, compress: bool, compression_tolerance: float):
+    X, L = guide_counts.counts, guide_counts.lib_sizes
+
+    if not compress:
+        return X, L, np.ones(len(X), dtype=np.int64), None
+
+    return compress_observations(X, L, compression_tolerance)
+
+
+def fit_guides(mm_data: MMData | MMLines, model_file: str, **options):
+    """Fit every guide, yielding (guide id, samples, counts) as each fit completes. The options are
+    the keyword arguments of `FitRun`.
+
+    Without `keep_pzi_draws`, the workers reduce each fit to its parameter draws and the median
+    and `quantiles` of each cell's PZi, so only those are sent back to this process. With a
+    `result_cache`, Stan fits found in the cache are not run again and new fits are added to it.
+
+    With `warm_start`, NUTS first fits `pilot_guides` guides with full adaptation. The remaining
+    single guides sample with the pilots' step size and metric, without adapting them, from
+    data-driven inits after a burn-in of `warm_warmup` iterations; guides whose warm-started fit
+    diverges, does not mix or has a low ESS are refit with full warmup.
+
+    With convergence `targets`, every single-guide NUTS fit starts with `num_samples` draws per
+    chain and is refit with twice as many, with its first fit's adaptation and a burn-in of
+    `warm_warmup` iterations, until its R-hat, bulk and tail ESS and divergences meet the
+    targets. NUTS samples carry their fit's diagnostics in `info["diagnostics"]`.
+
+    With `shard` (K, N), only the guides in shard K of N are fit. Library sizes are still
+    normalized over the whole library, so each guide's fit is the same as in an unsharded run.
+
+    With `subsample`, single guides with more rows than that are fit on a count-stratified,
+    reweighted subsample of about `subsample` rows, and every cell's PZi is computed from the
+    parameter draws.
+
+    With `triage`, guides that are degenerate (see `cleanser.triage`) are fit by the NumPy MAP
+    engine instead of Stan. Their samples hold the point estimate as a single draw, and the reason
+    they were triaged in `info["triage"]`.
+
+    A `profiler` records the time of each stage and of every guide's fit, and `progress` is called
+    with a `Progress` after every guide once the library is prepared.
+    """
+    for _, guide_id, samples, counts in fit_libraries([mm_data], model_file, **options):
+        yield guide_id, samples, counts
+
+
+def fit_libraries(libraries: list[MMData | MMLines], model_file: str, **options):
+    """Fit every guide of several libraries, yielding (library index, guide id, samples, counts)
+    as each fit completes. The options are those of `fit_guides`.
+
+    Each library is normalized on its own, and its guides are fit with the same seeds as when it
+    is fit alone, but the Stan fits of all the libraries are scheduled on one pool of workers,
+    so the tail of one library's fits overlaps the fits of the others. Warm-started fits start
+    from the adaptation of their own library's pilots.
+    """
+    fit_run = FitRun(model_file, **options)
+    for fit in fit_run.prepare(libraries):
+        yield fit_run.receive(*fit)
+    for task_specs in fit_run.rounds():
+        for fit in _run_task_specs(task_specs, **fit_run.task_args):
+            yield fit_run.receive(*fit)
+    fit_run.finish()
+
+
+class Progress(NamedTuple):
+    "How far a fit has got, reported as each guide's fit completes"
+
+    done: int  # Guides fit so far
+    total: int
+    elapsed: float  # Seconds since the fit started
+    eta: float | None  # Estimated seconds until every guide is fit, once a Stan fit has completed
+
+
+async def fit_libraries_async(libraries: list[MMData | MMLines], model_file: str, **options):
+    """Async counterpart of `fit_libraries`, for running inside an event loop.
+
+    Normalization, triage, the EM engine, model compilation and result cache reads, writes and
+    eviction run in the loop's default executor, and the Stan fits are submitted to the worker
+    pool with `loop.run_in_executor`, so the event loop is never blocked while guides are fit.
+    `progress` is called from the event loop's thread.
+
+    Closing the generator (e.g. with `contextlib.aclosing`), or cancelling the task iterating over
+    it, cancels the fits that have not started; fits already running finish in the background and
+    their results are dropped.
+    """
+    loop = asyncio.get_running_loop()
+    fit_run = FitRun(model_file, **options)
+    point_fits = await loop.run_in_executor(None, list, fit_run.prepare(libraries))
+    for fit in point_fits:
+        yield fit_run.receive(*fit)
+    del point_fits
+    for task_specs in fit_run.rounds():
+        async with aclosing(_arun_task_specs(task_specs, **fit_run.task_args)) as results:
+            async for fit in results:
+                yield fit_run.receive(*fit)
+    await loop.run_in_executor(None, fit_run.finish)
+
+
+async def fit_guides_async(mm_data: MMData | MMLines, model_file: str, **options):
+    """Fit every guide of one library, yielding (guide id, samples, counts) as each fit completes
+    without blocking the event loop. The options are those of `fit_guides`."""
+    async with aclosing(fit_libraries_async([mm_data], model_file, **options)) as fits:
+        async for _, guide_id, samples, counts in fits:
+            yield guide_id, samples, counts
+
+
+class FitRun:
+    """The options of a fit of one or more libraries, and the state carried between its stages:
+    preparing the libraries, fitting each library's pilots when warm starting, and fitting the
+    remaining guides. `fit_libraries` and `fit_libraries_async` drive it; every other fitting
+    function takes its keyword arguments as options."""
+
+    def __init__(
+        self,
+        model_file: str,
+        chains: int = DEFAULT_CHAINS,
+        normalization_lpf: int = DEFAULT_NORM_LPF,
+        num_parallel_runs: int | None = None,
+        num_samples: int = DEFAULT_SAMPLE,
+        num_warmup: int = DEFAULT_WARMUP,
+        seed: int = DEFAULT_SEED,
+        compress: bool = False,
+        compression_tolerance: float = 0.0,
+        threads_per_chain: int = DEFAULT_THREADS_PER_CHAIN,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        batch_max_cells: int = DEFAULT_BATCH_MAX_CELLS,
+        engine: str = DEFAULT_ENGINE,
+        inference: str = DEFAULT_INFERENCE,
+        cores: int = DEFAULT_CORES,
+        pzi_from_draws: bool = False,
+        keep_pzi_draws: bool = True,
+        quantiles=(),
+        result_cache: ResultCache | None = None,
+        warm_start: bool = False,
+        pilot_guides: int = DEFAULT_PILOT_GUIDES,
+        warm_warmup: int = DEFAULT_WARM_WARMUP,
+        targets: ConvergenceTargets | None = None,
+        shard: tuple[int, int] | None = None,
+        subsample: int = 0,
+        triage: bool = False,
+        profiler: Profiler | None = None,
+        progress: Callable[[Progress], None] | None = None,
+    ):
+        self.start = time.time()
+        self.options = FitOptions(
+            model_file,
+            inference,
             num_warmup,
             num_samples,
             chains,
-            (seed + int(guide_id)) % MAX_SEED_INT,
+            threads_per_chain,
+            not pzi_from_draws,
+            keep_pzi_draws,
+            tuple(quantiles),
+            warm_warmup=warm_warmup if targets is not None else 0,
+            targets=targets,
+            subsample=subsample,
+            profile=profiler is not None,
+        )
+        self.planning = {
+            "normalization_lpf": normalization_lpf,
+            "compress": compress,
+            "compression_tolerance": compression_tolerance,
+            "batch_size": batch_size,
+            "batch_max_cells": batch_max_cells,
+            "engine": engine,
+            "shard": shard,
+            "triage": triage,
+            "profiler": profiler,
+        }
+        self.task_args = {
+            "seed": seed,
+            "threads_per_chain": threads_per_chain,
+            "result_cache": result_cache,
+            "num_parallel_runs": num_parallel_runs,
+            "cores": cores,
+            # Every NUTS fit runs its chains in parallel, each using threads_per_chain cores
+            "cores_per_task": (chains if inference == "nuts" else 1) * threads_per_chain,
+            "profiler": profiler,
+        }
+        self.stan = engine != "em"
+        self.warm_start = warm_start and inference == "nuts"
+        self.pilot_guides = pilot_guides
+        self.warm_warmup = warm_warmup
+        self.result_cache = result_cache
+        self.progress = progress
+        self.tally = _FitTally(self.warm_start, targets if inference == "nuts" else None)
+
+        self.plan = _LibraryPlan([], [], [])
+        self.tracker = None
+        self.received = 0  # Fits received before the libraries were prepared
+        self.adaptations = None  # The adaptation of each library's pilots, while they are fit
+
+    def prepare(self, libraries: list[MMData | MMLines]):
+        """Normalize each library and pack its guides for Stan, yielding (library index, guide id,
+        samples) of the guides fit without Stan"""
+        yield from _plan_libraries(self.plan, libraries, self.options, **self.planning)
+        self.tracker = _ProgressTracker(self.plan, self.start, self.progress, self.received)
+
+    def rounds(self):
+        """Task specs of each round of Stan fits. A round is only built once the fits of the round
+        before it have been received, since warm-started fits need their pilots' adaptation."""
+        if not self.stan:
+            return
+
+        library_options = [self.options] * len(self.plan.singles)
+        pilot_ids = [set() for _ in self.plan.singles]
+        if self.warm_start:
+            # Fit a few typically sized guides of each library with full adaptation first, and start
+            # the library's other guides from their step size and metric with a short warmup
+            pilot_specs, pilot_ids = _pilot_specs(self.plan, self.options, self.pilot_guides)
+            self.adaptations = [[] for _ in self.plan.singles]
+            if pilot_specs:
+                yield pilot_specs
+            library_options = [
+                _warm_options(self.options, library_adaptations, self.warm_warmup)
+                for library_adaptations in self.adaptations
+            ]
+            self.adaptations = None
+
+        yield _single_specs(self.plan, library_options, pilot_ids)
+
+    def receive(self, library: int, guide_id: str, samples: GuideSamples):
+        """(library index, guide id, samples, counts) of a completed fit, after recording it"""
+        if self.adaptations is not None and samples.info.get("adaptation") is not None:
+            self.adaptations[library].append(samples.info["adaptation"])
+        self.tally.add(samples)
+
+        if self.tracker is None:
+            self.received += 1
+        else:
+            self.tracker.update(library, guide_id)
+        return library, guide_id, samples, self.plan.counts[library][guide_id]
+
+    def finish(self):
+        if not self.stan:
+            return
+        self.tally.report()
+        if self.result_cache is not None:
+            self.result_cache.evict()
+
+
+class _LibraryPlan(NamedTuple):
+    "The Stan fits left once every library is prepared"
+
+    counts: list[dict[str, GuideCounts]]  # {guide id: counts} of each library
+    batch_specs: list  # (function, model file, guides, options, library index) of the batched fits
+    singles: list[list]  # The (guide id, X, L, W, index) guides of each library fit on their own
+
+
+def _plan_libraries(
+    plan: _LibraryPlan,
+    libraries,
+    options: FitOptions,
+    normalization_lpf,
+    compress,
+    compression_tolerance,
+    batch_size,
+    batch_max_cells,
+    engine,
+    shard,
+    triage,
+    profiler,
+):
+    """Normalize each library and pack its guides for Stan, yielding (library index, guide id,
+    samples) of the guides fit without Stan: the triaged guides, or every guide with the EM
+    engine. The remaining fits are added to `plan`."""
+    model_file = options.model_file
+    # The EM engine always collapses identical observations; this is exact when the tolerance is 0
+    compress = compress or engine == "em"
+
+    for library, mm_data in enumerate(libraries):
+        with stage(profiler, "normalize"):
+            if not isinstance(mm_data, MMData):
+                mm_data = MMData.from_lines(mm_data)
+            library_sizes, groups = mm_counts(mm_data, normalization_lpf)
+            guide_counts = per_guide_counts(groups, normalize(library_sizes))
+        if shard is not None:
+            shard_index, num_shards = shard
+            guide_counts = {
+                guide_id: counts
+                for guide_id, counts in guide_counts.items()
+                if shard_of(guide_id, num_shards) == shard_index
+            }
+        plan.counts.append(guide_counts)
+
+        guides = [
+            (guide_id, *guide_data(counts, compress, compression_tolerance))  # X, L, W, index
+            for guide_id, counts in guide_counts.items()
+        ]
+
+        if triage and engine == "stan":
+            with stage(profiler, "triage"):
+                candidates = triage_candidates(guides)
+                point_fits = (
+                    run_em(model_file, [guide for guide in guides if guide[0] in candidates]) if candidates else {}
+                )
+                triaged = {
+                    guide_id: reason
+                    for guide_id, reason in candidates.items()
+                    if reason != SEPARATED or is_decisive(point_fits[guide_id].draws["PZi"])
+                }
+            for guide_id, X, L, _, _ in guides:
+                if guide_id in triaged:
+                    samples = finish_samples(point_fits[guide_id], X, L, options)
+                    samples.info["triage"] = triaged[guide_id]
+                    yield library, guide_id, samples
+            print(
+                f"Triage: {len(triaged)} of {len(guides)} guides were fit from point estimates instead of sampled",
+                file=sys.stderr,
+            )
+            guides = [guide for guide in guides if guide[0] not in triaged]
+            del point_fits
+
+        if engine == "em":
+            with stage(profiler, "em"):
+                fits = run_em(model_file, guides)
+            for guide_id, X, L, _, _ in guides:
+                yield library, guide_id, finish_samples(fits[guide_id], X, L, options)
+            plan.singles.append([])
+            continue
+
+        single_guides, batches = pack_guides(guides, batch_size, batch_max_cells)
+        plan.batch_specs.extend(
+            (run_stan_batch, BATCH_MODEL_FILES[model_file], batch, options, library) for batch in batches
         )
-        for guide_id, guide_counts in per_guide_counts.items()
+        plan.singles.append(single_guides)
+
+
+def _pilot_specs(plan: _LibraryPlan, options: FitOptions, pilot_guides: int):
+    """Task specs of a few typically sized single guides of each library, and their guide ids"""
+    specs, pilot_ids = [], []
+    for library, single_guides in enumerate(plan.singles):
+        by_size = sorted(single_guides, key=lambda guide: len(guide[1]))
+        middle = max(0, len(by_size) // 2 - pilot_guides // 2)
+        pilots = by_size[middle : middle + pilot_guides]
+        specs.extend(
+            (run_stan, options.model_file, [guide], options._replace(keep_adaptation=True), library) for guide in pilots
+        )
+        pilot_ids.append({guide[0] for guide in pilots})
+    return specs, pilot_ids
+
+
+def _warm_options(options: FitOptions, adaptations: list[Adaptation], warm_warmup: int) -> FitOptions:
+    return options._replace(warm_start=combine_adaptations(adaptations), warm_warmup=warm_warmup)
+
+
+def _single_specs(plan: _LibraryPlan, library_options: list[FitOptions], pilot_ids: list[set]):
+    """Task specs of the batches and of each library's single guides, except its pilots"""
+    return plan.batch_specs + [
+        (run_stan, options.model_file, [guide], options, library)
+        for library, (single_guides, options) in enumerate(zip(plan.singles, library_options))
+        for guide in single_guides
+        if guide[0] not in pilot_ids[library]
     ]
 
-    results = {}
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_parallel_runs) as executor:
-        for guide_id, samples in executor.map(run_stan, stan_params):
-            results[guide_id] = (samples, per_guide_counts[guide_id])
 
-    return results
+class _FitTally:
+    "Counts of the Stan fits that took more than one run, printed once every guide is fit"
+
+    def __init__(self, warm_start: bool, targets: ConvergenceTargets | None):
+        self.warm_start = warm_start
+        self.targets = targets
+        self.fallbacks = self.extended = self.unconverged = 0
+
+    def add(self, samples: GuideSamples):
+        self.fallbacks += samples.info.get("warm_start") is False
+        if self.targets is not None and "diagnostics" in samples.info:
+            self.extended += samples.info["diagnostics"].rounds > 1
+            self.unconverged += not self.targets.met(samples.info["diagnostics"])
+
+    def report(self):
+        if self.warm_start:
+            print(f"Warm start: {self.fallbacks} guides were refit with full warmup", file=sys.stderr)
+        if self.targets is not None:
+            print(
+                f"Adaptive sampling: {self.extended} guides were extended, {self.unconverged} did not meet the targets",
+                file=sys.stderr,
+            )
+
+
+class _ProgressTracker:
+    """Guides fit so far and the time left, estimated from the cost (see `task_cost`) of the Stan
+    fits completed since the first Stan fit was submitted"""
+
+    def __init__(self, plan: _LibraryPlan, start: float, callback: Callable[[Progress], None] | None, done: int = 0):
+        self.callback = callback
+        self.start = start
+        self.fit_start = time.time()
+        self.total = sum(len(guide_counts) for guide_counts in plan.counts)
+        self.done = done
+        self.costs = {
+            (library, guide[0]): task_cost(len(guide[1]))
+            for _, _, guides, _, library in plan.batch_specs
+            for guide in guides
+        }
+        self.costs.update(
+            ((library, guide[0]), task_cost(len(guide[1])))
+            for library, single_guides in enumerate(plan.singles)
+            for guide in single_guides
+        )
+        self.remaining_cost = sum(self.costs.values())
+        self.done_cost = 0.0
+
+    def update(self, library: int, guide_id: str):
+        self.done += 1
+        cost = self.costs.pop((library, guide_id), 0.0)
+        self.done_cost += cost
+        self.remaining_cost -= cost
+        if self.callback is None:
+            return
+
+        now = time.time()
+        eta = (now - self.fit_start) * self.remaining_cost / self.done_cost if self.done_cost else None
+        self.callback(Progress(self.done, self.total, now - self.start, eta))
+
+
+def _keyed_call(args):
+    """Call fn(fn_args) in a worker, returning the result with the task's key"""
+    key, fn, fn_args = args
+    return key, fn(fn_args)
+
+
+class _TaskRun:
+    """The pool tasks of fits given as (function, model file, guides, options, library index).
+    Fits found in the result cache are not run again, and are only read when they are yielded;
+    the others are added to it and recorded in the profile as their results come back. Single
+    guides use the threaded build of the model when threads_per_chain > 1."""
+
+    def __init__(self, task_specs, seed, threads_per_chain, result_cache, profiler):
+        self.seed = seed
+        self.threads_per_chain = threads_per_chain
+        self.result_cache = result_cache
+        self.profiler = profiler
+        self.tasks = []
+        self.hits = []  # (task spec, seed, key) of the fits found in the cache, read as they are yielded
+        self.libraries = []  # The library index of each task
+        self.cache_keys = {}
+        self.sizes = []  # (guide id, cells, rows) of the guides of each task
+        self.completed = []  # The index and the samples info of each task, in completion order
+        self.exe_files = {}
+
+        for task_spec in task_specs:
+            _, task_model_file, task_guides, options, _ = task_spec
+            task_seed = (seed + int(task_guides[0][0])) % MAX_SEED_INT
+            key = None
+            if result_cache is not None:
+                key = result_key(task_model_file, options, task_seed, task_guides)
+                if key in result_cache:
+                    self.hits.append((task_spec, task_seed, key))
+                    continue
+            self.add_task(task_spec, task_seed, key)
+
+    def add_task(self, task_spec, task_seed: int, key: str | None):
+        fn, task_model_file, task_guides, options, library = task_spec
+        if key is not None:
+            self.cache_keys[len(self.tasks)] = key
+        if task_model_file not in self.exe_files:
+            with stage(self.profiler, "compile"):
+                self.exe_files[task_model_file] = compiled_model(
+                    task_model_file,
+                    threaded=fn is run_stan and self.threads_per_chain > 1,
+                    profiled=options.profile,
+                )
+        self.sizes.append(
+            [(guide_id, len(X) if index is None else len(index), len(X)) for guide_id, X, _, _, index in task_guides]
+        )
+        self.libraries.append(library)
+        fn_args = (
+            self.exe_files[task_model_file],
+            task_guides[0] if fn is run_stan else task_guides,
+            options,
+            task_seed,
+        )
+        self.tasks.append(
+            Task(
+                _keyed_call,
+                (len(self.tasks), fn, fn_args),
+                task_cost(sum(len(X) for _, X, _, _, _ in task_guides)),
+            )
+        )
+
+    def load(self, hit) -> list:
+        """(library index, guide id, samples) of a fit found in the cache. If its entry has been
+        removed since, the fit is added to the tasks instead."""
+        task_spec, task_seed, key = hit
+        cached = self.result_cache.get(key)
+        if cached is None:
+            self.add_task(task_spec, task_seed, key)
+            return []
+        return [
+            (task_spec[4], guide_id, samples)
+            for guide_id, samples in (cached if isinstance(cached, list) else [cached])
+        ]
+
+    def workers(self, num_parallel_runs, cores, cores_per_task) -> int:
+        if num_parallel_runs is None:
+            return worker_count(cores, cores_per_task, len(self.tasks))
+        return num_parallel_runs
+
+    def store(self, task_index: int, result):
+        """Add a task's result to the result cache"""
+        if self.result_cache is not None:
+            self.result_cache.put(self.cache_keys[task_index], result)
+
+    def receive(self, task_index: int, result) -> list:
+        """(library index, guide id, samples) of a task's result"""
+        guide_results = result if isinstance(result, list) else [result]
+        if self.profiler is not None:
+            self.completed.append((task_index, [samples.info for _, samples in guide_results]))
+        return [(self.libraries[task_index], guide_id, samples) for guide_id, samples in guide_results]
+
+    def finish(self, report: ScheduleReport):
+        print(report, file=sys.stderr)
+        if self.profiler is not None:
+            self.profiler.schedules.append(report)
+            for timing, (task_index, infos) in zip(report.timings, self.completed):
+                self.profiler.add_task(timing, [(*size, info) for size, info in zip(self.sizes[task_index], infos)])
+
+
+def _run_task_specs(
+    task_specs, seed, threads_per_chain, result_cache, num_parallel_runs, cores, cores_per_task, profiler=None
+):
+    """Run fits given as (function, model file, guides, options, library index), yielding
+    (library index, guide id, samples) as they complete"""
+    task_run = _TaskRun(task_specs, seed, threads_per_chain, result_cache, profiler)
+    for hit in task_run.hits:
+        yield from task_run.load(hit)
+
+    task_results = iter_tasks(
+        task_run.tasks, task_run.workers(num_parallel_runs, cores, cores_per_task), cores_per_task
+    )
+    while True:
+        try:
+            task_index, result = next(task_results)
+        except StopIteration as stop:
+            task_run.finish(stop.value)
+            return
+        task_run.store(task_index, result)
+        yield from task_run.receive(task_index, result)
+
+
+async def _arun_task_specs(
+    task_specs, seed, threads_per_chain, result_cache, num_parallel_runs, cores, cores_per_task, profiler=None
+):
+    """Async counterpart of `_run_task_specs`. Compiling the models and reading and writing the
+    result cache run in the loop's default executor."""
+    loop = asyncio.get_running_loop()
+    task_run = await loop.run_in_executor(None, _TaskRun, task_specs, seed, threads_per_chain, result_cache, profiler)
+    for hit in task_run.hits:
+        for fit in await loop.run_in_executor(None, task_run.load, hit):
+            yield fit
+
+    task_results = aiter_tasks(
+        task_run.tasks,
+        task_run.workers(num_parallel_runs, cores, cores_per_task),
+        cores_per_task,
+        on_report=task_run.finish,
+    )
+    async with aclosing(task_results):
+        async for task_index, result in task_results:
+            await loop.run_in_executor(None, task_run.store, task_index, result)
+            for fit in task_run.receive(task_index, result):
+                yield fit
+
+
+async def run(mm_data: MMData | MMLines, model_file: str, **options):
+    """Fit every guide and return {guide id: (samples, counts)} in guide order, without blocking
+    the event loop (see `fit_libraries_async`). The options are those of `fit_guides`. Cancelling
+    the run cancels its outstanding fits."""
+    fits = {}
+    async with aclosing(fit_guides_async(mm_data, model_file, **options)) as guide_fits:
+        async for guide_id, samples, counts in guide_fits:
+            fits[guide_id] = (samples, counts)
+
+    # Fits complete in any order; guides have always been output in the string order of their ids
+    return dict(sorted(fits.items(), key=itemgetter(0)))
@@ -0,0 +1,162 @@
+"""
+Columnar Matrix Market reader.
+
+Guide library matrices are parsed in chunks straight into NumPy arrays instead of a list of
+per-entry tuples. Gzipped input is detected automatically, and "-" reads standard input. Parsed
+matrices can be saved as a memory-mappable `.npy` sidecar next to the input, which later reads
+open without any parsing.
+"""
+
+import gzip
+import os
+import sys
+from typing import NamedTuple
+
+import numpy as np
+
+GZIP_MAGIC = b"\x1f\x8b"
+SIDECAR_SUFFIX = ".npy"
+ENTRY_DTYPE = np.dtype([("guide", "<i4"), ("cell", "<i4"), ("count", "<i8")])
+CHUNK_BYTES = 1 << 24
+STDIN = "-"
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[list(b" \t\n\r\v\f")] = True
+
+
+class MMData(NamedTuple):
+    "Nonzero entries of a guide library matrix, one array per column"
+
+    guides: np.ndarray
+    cells: np.ndarray
+    counts: np.ndarray
+
+    def __len__(self):
+        return len(self.counts)
+
+    @classmethod
+    def from_lines(cls, mm_lines) -> "MMData":
+        """Columns from (guide, cell, count) tuples, as read by `cleanser.run.read_mm_file`"""
+        guides, cells, counts = zip(*mm_lines) if mm_lines else ((), (), ())
+        return cls(np.array(guides, dtype=np.int32), np.array(cells, dtype=np.int32), np.array(counts, dtype=np.int64))
+
+    def lines(self) -> list[tuple[str, str, int]]:
+        """The entries as (guide, cell, count) tuples, as read by `cleanser.run.read_mm_file`"""
+        return list(zip(self.guides.astype(str).tolist(), self.cells.astype(str).tolist(), self.counts.tolist()))
+
+
+def sidecar_path(path) -> str:
+    return os.fspath(path) + SIDECAR_SUFFIX
+
+
+def _open(path):
+    with open(path, "rb") as mtx_file:
+        magic = mtx_file.read(2)
+    return gzip.open(path, "rb") if magic == GZIP_MAGIC else open(path, "rb")
+
+
+def _open_stream(stream):
+    """A binary stream, decompressed if it is gzipped. The stream must support `peek` or `seek`."""
+    if hasattr(stream, "peek"):
+        magic = stream.peek(2)[:2]
+    else:
+        magic = stream.read(2)
+        stream.seek(-len(magic), os.SEEK_CUR)
+    return gzip.GzipFile(fileobj=stream, mode="rb") if magic == GZIP_MAGIC else stream
+
+
+def _parse(text: bytes) -> np.ndarray:
+    # Every line must have three fields, checked on the bytes since the values are parsed as one
+    # flat buffer: a field starts at a non-space byte after a space, or at the start
+    chars = np.frombuffer(text, dtype=np.uint8)
+    space = WHITESPACE[chars]
+    field_starts = np.flatnonzero(space[:-1] > space[1:]) + 1
+    fields = np.diff(
+        np.searchsorted(field_starts, np.flatnonzero(chars == ord("\n"))), prepend=0, append=len(field_starts)
+    )
+    fields[0] += not space[0]
+    if np.any(fields != 3):
+        raise ValueError("Matrix Market entries must have exactly three columns: guide, cell and count")
+
+    # Older NumPy stops at the first token that isn't an integer instead of raising
+    try:
+        values = np.fromstring(text, dtype=np.int64, sep=" ")
+    except ValueError:
+        values = None
+    if values is None or len(values) != 3 * len(fields):
+        raise ValueError("Matrix Market entries must be integers: guide, cell and count")
+    return values.reshape(-1, 3)
+
+
+def parse_mm(mtx_file, chunk_bytes: int = CHUNK_BYTES) -> MMData:
+    """Parse a binary Matrix Market stream. Raises ValueError if an entry is malformed or the
+    number of entries differs from the header's."""
+    line = mtx_file.readline()
+    while line.startswith(b"%"):
+        line = mtx_file.readline()
+
+    # The first non-comment line holds the matrix dimensions and number of entries
+    dimensions = line.split()
+    if len(dimensions) != 3 or not all(dimension.isdigit() for dimension in dimensions):
+        raise ValueError("Matrix Market size line must have the number of rows, columns and entries")
+    capacity = int(dimensions[2])
+    entries = np.empty(capacity, dtype=ENTRY_DTYPE)
+
+    size = 0
+    remainder = b""
+    while True:
+        block = mtx_file.read(chunk_bytes)
+        if not block:
+            text, remainder = remainder, b""
+        else:
+            text, _, remainder = (remainder + block).rpartition(b"\n")
+        if text:
+            values = _parse(text)
+            if size + len(values) > capacity:
+                raise ValueError(f"Matrix Market file has more than the {capacity} entries in its header")
+            entries["guide"][size : size + len(values)] = values[:, 0]
+            entries["cell"][size : size + len(values)] = values[:, 1]
+            entries["count"][size : size + len(values)] = values[:, 2]
+            size += len(values)
+        if not block:
+            break
+
+    if size != capacity:
+        raise ValueError(f"Matrix Market file has {size} of the {capacity} entries in its header")
+    return MMData(entries["guide"], entries["cell"], entries["count"])
+
+
+def read_mm_arrays(path, cache: bool = False) -> MMData:
+    """Read a (possibly gzipped) Matrix Market file of guide counts.
+
+    An up to date `.npy` sidecar is memory-mapped instead of parsing the file. With `cache`, the
+    sidecar is written after parsing so later runs can use it. `path` may also be "-" for standard
+    input or a binary stream, which are always parsed.
+    """
+    if path == STDIN or hasattr(path, "read"):
+        return parse_mm(_open_stream(sys.stdin.buffer if path == STDIN else path))
+
+    sidecar = sidecar_path(path)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        entries = np.load(sidecar, mmap_mode="r")
+        return MMData(entries["guide"], entries["cell"], entries["count"])
+
+    with _open(path) as mtx_file:
+        data = parse_mm(mtx_file)
+
+    if cache:
+        write_sidecar(data, sidecar)
+
+    return data
+
+
+def write_sidecar(data: MMData, sidecar: str):
+    entries = np.empty(len(data), dtype=ENTRY_DTYPE)
+    entries["guide"] = data.guides
+    entries["cell"] = data.cells
+    entries["count"] = data.counts
+
+    # Write to a temporary name first so readers never map a partial file
+    temp_file = f"{sidecar}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as sidecar_file:
+        np.save(sidecar_file, entries)
+    os.replace(temp_file, sidecar)
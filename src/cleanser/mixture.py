@@ -0,0 +1,321 @@
+"""
+NumPy implementation of the CROP-seq and direct capture guide mixture models.
+
+The log densities here match the Stan programs term for term, but are evaluated for many guides
+at once: observations of all guides are concatenated and `guide_index` says which guide each
+observation belongs to, while parameters are arrays with one entry per guide.
+"""
+
+import numpy as np
+from scipy.special import digamma, expit, gammaln
+
+from .constants import CS_MODEL_FILE, DC_MODEL_FILE
+
+# (name, lower, upper) of each model parameter, in the order they are constrained. A string
+# lower bound refers to a parameter earlier in the list (e.g. CROP-seq nbMean > lambda).
+PARAMETER_BOUNDS = {
+    CS_MODEL_FILE: (
+        ("lambda", 0.000001, 5),
+        ("r", 0.000001, 0.1),
+        ("nbMean", "lambda", None),
+        ("nbDisp", 0.000001, None),
+    ),
+    DC_MODEL_FILE: (
+        ("n_nbMean", 0.000001, None),
+        ("n_nbDisp", 0.1, None),
+        ("r", 0.000001, 0.1),
+        ("nbMean", 5, None),
+        ("nbDisp", 0.1, None),
+    ),
+}
+
+# Priors as ("lognormal", log median, log scale) or ("beta", alpha, beta)
+PRIORS = {
+    CS_MODEL_FILE: {
+        "r": ("beta", 1, 10),
+        "lambda": ("lognormal", np.log(1.1), np.log(1.1)),
+        "nbMean": ("lognormal", np.log(100), np.log(100)),
+        "nbDisp": ("beta", 1, 10),
+    },
+    DC_MODEL_FILE: {
+        "r": ("beta", 1, 10),
+        "nbDisp": ("lognormal", np.log(3), np.log(2)),
+        "n_nbMean": ("lognormal", np.log(1.075), np.log(1.1)),
+        "n_nbDisp": ("lognormal", np.log(1.1), np.log(1.1)),
+        "nbMean": ("lognormal", np.log(100), np.log(3)),
+    },
+}
+
+# Counts above this are treated as likely native when initializing the optimizer
+INIT_NATIVE_COUNT = 5
+
+
+def neg_binomial_2_lpmf(X, mu, phi):
+    return (
+        gammaln(X + phi)
+        - gammaln(phi)
+        - gammaln(X + 1)
+        + phi * (np.log(phi) - np.log(phi + mu))
+        + X * (np.log(mu) - np.log(phi + mu))
+    )
+
+
+def _neg_binomial_2(X, L, mean, disp, mean_name, disp_name):
+    """Log density, log probability of a zero count, and their gradients for a negative binomial
+    component whose mean is scaled by the library size."""
+    mu = mean * L
+    log_p = np.log(disp) - np.log(disp + mu)
+    lf = neg_binomial_2_lpmf(X, mu, disp)
+    log_p0 = disp * log_p
+
+    lf_grad = {
+        mean_name: L * (X / mu - (X + disp) / (disp + mu)),
+        disp_name: digamma(X + disp) - digamma(disp) + log_p + 1 - (X + disp) / (disp + mu),
+    }
+    log_p0_grad = {
+        mean_name: L * -disp / (disp + mu),
+        disp_name: log_p + mu / (disp + mu),
+    }
+    return lf, log_p0, lf_grad, log_p0_grad
+
+
+def _poisson(X, lamb):
+    lf = X * np.log(lamb) - lamb - gammaln(X + 1)
+    log_p0 = -lamb
+    return lf, log_p0, {"lambda": X / lamb - 1}, {"lambda": -np.ones_like(lamb)}
+
+
+def components(model_file: str, params: dict[str, np.ndarray], X, L):
+    """Ambient (0) and native (1) component log densities, log zero-count probabilities, and
+    their gradients with respect to the component parameters."""
+    if model_file == CS_MODEL_FILE:
+        ambient = _poisson(X, params["lambda"])
+        native = _neg_binomial_2(X, L, params["nbMean"], params["nbDisp"], "nbMean", "nbDisp")
+    elif model_file == DC_MODEL_FILE:
+        ambient = _neg_binomial_2(X, L, params["n_nbMean"], params["n_nbDisp"], "n_nbMean", "n_nbDisp")
+        native = _neg_binomial_2(X, L, params["nbMean"], params["nbDisp"], "nbMean", "nbDisp")
+    else:
+        raise ValueError(f"Unknown model {model_file}")
+
+    return ambient, native
+
+
+def log_likelihood(model_file: str, params: dict[str, np.ndarray], X, L, gradient: bool = False):
+    """Per-observation zero-truncated mixture log likelihood, posterior probability of the native
+    component (PZi) and, optionally, the per-observation gradient for each parameter."""
+    (lf0, log_p00, lf0_grad, log_p00_grad), (lf1, log_p01, lf1_grad, log_p01_grad) = components(
+        model_file, params, X, L
+    )
+    r = params["r"]
+    a0 = np.log1p(-r) + lf0
+    a1 = np.log(r) + lf1
+    log_mix = np.logaddexp(a0, a1)
+    pzi = np.exp(a1 - log_mix)
+
+    # Truncation at zero: log(1 - P(X = 0))
+    b0 = np.log1p(-r) + log_p00
+    b1 = np.log(r) + log_p01
+    log_trunc = np.log(-np.expm1(np.logaddexp(b0, b1)))
+
+    ll = log_mix - log_trunc
+    if not gradient:
+        return ll, pzi
+
+    h0 = np.exp(b0 - log_trunc)
+    h1 = np.exp(b1 - log_trunc)
+    grad = {"r": -(1 - pzi) / (1 - r) + pzi / r + h1 / r - h0 / (1 - r)}
+    for name in lf0_grad:
+        grad[name] = (1 - pzi) * lf0_grad[name] + h0 * log_p00_grad[name]
+    for name in lf1_grad:
+        grad[name] = pzi * lf1_grad[name] + h1 * log_p01_grad[name]
+
+    return ll, pzi, grad
+
+
+def log_prior(model_file: str, params: dict[str, np.ndarray]):
+    lp = 0.0
+    grad = {}
+    for name, (dist, a, b) in PRIORS[model_file].items():
+        x = params[name]
+        if dist == "lognormal":
+            z = (np.log(x) - a) / b
+            lp = lp - np.log(x) - z * z / 2
+            grad[name] = -1 / x - z / (b * x)
+        else:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                lp = lp + (a - 1) * np.log(x) + (b - 1) * np.log1p(-x)
+            grad[name] = (a - 1) / x - (b - 1) / (1 - x)
+
+    return lp, grad
+
+
+def constrain(model_file: str, u: np.ndarray) -> dict[str, np.ndarray]:
+    """Map unconstrained values (one row per parameter) onto the parameters' supports, using the
+    same transforms as Stan."""
+    params = {}
+    for row, (name, lower, upper) in zip(u, PARAMETER_BOUNDS[model_file]):
+        lower = params[lower] if isinstance(lower, str) else lower
+        if upper is None:
+            params[name] = lower + np.exp(row)
+        else:
+            params[name] = lower + (upper - lower) * expit(row)
+
+    return params
+
+
+def unconstrain(model_file: str, params: dict[str, np.ndarray]) -> np.ndarray:
+    rows = []
+    for name, lower, upper in PARAMETER_BOUNDS[model_file]:
+        lower = params[lower] if isinstance(lower, str) else lower
+        if upper is None:
+            rows.append(np.log(params[name] - lower))
+        else:
+            p = (params[name] - lower) / (upper - lower)
+            rows.append(np.log(p) - np.log1p(-p))
+
+    return np.array(rows)
+
+
+def _unconstrained_gradient(model_file: str, params, grad) -> np.ndarray:
+    grad = dict(grad)
+    bounds = PARAMETER_BOUNDS[model_file]
+    for name, lower, _ in reversed(bounds):
+        if isinstance(lower, str):
+            grad[lower] = grad[lower] + grad[name]
+
+    rows = []
+    for name, lower, upper in bounds:
+        lower = params[lower] if isinstance(lower, str) else lower
+        if upper is None:
+            rows.append(grad[name] * (params[name] - lower))
+        else:
+            rows.append(grad[name] * (params[name] - lower) * (upper - params[name]) / (upper - lower))
+
+    return np.array(rows)
+
+
+def initial_params(model_file: str, X, L, W, guide_index, num_guides: int) -> dict[str, np.ndarray]:
+    """Data-driven starting point: counts above INIT_NATIVE_COUNT seed the native component."""
+    native = X > INIT_NATIVE_COUNT
+    cells = np.bincount(guide_index, weights=W, minlength=num_guides)
+    native_cells = np.bincount(guide_index, weights=W * native, minlength=num_guides)
+    native_sum = np.bincount(guide_index, weights=W * native * X / L, minlength=num_guides)
+    native_mean = np.divide(native_sum, native_cells, out=np.full(num_guides, 100.0), where=native_cells > 0)
+
+    params = {"r": np.clip(native_cells / cells, 0.001, 0.09)}
+    if model_file == CS_MODEL_FILE:
+        params["lambda"] = np.full(num_guides, 1.1)
+        params["nbMean"] = np.maximum(native_mean, 2.2)
+        params["nbDisp"] = np.full(num_guides, 0.1)
+    else:
+        params["n_nbMean"] = np.full(num_guides, 1.075)
+        params["n_nbDisp"] = np.full(num_guides, 1.1)
+        params["nbMean"] = np.maximum(native_mean, 10.0)
+        params["nbDisp"] = np.full(num_guides, 3.0)
+
+    return params
+
+
+def _neg_log_posterior(model_file: str, u, X, L, W, guide_index, num_guides: int):
+    """Per-guide negative log posterior and its gradient on the unconstrained scale"""
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        params = constrain(model_file, u)
+        cell_params = {name: value[guide_index] for name, value in params.items()}
+        ll, _, ll_grad = log_likelihood(model_file, cell_params, X, L, gradient=True)
+        lp, grad = log_prior(model_file, params)
+    for name, value in ll_grad.items():
+        grad[name] = grad[name] + np.bincount(guide_index, weights=W * value, minlength=num_guides)
+    value = -(np.bincount(guide_index, weights=W * ll, minlength=num_guides) + lp)
+
+    return np.where(np.isfinite(value), value, np.inf), -_unconstrained_gradient(model_file, params, grad)
+
+
+def fit_map(
+    model_file: str, X, L, W, guide_index, num_guides: int, max_iterations: int = 100, tolerance: float = 1e-8
+) -> dict[str, np.ndarray]:
+    """Maximum a posteriori parameter estimates of every guide. Like Stan's optimizer this works
+    on the unconstrained scale without the Jacobian adjustment.
+
+    The guides are independent, so all of them take damped Newton (Levenberg-Marquardt) steps in
+    lockstep, each with its own damping. Hessians come from forward differences of the analytic
+    gradient; perturbing one parameter of every guide at once gives that column of every guide's
+    Hessian from a single gradient evaluation. Guides drop out of the iteration once converged.
+    """
+    X = np.asarray(X, dtype=float)
+    L = np.asarray(L, dtype=float)
+    W = np.asarray(W, dtype=float)
+    guide_index = np.asarray(guide_index)
+
+    u = unconstrain(model_file, initial_params(model_file, X, L, W, guide_index, num_guides))
+    num_params = u.shape[0]
+    identity = np.eye(num_params)
+    value, grad = _neg_log_posterior(model_file, u, X, L, W, guide_index, num_guides)
+    damping = np.full(num_guides, 1e-3)
+    active = np.arange(num_guides)
+
+    for _ in range(max_iterations):
+        # Only evaluate the observations of guides that are still converging
+        if len(active) < num_guides:
+            position = np.full(num_guides, -1)
+            position[active] = np.arange(len(active))
+            obs_position = position[guide_index]
+            keep = obs_position >= 0
+            obs = (X[keep], L[keep], W[keep], obs_position[keep], len(active))
+        else:
+            obs = (X, L, W, guide_index, num_guides)
+
+        active_u = u[:, active]
+        active_grad = grad[:, active]
+        hessian = np.empty((len(active), num_params, num_params))
+        for j in range(num_params):
+            h = 1e-5 * (1 + np.abs(active_u[j]))
+            shifted = active_u.copy()
+            shifted[j] += h
+            hessian[:, :, j] = ((_neg_log_posterior(model_file, shifted, *obs)[1] - active_grad) / h).T
+        hessian = (hessian + hessian.transpose(0, 2, 1)) / 2
+        # Damping relative to the curvature keeps the steps scale-free
+        scale = np.abs(np.diagonal(hessian, axis1=1, axis2=2)).max(axis=1) + 1
+        system = hessian + (damping[active] * scale)[:, None, None] * identity
+        step = np.linalg.solve(system, -active_grad.T[:, :, None])[:, :, 0].T
+
+        new_value, new_grad = _neg_log_posterior(model_file, active_u + step, *obs)
+        improved = new_value <= value[active]
+        decrease = value[active] - new_value
+        u[:, active] = np.where(improved, active_u + step, active_u)
+        grad[:, active] = np.where(improved, new_grad, active_grad)
+        value[active] = np.where(improved, new_value, value[active])
+        damping[active] = np.clip(np.where(improved, damping[active] / 3, damping[active] * 10), 1e-9, 1e9)
+
+        # Converged once steps stop making progress, or when no damping finds a better point
+        converged = (improved & (decrease <= tolerance * (1 + np.abs(new_value)))) | (damping[active] >= 1e9)
+        active = active[~converged]
+        if len(active) == 0:
+            break
+
+    return constrain(model_file, u)
+
+
+def component_log_densities(model_file: str, params: dict[str, np.ndarray], X, L):
+    """Ambient and native component log densities, without the gradients. Parameters broadcast
+    against the observations, so e.g. (draws, 1) parameters give a (draws, cells) result."""
+    if model_file == CS_MODEL_FILE:
+        lamb = params["lambda"]
+        ambient = X * np.log(lamb) - lamb - gammaln(X + 1)
+    elif model_file == DC_MODEL_FILE:
+        ambient = neg_binomial_2_lpmf(X, params["n_nbMean"] * L, params["n_nbDisp"])
+    else:
+        raise ValueError(f"Unknown model {model_file}")
+
+    return ambient, neg_binomial_2_lpmf(X, params["nbMean"] * L, params["nbDisp"])
+
+
+def posterior_probability(model_file: str, params: dict[str, np.ndarray], X, L, guide_index=None) -> np.ndarray:
+    """Probability that each observation comes from the native component (PZi)"""
+    if guide_index is not None:
+        params = {name: value[guide_index] for name, value in params.items()}
+    X = np.asarray(X, dtype=float)
+    L = np.asarray(L, dtype=float)
+    with np.errstate(divide="ignore", over="ignore"):
+        lf0, lf1 = component_log_densities(model_file, params, X, L)
+        r = params["r"]
+        return expit(np.log(r) + lf1 - np.log1p(-r) - lf0)
@@ -0,0 +1,69 @@
+"""
+User-level cache of compiled model executables.
+
+Executables are keyed by a hash of the model source, the CmdStan version and the compile flags,
+so they can be shared between runs (and baked into container images with `cleanser precompile`)
+without ever writing next to the installed package.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from importlib.resources import files
+from pathlib import Path
+
+from cmdstanpy import CmdStanModel, cmdstan_version
+
+PROFILE_BLOCK = re.compile(r'profile\("[^"]*"\)\s*\{')
+
+
+def cache_dir() -> Path:
+    if "CLEANSER_CACHE_DIR" in os.environ:
+        return Path(os.environ["CLEANSER_CACHE_DIR"])
+
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "cleanser"
+
+
+def compile_options(threaded: bool) -> dict:
+    return {"STAN_THREADS": True} if threaded else {}
+
+
+def model_key(source: str, cpp_options: dict) -> str:
+    version = cmdstan_version()
+    flags = ",".join(f"{option}={value}" for option, value in sorted(cpp_options.items()))
+    key = f"{source}\0{'.'.join(str(v) for v in version) if version else 'unknown'}\0{flags}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def model_source(model_file: str, profiled: bool = False) -> str:
+    """Stan source of one of the package's models. Unless `profiled`, its `profile` blocks become
+    plain blocks, so CmdStan neither times them nor writes a profile file to the working directory."""
+    source = files("cleanser").joinpath(model_file).read_text(encoding="utf-8")
+    return source if profiled else PROFILE_BLOCK.sub("{", source)
+
+
+def compiled_model(model_file: str, threaded: bool = False, profiled: bool = False) -> str:
+    """Path to the compiled executable of one of the package's models, compiling it into the
+    cache first if needed. `threaded` builds with STAN_THREADS for within-chain parallelism, and
+    `profiled` keeps the timing of the models' profile blocks."""
+    source = model_source(model_file, profiled)
+    cpp_options = compile_options(threaded)
+    stem = Path(model_file).stem
+    models_dir = cache_dir() / "models"
+    exe_file = models_dir / f"{stem}-{model_key(source, cpp_options)}{'.exe' if os.name == 'nt' else ''}"
+    if exe_file.exists():
+        return str(exe_file)
+
+    models_dir.mkdir(parents=True, exist_ok=True)
+    # Compile in a private directory and move the result into place, so concurrent runs never
+    # see a partially written executable.
+    with tempfile.TemporaryDirectory(dir=models_dir) as build_dir:
+        stan_file = Path(build_dir) / exe_file.with_suffix(".stan").name
+        stan_file.write_text(source, encoding="utf-8")
+        model = CmdStanModel(stan_file=stan_file, cpp_options=cpp_options)
+        os.replace(model.exe_file, exe_file)
+        shutil.copyfile(stan_file, exe_file.with_suffix(".stan"))
+
+    return str(exe_file)
@@ -0,0 +1,148 @@
+"""
+Single-file store of per-cell posterior probability draws.
+
+The draws of each guide are appended as a (cells × draws) float64 block as the guide's results
+are written, so the file is built in one pass without holding more than one block in memory.
+Closing the store appends an index of guides and cells and records its position in the header:
+
+    magic (8 bytes) | index offset (uint64) | guide blocks ... | guide table (.npy) | cell table (.npy)
+
+The reader memory-maps the file and finds a guide through a dictionary and a cell through a binary
+search of the guide's cells, so no draws are read until they are asked for.
+"""
+
+import struct
+
+import numpy as np
+
+MAGIC = b"CLNSPZI\x01"
+HEADER = struct.Struct("<8sQ")
+GUIDE_DTYPE = np.dtype(
+    [("guide", "<i8"), ("offset", "<u8"), ("cells_start", "<u8"), ("num_cells", "<u8"), ("num_draws", "<u8")]
+)
+CELL_DTYPE = np.dtype([("cell", "<i8"), ("row", "<u8")])
+
+
+class PosteriorStoreWriter:
+    """Writes guides' PZi draws to a store. `append` may be called several times in a row for the
+    same guide, e.g. once per block of cells."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, 0))
+        self._guides = []
+        self._cells = []
+        self._num_cells = 0
+        self._guide = None
+
+    def append(self, guide_id, cells, pzi: np.ndarray):
+        """Add the draws of `cells` of a guide. `pzi` has one row per draw and one column per cell."""
+        num_draws = pzi.shape[0]
+        if self._guide is None or self._guide[0] != int(guide_id):
+            self._finish_guide()
+            self._guide = [int(guide_id), self._file.tell(), num_draws, []]
+        elif self._guide[2] != num_draws:
+            raise ValueError(f"Guide {guide_id} has {num_draws} draws for some cells and {self._guide[2]} for others")
+
+        self._guide[3].append(np.asarray(cells, dtype=np.int64))
+        self._file.write(np.ascontiguousarray(pzi.T, dtype="<f8").tobytes())
+
+    def _finish_guide(self):
+        if self._guide is None:
+            return
+
+        guide_id, offset, num_draws, cells = self._guide
+        cells = np.concatenate(cells)
+        order = np.argsort(cells, kind="stable")
+        self._guides.append((guide_id, offset, self._num_cells, len(cells), num_draws))
+        self._num_cells += len(cells)
+        self._cells.append(np.rec.fromarrays([cells[order], order], dtype=CELL_DTYPE))
+        self._guide = None
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        self._finish_guide()
+        index_offset = self._file.tell()
+        np.lib.format.write_array(self._file, np.array(self._guides, dtype=GUIDE_DTYPE))
+        cells = np.concatenate(self._cells) if self._cells else np.empty(0, dtype=CELL_DTYPE)
+        np.lib.format.write_array(self._file, cells)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, index_offset))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PosteriorStore:
+    """Read access to a store written by `PosteriorStoreWriter`"""
+
+    def __init__(self, path):
+        with open(path, "rb") as store_file:
+            magic, index_offset = HEADER.unpack(store_file.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a posterior store")
+            if index_offset == 0:
+                raise ValueError(f"{path} is incomplete; the run writing it did not finish")
+            store_file.seek(index_offset)
+            self._guides = np.lib.format.read_array(store_file)
+            self._cells = np.lib.format.read_array(store_file)
+
+        self._data = np.memmap(path, dtype=np.uint8, mode="r")
+        self._guide_rows = {int(guide_id): i for i, guide_id in enumerate(self._guides["guide"])}
+
+    @property
+    def guide_ids(self) -> np.ndarray:
+        return self._guides["guide"]
+
+    def cells(self, guide_id) -> np.ndarray:
+        """The guide's cells, in the order their draws are stored"""
+        guide = self._guide(guide_id)
+        cells = self._guide_cells(guide)
+        stored = np.empty(len(cells), dtype=np.int64)
+        stored[cells["row"]] = cells["cell"]
+        return stored
+
+    def guide_draws(self, guide_id) -> np.ndarray:
+        """(cells × draws) array of the guide's draws, in the order of `cells(guide_id)`"""
+        guide = self._guide(guide_id)
+        num_cells, num_draws = int(guide["num_cells"]), int(guide["num_draws"])
+        return self._float_view(int(guide["offset"]), num_cells * num_draws).reshape(num_cells, num_draws)
+
+    def draws(self, guide_id, cell_id) -> np.ndarray:
+        """The PZi draws of one guide and cell, in sampling order"""
+        guide = self._guide(guide_id)
+        cells = self._guide_cells(guide)
+        i = np.searchsorted(cells["cell"], int(cell_id))
+        if i == len(cells) or cells["cell"][i] != int(cell_id):
+            raise KeyError(f"Guide {guide_id} has no draws for cell {cell_id}")
+
+        num_draws = int(guide["num_draws"])
+        offset = int(guide["offset"]) + int(cells["row"][i]) * num_draws * 8
+        return self._float_view(offset, num_draws)
+
+    def _float_view(self, offset: int, count: int) -> np.ndarray:
+        return self._data[offset : offset + 8 * count].view("<f8")
+
+    def _guide(self, guide_id):
+        try:
+            return self._guides[self._guide_rows[int(guide_id)]]
+        except KeyError:
+            raise KeyError(f"No draws stored for guide {guide_id}") from None
+
+    def _guide_cells(self, guide):
+        start = int(guide["cells_start"])
+        return self._cells[start : start + int(guide["num_cells"])]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Arrays returned by the store keep the mapping open for as long as they are used
+        del self._data
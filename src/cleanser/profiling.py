@@ -0,0 +1,260 @@
+"""
+Opt-in performance profile of a run.
+
+The main process records wall and CPU time of each stage of a run (reading the input,
+normalization, compiling models, waiting for fits, writing outputs); a stage that runs inside
+another is also subtracted from the outer stage's own ("self") time. Every guide gets how long its
+fit task waited in the pool's queue, ran in a worker and took to come back, with the worker's own
+breakdown (sampling, reading the draws and reducing them) and the time CmdStan spent in the
+models' `profile` blocks. Worker utilization and peak memory use come from the scheduler and
+the operating system.
+
+The profile is written as JSON, and as a Chrome trace (viewable in Perfetto or chrome://tracing)
+with one row for the main process and one for each worker.
+"""
+
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import NamedTuple
+
+from .scheduler import ScheduleReport, TaskTiming
+
+TRACE_SUFFIX = ".trace.json"
+
+
+class StageTiming(NamedTuple):
+    name: str
+    start: float  # Seconds since the epoch
+    wall: float
+    self_wall: float  # Excluding the stages nested inside this one
+    cpu: float  # CPU seconds of the main process
+
+
+class GuideTiming(NamedTuple):
+    "Where the time of one guide's fit went. Guides fit in one batch share its task."
+
+    guide_id: str
+    cells: int
+    rows: int  # Observations fit, fewer than cells when they were compressed
+    task: TaskTiming
+    task_guides: int
+    phases: dict[str, float]  # Seconds of each phase of the task in the worker, in order
+    stan_profile: dict[str, float]  # Seconds spent in each Stan profile block
+
+    @property
+    def queue_wait(self) -> float:
+        return self.task.started - self.task.submitted
+
+    @property
+    def run(self) -> float:
+        return self.task.finished - self.task.started
+
+    @property
+    def transfer(self) -> float:
+        return self.task.received - self.task.finished
+
+
+def stan_profile(output_dir: str) -> dict[str, float]:
+    """Total seconds in each `profile` block, over every CmdStan profile file in `output_dir`"""
+    totals = defaultdict(float)
+    for path in glob.glob(os.path.join(output_dir, "*-profile*.csv")):
+        with open(path, newline="", encoding="utf-8") as profile_file:
+            for row in csv.DictReader(profile_file):
+                totals[row["name"]] += float(row["total_time"])
+    return dict(totals)
+
+
+def peak_rss() -> dict[str, int] | None:
+    """Peak resident memory in bytes of this process and of its largest child, where the platform
+    reports it"""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+class Profiler:
+    def __init__(self):
+        self.start = time.time()
+        self.stages: list[StageTiming] = []
+        self.schedules: list[ScheduleReport] = []
+        self.guides: list[GuideTiming] = []
+        self._nested: list[float] = []  # Wall time of the stages nested in each open stage
+
+    @contextmanager
+    def stage(self, name: str):
+        start, cpu = time.time(), time.process_time()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            wall = time.time() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += wall
+            self.stages.append(StageTiming(name, start, wall, wall - nested, time.process_time() - cpu))
+
+    def timed_iter(self, name: str, iterable):
+        """Yield from `iterable`, timing each wait for the next item as stage `name`"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_task(self, timing: TaskTiming, guides):
+        """Record a completed fit task. `guides` are the (guide id, cells, rows, samples info)
+        of the guides it fit."""
+        for guide_id, cells, rows, info in guides:
+            self.guides.append(
+                GuideTiming(
+                    str(guide_id),
+                    cells,
+                    rows,
+                    timing,
+                    len(guides),
+                    info.get("timings", {}),
+                    info.get("stan_profile", {}),
+                )
+            )
+
+    def summary(self) -> dict:
+        stages = {}
+        for stage in self.stages:
+            totals = stages.setdefault(stage.name, {"calls": 0, "wall": 0.0, "self": 0.0, "cpu": 0.0})
+            totals["calls"] += 1
+            totals["wall"] += stage.wall
+            totals["self"] += stage.self_wall
+            totals["cpu"] += stage.cpu
+
+        stan_totals = defaultdict(float)
+        for guide in self.guides:
+            for name, seconds in guide.stan_profile.items():
+                stan_totals[name] += seconds
+
+        return {
+            "wall": time.time() - self.start,
+            "cpu": time.process_time(),
+            "peak_rss": peak_rss(),
+            "stages": stages,
+            "schedules": [
+                {
+                    "tasks": schedule.tasks,
+                    "workers": schedule.workers,
+                    "cores_per_task": schedule.cores_per_task,
+                    "predicted_makespan": schedule.predicted_makespan,
+                    "makespan": schedule.actual_makespan,
+                    "utilization": schedule.utilization,
+                    "worker_cpu": sum(timing.cpu for timing in schedule.timings),
+                }
+                for schedule in self.schedules
+            ],
+            "stan_profile": dict(stan_totals),
+            "guides": [
+                {
+                    "guide id": guide.guide_id,
+                    "cells": guide.cells,
+                    "rows": guide.rows,
+                    "task guides": guide.task_guides,
+                    "queue wait": guide.queue_wait,
+                    "run": guide.run,
+                    "transfer": guide.transfer,
+                    "cpu": guide.task.cpu,
+                    "worker": guide.task.pid,
+                    **guide.phases,
+                    "stan profile": guide.stan_profile,
+                }
+                for guide in self.guides
+            ],
+        }
+
+    def trace_events(self) -> list[dict]:
+        """Chrome trace events: the stages on the main process's row, and each fit task with its
+        phases on the row of the worker that ran it"""
+
+        def microseconds(seconds: float) -> float:
+            return round(seconds * 1e6, 1)
+
+        main = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": main, "tid": 0, "args": {"name": "cleanser"}}]
+        events.extend(
+            {
+                "name": stage.name,
+                "ph": "X",
+                "pid": main,
+                "tid": 0,
+                "ts": microseconds(stage.start - self.start),
+                "dur": microseconds(stage.wall),
+                "args": {"cpu": stage.cpu},
+            }
+            for stage in self.stages
+        )
+
+        tasks = defaultdict(list)
+        for guide in self.guides:
+            tasks[guide.task].append(guide)
+        for worker in sorted({task.pid for task in tasks}):
+            events.append({"name": "thread_name", "ph": "M", "pid": main, "tid": worker, "args": {"name": "worker"}})
+        for task, guides in tasks.items():
+            events.append(
+                {
+                    "name": ", ".join(guide.guide_id for guide in guides),
+                    "ph": "X",
+                    "pid": main,
+                    "tid": task.pid,
+                    "ts": microseconds(task.started - self.start),
+                    "dur": microseconds(task.finished - task.started),
+                    "args": {
+                        "cells": sum(guide.cells for guide in guides),
+                        "queue wait": task.started - task.submitted,
+                        "transfer": task.received - task.finished,
+                        "cpu": task.cpu,
+                    },
+                }
+            )
+            phase_start = task.started
+            for name, seconds in guides[0].phases.items():
+                events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "pid": main,
+                        "tid": task.pid,
+                        "ts": microseconds(phase_start - self.start),
+                        "dur": microseconds(seconds),
+                    }
+                )
+                phase_start += seconds
+        return events
+
+    def write(self, path: str):
+        """Write the profile to `path` and the Chrome trace next to it"""
+        with open(path, "w", encoding="utf-8") as profile_file:
+            json.dump(self.summary(), profile_file, indent=2)
+        with open(trace_path(path), "w", encoding="utf-8") as trace_file:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, trace_file)
+
+
+def trace_path(path: str) -> str:
+    return os.path.splitext(path)[0] + TRACE_SUFFIX
+
+
+def stage(profiler: Profiler | None, name: str):
+    """Time stage `name` when profiling"""
+    return profiler.stage(name) if profiler is not None else nullcontext()
@@ -0,0 +1,116 @@
+"""
+On-disk cache of guide fit results.
+
+Each fit task (a single guide, or a batch of small guides) is keyed by a hash of everything its
+result depends on: the guides' observations, the model source, the CmdStan version, the fit
+options and the seed. Rerunning an interrupted or extended library only fits the guides that are
+not in the cache, and cached guides give exactly the same output as when they were first fit.
+
+Entries are written as fits complete, so a crashed run loses at most the fits in progress. When
+the cache grows past its size limit, the least recently used entries are removed.
+"""
+
+import hashlib
+import os
+import pickle
+from importlib.resources import files
+from pathlib import Path
+
+import numpy as np
+from cmdstanpy import cmdstan_version
+
+from .model_cache import cache_dir
+
+ENTRY_SUFFIX = ".pkl"
+# Options that only change what a run reports, not the fits, so cached fits are reused across them
+UNKEYED_OPTIONS = ("profile",)
+
+
+def result_key(model_file: str, options, seed: int, guides) -> str:
+    """Hash of a fit task's inputs. `guides` are (guide id, X, L, W, index) tuples."""
+    key = hashlib.sha256()
+    key.update(files("cleanser").joinpath(model_file).read_bytes())
+    _update(key, (cmdstan_version(), options, seed))
+    for guide_id, *arrays in guides:
+        _update(key, (str(guide_id), *arrays))
+
+    return key.hexdigest()
+
+
+def _update(key, value):
+    """Add a canonical encoding of `value` to the hash `key`. Named tuples (like `FitOptions`) are
+    encoded field by field and arrays by their dtype, shape and bytes, since an array's repr
+    depends on the NumPy version and elides the middle of large arrays."""
+    if hasattr(value, "_fields"):
+        key.update(f"\0{type(value).__name__}{len(value)}".encode("utf-8"))
+        for name, field in zip(value._fields, value):
+            if name in UNKEYED_OPTIONS:
+                continue
+            key.update(f"\0{name}=".encode("utf-8"))
+            _update(key, field)
+    elif isinstance(value, (tuple, list)):
+        key.update(f"\0({len(value)}".encode("utf-8"))
+        for item in value:
+            _update(key, item)
+    elif isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        key.update(f"\0{array.dtype.str}{array.shape}".encode("utf-8"))
+        key.update(array.tobytes())
+    elif isinstance(value, np.generic):
+        _update(key, value.item())
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        key.update(f"\0{type(value).__name__}:{value!r}".encode("utf-8"))
+    else:
+        raise TypeError(f"Can't use a {type(value).__name__} in a result cache key")
+
+
+class ResultCache:
+    def __init__(self, directory: Path | None = None, max_bytes: int | None = None):
+        self.directory = Path(directory) if directory is not None else cache_dir() / "results"
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}{ENTRY_SUFFIX}"
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str):
+        """The cached result for `key`, or None"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as entry:
+                result = pickle.load(entry)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+        # The modification time records when an entry was last used, for eviction
+        os.utime(path)
+        return result
+
+    def put(self, key: str, result):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary name first so an interrupted write never leaves a partial entry
+        temp_file = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_file, "wb") as entry:
+            pickle.dump(result, entry, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, path)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in `max_bytes`"""
+        if self.max_bytes is None or not self.directory.exists():
+            return
+
+        entries = []
+        for path in self.directory.glob(f"*/*{ENTRY_SUFFIX}"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
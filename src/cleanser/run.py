@@ -1,21 +1,46 @@
 import argparse
-import asyncio
 import os.path
 import sys
+from contextlib import ExitStack
+from typing import NamedTuple
 
 import numpy as np
 
+from .batch import OPTIONAL_COLUMNS, REQUIRED_COLUMNS, read_manifest
 from .constants import (
+    BATCH_MODEL_FILES,
     CS_MODEL_FILE,
     DC_MODEL_FILE,
+    DEFAULT_BATCH_MAX_CELLS,
+    DEFAULT_BATCH_SIZE,
     DEFAULT_CHAINS,
+    DEFAULT_CORES,
+    DEFAULT_ENGINE,
+    DEFAULT_INFERENCE,
+    DEFAULT_MAX_DIVERGENCES,
+    DEFAULT_MAX_SAMPLE,
     DEFAULT_NORM_LPF,
-    DEFAULT_RUNS,
+    DEFAULT_PILOT_GUIDES,
+    DEFAULT_RESULT_CACHE_GB,
     DEFAULT_SAMPLE,
     DEFAULT_SEED,
+    DEFAULT_TARGET_ESS,
+    DEFAULT_TARGET_RHAT,
+    DEFAULT_THREADS_PER_CHAIN,
+    DEFAULT_WARM_WARMUP,
     DEFAULT_WARMUP,
+    ENGINES,
+    INFERENCE_METHODS,
 )
-from .guide_mixture import MMLines, run
+from .diagnostics import ConvergenceTargets
+from .guide_mixture import MMLines, fit_guides, fit_libraries
+from .matrix_market import read_mm_arrays
+from .model_cache import compiled_model
+from .posterior_store import PosteriorStoreWriter
+from .profiling import Profiler, stage
+from .result_cache import ResultCache
+from .shards import merge_stores, merge_tables, parse_shard
+from .tables import OUTPUT_FORMATS, STDOUT, open_table
 
 
 def read_mm_file(mtx_file) -> MMLines:
@@ -36,57 +61,207 @@ def read_mm_file(mtx_file) -> MMLines:
     return mm_lines
 
 
-def output_posteriors(stan_results, output_file):
-    output_all_posteriors = True
+POSTERIOR_COLUMNS = ["guide id", "cell id", "posterior"]
+CS_SAMPLE_COLUMNS = ["guide id", "r", "mu", "Disp", "lambda"]
+DC_SAMPLE_COLUMNS = ["guide id", "r", "mu", "Disp", "n_nbMean", "n_nbDisp"]
+DIAGNOSTICS_COLUMNS = [
+    "guide id",
+    "draws",
+    "rounds",
+    "max rhat",
+    "min bulk ess",
+    "min tail ess",
+    "divergences",
+    "treedepth hits",
+    "seconds",
+    "ess per second",
+]
+
+TRIAGE_COLUMNS = ["guide id", "reason", "cells"]
+
+
+def posterior_columns(quantiles=()) -> list[str]:
+    return POSTERIOR_COLUMNS + [f"q{quantile}" for quantile in quantiles]
+
+
+def write_posteriors(table, guide_id, samples, cell_info, quantiles=(), posterior_store=None, all_posteriors=False):
+    """Write each of a guide's cells' median posterior probability (and `quantiles`) to `table`,
+    a block of cells at a time. All draws are also added to `posterior_store` when given, and to
+    one file per cell in `posteriors/` with `all_posteriors`."""
+    start = 0
+    for medians, cell_quantiles, pzi in samples.pzi_summaries(cell_info.counts, cell_info.lib_sizes, quantiles):
+        chunk_cells = cell_info.cells[start : start + len(medians)]
+        if posterior_store is not None:
+            posterior_store.append(guide_id, chunk_cells, pzi)
+
+        if all_posteriors:
+            for i, cell_id in enumerate(chunk_cells):
+                with open(f"posteriors/{guide_id}_{cell_id}.txt", "w", encoding="ascii") as post_out:
+                    post_out.write(f"{', '.join(str(n) for n in sorted(pzi[:, i]))}")
+
+        table.write(guide_id, chunk_cells, medians, *(cell_quantiles.T if quantiles else ()))
+        start += len(medians)
+
+
+def output_all_posteriors() -> bool:
     if not os.path.isdir("posteriors"):
         print("Please create a 'posteriors' directory if you want all posterior values saved.")
-        output_all_posteriors = False
+        return False
+    return True
 
-    for guide_id, (samples, cell_info) in stan_results.items():
-        pzi = np.transpose(samples.stan_variable("PZi"))
-        for i, (cell_id, _) in enumerate(cell_info):
-            if output_all_posteriors:
-                with open(f"posteriors/{guide_id}_{cell_id}.txt", "w", encoding="ascii") as post_out:
-                    post_out.write(f"{', '.join(str(n) for n in sorted(pzi[i]))}")
-
-            output_file.write(f"{guide_id}\t{cell_id}\t{np.median(pzi[i])}\n")
-
-
-def output_cs_samples(stan_results, output_file):
-    output_file.write("guide id\tr\tmu\tDisp\tlambda\n")
-    for guide_id, (samples, _) in stan_results.items():
-        r = samples.stan_variable("r")
-        mu = samples.stan_variable("nbMean")
-        disp = samples.stan_variable("nbDisp")
-        lamb = samples.stan_variable("lambda")
-        for i, r_samp in enumerate(r):
-            output_file.write(f"{guide_id}\t{r_samp}\t{mu[i]}\t{disp[i]}\t{lamb[i]}\n")
-
-
-def output_dc_samples(stan_results, output_file):
-    output_file.write("guide id\tr\tmu\tDisp\tn_nbMean\tn_nbDisp\n")
-    for guide_id, (samples, _) in stan_results.items():
-        r = samples.stan_variable("r")
-        mu = samples.stan_variable("nbMean")
-        disp = samples.stan_variable("nbDisp")
-        n_mean = samples.stan_variable("n_nbMean")
-        n_disp = samples.stan_variable("n_nbDisp")
-        for i, r_samp in enumerate(r):
-            output_file.write(f"{guide_id}\t{r_samp}\t{mu[i]}\t{disp[i]}\t{n_mean[i]}\t{n_disp[i]}\n")
-
-
-def output_cs_stats(results):
-    for _, (samples, _) in results.items():
-        print(
-            f"r={np.median(samples.stan_variable('r'))}\tmu={np.median(samples.stan_variable('nbMean'))}\tlambda={np.median(samples.stan_variable('lambda'))}"
-        )
 
+def write_cs_samples(table, guide_id, samples):
+    table.write(
+        guide_id,
+        samples.stan_variable("r"),
+        samples.stan_variable("nbMean"),
+        samples.stan_variable("nbDisp"),
+        samples.stan_variable("lambda"),
+    )
 
-def output_dc_stats(results):
-    for _, (samples, _) in results.items():
-        print(
-            f"r={np.median(samples.stan_variable('r'))}\tmu={np.median(samples.stan_variable('nbMean'))}\tn_nbMean={np.median(samples.stan_variable('n_nbMean'))}\tn_nbDisp={np.median(samples.stan_variable('n_nbDisp'))}"
-        )
+
+def write_dc_samples(table, guide_id, samples):
+    table.write(
+        guide_id,
+        samples.stan_variable("r"),
+        samples.stan_variable("nbMean"),
+        samples.stan_variable("nbDisp"),
+        samples.stan_variable("n_nbMean"),
+        samples.stan_variable("n_nbDisp"),
+    )
+
+
+def write_diagnostics(table, guide_id, samples):
+    """Write the convergence diagnostics of a guide's NUTS fit, if it has any"""
+    diagnostics = samples.info.get("diagnostics")
+    if diagnostics is None:
+        return
+
+    table.write(
+        guide_id,
+        diagnostics.draws,
+        diagnostics.rounds,
+        diagnostics.max_rhat,
+        diagnostics.min_ess_bulk,
+        diagnostics.min_ess_tail,
+        diagnostics.divergences,
+        diagnostics.treedepth_hits,
+        diagnostics.seconds,
+        diagnostics.ess_per_second,
+    )
+
+
+def write_triage(table, guide_id, samples, cell_info):
+    """Record a guide that triage fit from a point estimate instead of sampling"""
+    if "triage" in samples.info:
+        table.write(guide_id, samples.info["triage"], len(cell_info.cells))
+
+
+def cs_stats(samples) -> str:
+    return f"r={np.median(samples.stan_variable('r'))}\tmu={np.median(samples.stan_variable('nbMean'))}\tlambda={np.median(samples.stan_variable('lambda'))}"
+
+
+def dc_stats(samples) -> str:
+    return f"r={np.median(samples.stan_variable('r'))}\tmu={np.median(samples.stan_variable('nbMean'))}\tn_nbMean={np.median(samples.stan_variable('n_nbMean'))}\tn_nbDisp={np.median(samples.stan_variable('n_nbDisp'))}"
+
+
+def model_outputs(args):
+    """The model file, sample columns, sample writer and summary statistics of the chosen model"""
+    if args.dc:
+        return DC_MODEL_FILE, DC_SAMPLE_COLUMNS, write_dc_samples, dc_stats
+    return CS_MODEL_FILE, CS_SAMPLE_COLUMNS, write_cs_samples, cs_stats
+
+
+def fit_options(args) -> dict:
+    """Keyword arguments of `fit_guides` from the options added by `add_fit_args`"""
+    return {
+        "chains": args.chains,
+        "normalization_lpf": args.normalization_lpf,
+        "num_parallel_runs": args.parallel_runs,
+        "num_samples": args.num_samples,
+        "num_warmup": args.num_warmup,
+        "seed": args.seed,
+        "compress": args.compress,
+        "compression_tolerance": args.compress_tolerance,
+        "threads_per_chain": args.threads_per_chain,
+        "batch_size": args.batch_size,
+        "batch_max_cells": args.batch_max_cells,
+        "engine": args.engine,
+        "inference": args.inference,
+        "pzi_from_draws": args.pzi_from_draws,
+        "quantiles": args.quantiles,
+        "result_cache": ResultCache(max_bytes=int(args.result_cache_size * 1e9)) if args.cache_results else None,
+        "warm_start": args.warm_start,
+        "pilot_guides": args.pilot_guides,
+        "warm_warmup": args.warm_warmup,
+        "targets": (
+            ConvergenceTargets(args.target_rhat, args.target_ess, args.max_divergences, args.max_samples)
+            if args.adaptive
+            else None
+        ),
+        "cores": args.cores,
+        "shard": args.shard,
+        "subsample": args.subsample,
+        "triage": args.triage,
+    }
+
+
+class Outputs(NamedTuple):
+    "The open output tables of one library; the optional ones are None when not written"
+
+    samples: object
+    posteriors: object
+    posterior_store: PosteriorStoreWriter | None
+    diagnostics: object
+    triage: object
+
+
+def open_outputs(
+    stack: ExitStack,
+    sample_columns,
+    posteriors_output,
+    samples_output,
+    output_format,
+    quantiles=(),
+    diagnostics_output=None,
+    triage_output=None,
+    posteriors_store=None,
+) -> Outputs:
+    """Open a library's outputs, closing them when `stack` closes"""
+    return Outputs(
+        stack.enter_context(open_table(samples_output, sample_columns, output_format)),
+        stack.enter_context(open_table(posteriors_output, posterior_columns(quantiles), output_format, header=False)),
+        stack.enter_context(PosteriorStoreWriter(posteriors_store)) if posteriors_store else None,
+        (
+            stack.enter_context(open_table(diagnostics_output, DIAGNOSTICS_COLUMNS, output_format))
+            if diagnostics_output
+            else None
+        ),
+        stack.enter_context(open_table(triage_output, TRIAGE_COLUMNS, "tsv")) if triage_output else None,
+    )
+
+
+def write_outputs(
+    outputs: Outputs, write_samples, guide_id, samples, cell_info, quantiles=(), all_posteriors=False, stats=None
+):
+    """Write one guide's fit to a library's outputs, printing its `stats` when given"""
+    write_samples(outputs.samples, guide_id, samples)
+    if outputs.diagnostics is not None:
+        write_diagnostics(outputs.diagnostics, guide_id, samples)
+    if outputs.triage is not None:
+        write_triage(outputs.triage, guide_id, samples, cell_info)
+    if stats is not None:
+        print(stats(samples))
+    write_posteriors(
+        outputs.posteriors, guide_id, samples, cell_info, quantiles, outputs.posterior_store, all_posteriors
+    )
+
+
+def shard_arg(value: str) -> tuple[int, int]:
+    try:
+        return parse_shard(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error)) from None
 
 
 def get_args():
@@ -98,24 +273,58 @@ def get_args():
     parser.add_argument(
         "-i",
         "--input",
-        help="Matrix Market file of guide library information",
-        type=argparse.FileType("r", encoding="utf-8"),
+        help="Matrix Market file of guide library information, or - for standard input. May be gzipped.",
         required=True,
     )
+    parser.add_argument(
+        "--cache-input",
+        action="store_true",
+        help="Save the parsed input next to it as a .npy file, which later runs read without parsing",
+    )
     parser.add_argument(
         "-o",
         "--posteriors-output",
-        help="output file name of per-guide/cell posterior probabilities",
-        type=argparse.FileType("w", encoding="utf-8"),
-        default=sys.stdout,
+        help="output file name of per-guide/cell posterior probabilities. Gzipped if the name ends in .gz",
+        default=STDOUT,
+    )
+    parser.add_argument(
+        "--posteriors-store",
+        help="File to save every posterior probability draw of every guide and cell to, in place of the 'posteriors' directory",
     )
     parser.add_argument(
         "--so",
         "--samples-output",
-        help="output file name of sample data",
-        type=argparse.FileType("w", encoding="utf-8"),
-        default=sys.stdout,
+        help="output file name of sample data. Gzipped if the name ends in .gz",
+        default=STDOUT,
+    )
+    parser.add_argument(
+        "--diagnostics-output",
+        help="output file name of each guide's NUTS convergence diagnostics (R-hat, ESS, divergences, tree depth hits "
+        "and wall time). Gzipped if the name ends in .gz",
+    )
+    parser.add_argument(
+        "--triage-output",
+        help="output file name of a tab-separated table of the guides --triage fit from point estimates, and why. "
+        "Gzipped if the name ends in .gz",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="tsv",
+        help="Write the posterior and sample outputs as tab-separated text or in a binary columnar format",
+    )
+    add_fit_args(parser)
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Write a JSON profile of the run's stages and guide fits to PATH, and a Chrome trace next to it",
     )
+
+    return parser.parse_args()
+
+
+def add_fit_args(parser):
+    """Add the options of how guides are fit, shared by a single run and a batch"""
     parser.add_argument(
         "-n", "--num-samples", type=int, default=DEFAULT_SAMPLE, help="The number of samples to take of the model"
     )
@@ -128,8 +337,51 @@ def get_args():
         "-p",
         "--parallel-runs",
         type=int,
-        default=DEFAULT_RUNS,
-        help="Number of guide models to run in parallel",
+        default=None,
+        help="Number of guide models to run in parallel. By default this is chosen so that the models' chains "
+        "and threads fit in --cores.",
+    )
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=DEFAULT_CORES,
+        help="Number of cores available for fitting guide models",
+    )
+    parser.add_argument(
+        "--threads-per-chain",
+        type=int,
+        default=DEFAULT_THREADS_PER_CHAIN,
+        help="Number of threads each Markov chain uses to evaluate the likelihood",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=(
+            "Maximum number of small guides to fit together in a single Stan run. Batched guides share one NUTS "
+            "step size and mass matrix, which can mix worse for guides unlike the rest of their batch. "
+            "The default, 1, fits every guide separately."
+        ),
+    )
+    parser.add_argument(
+        "--batch-max-cells",
+        type=int,
+        default=DEFAULT_BATCH_MAX_CELLS,
+        help="Guides with at most this many observations are eligible for batched fits",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=DEFAULT_ENGINE,
+        help="Inference engine. 'stan' samples each guide's posterior with CmdStan, 'em' finds MAP estimates "
+        "for all guides at once with a vectorized NumPy optimizer.",
+    )
+    parser.add_argument(
+        "--inference",
+        choices=INFERENCE_METHODS,
+        default=DEFAULT_INFERENCE,
+        help="CmdStan inference algorithm used by the stan engine. Everything except nuts is approximate, "
+        "but much cheaper.",
     )
     parser.add_argument(
         "--lpf",
@@ -139,6 +391,105 @@ def get_args():
         help="The upper limit for including the guide counts in guide count normalization. Set to 0 for no limit.",
         dest="normalization_lpf",
     )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Collapse cells with identical guide counts and library sizes into weighted observations",
+    )
+    parser.add_argument(
+        "--compress-tolerance",
+        type=float,
+        default=0.0,
+        help="Bin width for matching library sizes when compressing observations. Set to 0 for exact matches.",
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="Adapt NUTS on a few pilot guides, then start the other guides from their step size and metric with a short warmup",
+    )
+    parser.add_argument(
+        "--pilot-guides",
+        type=int,
+        default=DEFAULT_PILOT_GUIDES,
+        help="Number of guides fit with full warmup to adapt the warm-started fits",
+    )
+    parser.add_argument(
+        "--warm-warmup",
+        type=int,
+        default=DEFAULT_WARM_WARMUP,
+        help="The number of burn-in iterations per chain of warm-started and extended fits, which do not adapt",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Start each guide with --num-samples draws per chain and keep doubling them, up to --max-samples, "
+        "until its fit meets the R-hat, ESS and divergence targets",
+    )
+    parser.add_argument(
+        "--max-samples",
+        type=int,
+        default=DEFAULT_MAX_SAMPLE,
+        help="The most samples per chain an adaptive fit may take",
+    )
+    parser.add_argument(
+        "--target-rhat",
+        type=float,
+        default=DEFAULT_TARGET_RHAT,
+        help="Largest split R-hat an adaptive fit may end with",
+    )
+    parser.add_argument(
+        "--target-ess",
+        type=float,
+        default=DEFAULT_TARGET_ESS,
+        help="Smallest bulk and tail effective sample size an adaptive fit may end with",
+    )
+    parser.add_argument(
+        "--max-divergences",
+        type=int,
+        default=DEFAULT_MAX_DIVERGENCES,
+        help="Most divergent transitions an adaptive fit may end with",
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_arg,
+        help="Only fit the guides in shard K of N, given as K/N. Combine the shards' outputs with 'cleanser merge'.",
+    )
+    parser.add_argument(
+        "--cache-results",
+        action="store_true",
+        help="Keep each guide's fit in a cache, and reuse fits of guides whose data and settings have not changed",
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        type=float,
+        default=DEFAULT_RESULT_CACHE_GB,
+        help="Size limit of the result cache in GB. The least recently used fits are removed past it.",
+    )
+    parser.add_argument(
+        "--triage",
+        action="store_true",
+        help="Fit guides that leave nothing to sample (only 1-2 UMIs, a few cells or clearly separated counts) "
+        "from point estimates instead of with Stan",
+    )
+    parser.add_argument(
+        "--subsample",
+        type=int,
+        default=0,
+        metavar="ROWS",
+        help="Fit guides with more than ROWS observations on a count-stratified, reweighted subsample of about ROWS",
+    )
+    parser.add_argument(
+        "--pzi-from-draws",
+        action="store_true",
+        help="Only sample the model parameters and compute per-cell posterior probabilities from their draws afterwards",
+    )
+    parser.add_argument(
+        "--quantiles",
+        type=float,
+        nargs="+",
+        default=[],
+        help="Quantiles of each cell's posterior probability to output after the median",
+    )
     model_group = parser.add_mutually_exclusive_group(required=True)
     model_group.add_argument(
         "--dc",
@@ -153,39 +504,196 @@ def get_args():
         help="Use crop-seq mixture model",
     )
 
-    return parser.parse_args()
+
+def get_precompile_args(argv):
+    parser = argparse.ArgumentParser(
+        "cleanser precompile",
+        description="Compile the CLEANSER models into the model cache, e.g. while building a container image",
+    )
+    parser.add_argument("--no-threads", action="store_true", help="Skip the multithreaded builds of the models")
+
+    return parser.parse_args(argv)
+
+
+def precompile_cli(argv):
+    args = get_precompile_args(argv)
+
+    for model_file in (CS_MODEL_FILE, DC_MODEL_FILE):
+        print(compiled_model(model_file))
+        if not args.no_threads:
+            print(compiled_model(model_file, threaded=True))
+    for model_file in BATCH_MODEL_FILES.values():
+        print(compiled_model(model_file))
+
+
+def get_merge_args(argv):
+    parser = argparse.ArgumentParser(
+        "cleanser merge",
+        description="Combine the outputs of a library's shard runs (--shard) into the outputs of a single run",
+    )
+    parser.add_argument("--posteriors", nargs="+", default=[], help="Posterior outputs of the shard runs")
+    parser.add_argument(
+        "-o", "--posteriors-output", default=STDOUT, help="output file name of the merged posterior probabilities"
+    )
+    parser.add_argument("--samples", nargs="+", default=[], help="Sample outputs of the shard runs")
+    parser.add_argument("--so", "--samples-output", default=STDOUT, help="output file name of the merged sample data")
+    parser.add_argument("--diagnostics", nargs="+", default=[], help="Diagnostics outputs of the shard runs")
+    parser.add_argument("--diagnostics-output", default=STDOUT, help="output file name of the merged diagnostics")
+    parser.add_argument("--triage", nargs="+", default=[], help="Triage outputs of the shard runs")
+    parser.add_argument("--triage-output", default=STDOUT, help="output file name of the merged triage table")
+    parser.add_argument("--posteriors-stores", nargs="+", default=[], help="Posterior stores of the shard runs")
+    parser.add_argument("--posteriors-store", help="File name of the merged posterior store")
+
+    args = parser.parse_args(argv)
+    if args.posteriors_stores and args.posteriors_store is None:
+        parser.error("--posteriors-stores needs --posteriors-store")
+
+    return args
+
+
+def merge_cli(argv):
+    args = get_merge_args(argv)
+
+    if args.posteriors:
+        merge_tables(args.posteriors, args.posteriors_output, header=False)
+    if args.samples:
+        merge_tables(args.samples, args.so)
+    if args.diagnostics:
+        merge_tables(args.diagnostics, args.diagnostics_output)
+    if args.triage:
+        merge_tables(args.triage, args.triage_output)
+    if args.posteriors_stores:
+        merge_stores(args.posteriors_stores, args.posteriors_store)
+
+
+def get_batch_args(argv):
+    parser = argparse.ArgumentParser(
+        "cleanser batch",
+        description="Fit several libraries in one run. Each library is normalized on its own, but the guide fits "
+        "of all of them share one pool of workers.",
+    )
+    parser.add_argument(
+        "manifest",
+        help=f"Tab-separated file with a header and one row per library, with columns {', '.join(REQUIRED_COLUMNS)} "
+        f"and optionally {', '.join(OPTIONAL_COLUMNS)}. Posterior draws are only saved to posterior stores.",
+    )
+    parser.add_argument(
+        "--cache-input",
+        action="store_true",
+        help="Save each parsed input next to it as a .npy file, which later runs read without parsing",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="tsv",
+        help="Write the posterior and sample outputs as tab-separated text or in a binary columnar format",
+    )
+    add_fit_args(parser)
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Write a JSON profile of the batch's stages and guide fits to PATH, and a Chrome trace next to it",
+    )
+
+    args = parser.parse_args(argv)
+    try:
+        args.libraries = read_manifest(args.manifest)
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+
+    return args
+
+
+def batch_cli(argv):
+    args = get_batch_args(argv)
+    model_file, sample_columns, write_samples, _ = model_outputs(args)
+    profiler = Profiler() if args.profile else None
+
+    try:
+        with stage(profiler, "read input"):
+            libraries = [read_mm_arrays(library.input, cache=args.cache_input) for library in args.libraries]
+        fits = fit_libraries(
+            libraries,
+            model_file,
+            keep_pzi_draws=any(library.posteriors_store for library in args.libraries),
+            profiler=profiler,
+            **fit_options(args),
+        )
+        if profiler is not None:
+            fits = profiler.timed_iter("fit", fits)
+
+        # Fits of the libraries complete interleaved, so all of their outputs stay open
+        with ExitStack() as stack:
+            outputs = [
+                open_outputs(
+                    stack,
+                    sample_columns,
+                    library.posteriors,
+                    library.samples,
+                    args.output_format,
+                    args.quantiles,
+                    library.diagnostics,
+                    library.triage,
+                    library.posteriors_store,
+                )
+                for library in args.libraries
+            ]
+            for library, guide_id, samples, cell_info in fits:
+                with stage(profiler, "write"):
+                    write_outputs(outputs[library], write_samples, guide_id, samples, cell_info, args.quantiles)
+
+        print(f"Random seed: {args.seed}")
+        if profiler is not None:
+            profiler.write(args.profile)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+
+COMMANDS = {"precompile": precompile_cli, "merge": merge_cli, "batch": batch_cli}
 
 
 def run_cli():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     args = get_args()
 
-    if args.dc:
-        model_file = DC_MODEL_FILE
-    elif args.cs:
-        model_file = CS_MODEL_FILE
+    model_file, sample_columns, write_samples, stats = model_outputs(args)
+
+    # Full posterior draws only come back from the workers when they are written out
+    all_posteriors = args.posteriors_store is None and output_all_posteriors()
+    keep_pzi_draws = args.posteriors_store is not None or all_posteriors
+    profiler = Profiler() if args.profile else None
 
     try:
-        mm_lines = read_mm_file(args.input)
-        results = asyncio.run(
-            run(
-                mm_lines,
-                model_file,
-                chains=args.chains,
-                normalization_lpf=args.normalization_lpf,
-                num_parallel_runs=args.parallel_runs,
-                num_samples=args.num_samples,
-                num_warmup=args.num_warmup,
-                seed=args.seed,
+        with stage(profiler, "read input"):
+            mm_data = read_mm_arrays(args.input, cache=args.cache_input)
+        fits = fit_guides(mm_data, model_file, keep_pzi_draws=keep_pzi_draws, profiler=profiler, **fit_options(args))
+        if profiler is not None:
+            fits = profiler.timed_iter("fit", fits)
+
+        # Each guide's output is written as soon as its fit completes
+        with ExitStack() as stack:
+            outputs = open_outputs(
+                stack,
+                sample_columns,
+                args.posteriors_output,
+                args.so,
+                args.output_format,
+                args.quantiles,
+                args.diagnostics_output,
+                args.triage_output,
+                args.posteriors_store,
             )
-        )
-        if args.dc:
-            output_dc_samples(results, args.so)
-            output_dc_stats(results)
-        elif args.cs:
-            output_cs_samples(results, args.so)
-            output_cs_stats(results)
-        output_posteriors(results, args.posteriors_output)
+            for guide_id, samples, cell_info in fits:
+                with stage(profiler, "write"):
+                    write_outputs(
+                        outputs, write_samples, guide_id, samples, cell_info, args.quantiles, all_posteriors, stats
+                    )
 
         print(f"Random seed: {args.seed}")
+        if profiler is not None:
+            profiler.write(args.profile)
     except KeyboardInterrupt:
         sys.exit(1)
@@ -0,0 +1,199 @@
+"""
+Core-aware, longest-job-first scheduling of guide fits.
+
+Each fit runs several chains (and possibly several threads per chain) at once, so the number of
+workers is chosen to keep workers × cores per fit within the core budget. Fits are submitted
+largest first; the pool hands the next one to whichever worker frees up, which backfills the
+smaller fits around the large ones instead of leaving one large fit running alone at the end.
+"""
+
+import asyncio
+import concurrent.futures
+import heapq
+import os
+import time
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Callable, NamedTuple
+
+# Estimated cost, in observations, of starting CmdStan and reading its output for one fit
+TASK_OVERHEAD = 200
+
+
+class Task(NamedTuple):
+    fn: Callable
+    args: Any
+    cost: float
+
+
+class TaskTiming(NamedTuple):
+    "When a task was submitted, started, finished and got back to the parent, in seconds since the epoch"
+
+    submitted: float
+    started: float
+    finished: float
+    received: float
+    cpu: float  # CPU seconds of the worker, including the processes (CmdStan) it ran
+    pid: int  # The worker that ran the task
+
+
+@dataclass
+class ScheduleReport:
+    tasks: int
+    workers: int
+    cores_per_task: int
+    # Makespan predicted before dispatch by scheduling the tasks' estimated costs longest first,
+    # converted to seconds at the measured seconds per unit of cost. The actual makespan is longer
+    # when the cost model misjudges the fits' relative run times, or by the pool's overhead.
+    predicted_makespan: float
+    actual_makespan: float
+    timings: list[TaskTiming] = field(default_factory=list)  # In completion order
+
+    @property
+    def utilization(self) -> float:
+        """Fraction of the workers' time spent running tasks"""
+        busy = sum(timing.finished - timing.started for timing in self.timings)
+        return busy / (self.workers * self.actual_makespan) if self.actual_makespan else 0.0
+
+    def __str__(self):
+        return (
+            f"Scheduled {self.tasks} fits on {self.workers} workers ({self.cores_per_task} cores each): "
+            f"makespan {self.actual_makespan:.1f}s, predicted {self.predicted_makespan:.1f}s from the fits' "
+            "estimated costs"
+        )
+
+
+def task_cost(num_rows: int) -> float:
+    """Relative cost of a fit: each gradient evaluation is linear in the number of rows"""
+    return TASK_OVERHEAD + num_rows
+
+
+def worker_count(cores: int, cores_per_task: int, num_tasks: int) -> int:
+    return max(1, min(num_tasks, cores // max(1, cores_per_task)))
+
+
+def lpt_makespan(costs, workers: int) -> float:
+    """Makespan of running tasks longest first, each on the least loaded worker"""
+    loads = [0.0] * max(1, workers)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(loads, loads[0] + cost)
+
+    return max(loads)
+
+
+def _cpu_seconds() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _timed_call(fn, args):
+    start, cpu = time.time(), _cpu_seconds()
+    result = fn(args)
+    return start, time.time(), _cpu_seconds() - cpu, os.getpid(), result
+
+
+def iter_tasks(tasks: list[Task], workers: int, cores_per_task: int = 1, max_in_flight: int | None = None):
+    """Run `tasks` largest first on a pool of `workers` processes, yielding their results in
+    completion order. At most `max_in_flight` tasks (twice the workers by default) are submitted
+    or waiting to be consumed at once, so results never pile up in memory.
+
+    The generator returns a report comparing the actual makespan with the one predicted from the
+    tasks' costs."""
+    ordered = sorted(tasks, key=lambda task: task.cost, reverse=True)
+    predicted = lpt_makespan([task.cost for task in ordered], workers)
+    max_in_flight = max(workers, max_in_flight or 2 * workers)
+
+    timings = []
+    submitted = {}  # Submission time of each task in flight
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = iter(ordered)
+        for task in islice(pending, max_in_flight):
+            submitted[executor.submit(_timed_call, task.fn, task.args)] = time.time()
+        while submitted:
+            done, _ = concurrent.futures.wait(submitted, return_when=concurrent.futures.FIRST_COMPLETED)
+            received = time.time()
+            for future in done:
+                started, finished, cpu, pid, result = future.result()
+                timings.append(TaskTiming(submitted.pop(future), started, finished, received, cpu, pid))
+                yield result
+            for task in islice(pending, len(done)):
+                submitted[executor.submit(_timed_call, task.fn, task.args)] = time.time()
+    return _schedule_report(ordered, workers, cores_per_task, predicted, timings, time.perf_counter() - start)
+
+
+async def aiter_tasks(
+    tasks: list[Task],
+    workers: int,
+    cores_per_task: int = 1,
+    max_in_flight: int | None = None,
+    on_report: Callable[[ScheduleReport], None] | None = None,
+):
+    """Async counterpart of `iter_tasks`: tasks are submitted to the pool with
+    `loop.run_in_executor` and their results yielded as they complete, without blocking the event
+    loop. `on_report` is called with the schedule report once every task has completed.
+
+    Closing the generator, or cancelling the task iterating over it, cancels the tasks that have
+    not started yet. Tasks already running in a worker finish in the background, and their results
+    are dropped."""
+    loop = asyncio.get_running_loop()
+    ordered = sorted(tasks, key=lambda task: task.cost, reverse=True)
+    predicted = lpt_makespan([task.cost for task in ordered], workers)
+    max_in_flight = max(workers, max_in_flight or 2 * workers)
+
+    timings = []
+    submitted = {}  # Submission time of each task in flight
+    start = time.perf_counter()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    def submit(task):
+        submitted[loop.run_in_executor(executor, _timed_call, task.fn, task.args)] = time.time()
+
+    try:
+        pending = iter(ordered)
+        for task in islice(pending, max_in_flight):
+            submit(task)
+        while submitted:
+            done, _ = await asyncio.wait(submitted, return_when=asyncio.FIRST_COMPLETED)
+            received = time.time()
+            for future in done:
+                started, finished, cpu, pid, result = future.result()
+                timings.append(TaskTiming(submitted.pop(future), started, finished, received, cpu, pid))
+                yield result
+            for task in islice(pending, len(done)):
+                submit(task)
+    finally:
+        for future in submitted:
+            future.cancel()
+        # Joining the workers would block the event loop; the pool's own thread does it
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if on_report is not None:
+        on_report(_schedule_report(ordered, workers, cores_per_task, predicted, timings, time.perf_counter() - start))
+
+
+def _schedule_report(
+    ordered: list[Task], workers: int, cores_per_task: int, predicted: float, timings, actual: float
+) -> ScheduleReport:
+    """Report of running `ordered` tasks, whose costs were predicted to take `predicted` units of cost"""
+    total_cost = sum(task.cost for task in ordered)
+    busy = sum(timing.finished - timing.started for timing in timings)
+    return ScheduleReport(
+        tasks=len(ordered),
+        workers=workers,
+        cores_per_task=cores_per_task,
+        predicted_makespan=predicted * busy / total_cost if total_cost else 0.0,
+        actual_makespan=actual,
+        timings=timings,
+    )
+
+
+def run_tasks(tasks: list[Task], workers: int, cores_per_task: int = 1) -> tuple[list, ScheduleReport]:
+    """Run all of `tasks`, returning their results in completion order and the schedule report"""
+    results = []
+    task_results = iter_tasks(tasks, workers, cores_per_task)
+    while True:
+        try:
+            results.append(next(task_results))
+        except StopIteration as stop:
+            return results, stop.value
@@ -0,0 +1,148 @@
+"""
+Splitting a library's guides across several runs, and merging the runs' outputs.
+
+A guide belongs to shard K of N (K = 1..N) by a hash of its id, so every run assigns it the same
+way without talking to the others. Each shard run still reads the whole library, so library size
+normalization, and with it every guide's data, is the same as in a single run. Merging orders
+guides by id, keeping each guide's rows in the order they were written.
+"""
+
+import gzip
+import heapq
+import os
+import tempfile
+import zlib
+from contextlib import ExitStack
+from operator import itemgetter
+
+import numpy as np
+
+from .posterior_store import PosteriorStore, PosteriorStoreWriter
+from .tables import _columnar_names, is_columnar, open_binary, open_table
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """(K, N) from a "K/N" shard specification"""
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard {shard} is not of the form K/N") from None
+    if not 1 <= index <= count:
+        raise ValueError(f"Shard {shard} must have 1 <= K <= N")
+    return index, count
+
+
+def shard_of(guide_id, num_shards: int) -> int:
+    """The shard (1..num_shards) a guide belongs to. Unlike `hash`, this is the same in every process."""
+    return zlib.crc32(str(guide_id).encode("utf-8")) % num_shards + 1
+
+
+def merge_tables(input_paths, output_path: str, header: bool = True):
+    """Merge tables whose first column is the guide id into one table in guide order. Inputs may
+    be text (gzipped or not) or columnar; the output has the format of the first input.
+
+    A shard writes each guide's rows together, but its guides in the order their fits completed.
+    Each input is read once to find where each guide's rows are, and the inputs' guides are then
+    merged in order, copying one guide's rows at a time, so the tables never have to fit in memory.
+    """
+    with ExitStack() as stack:
+        if is_columnar(input_paths[0]):
+            inputs = [_ColumnarRuns(stack.enter_context(open(path, "rb")), path) for path in input_paths]
+            output = stack.enter_context(open_table(output_path, inputs[0].columns, "columnar"))
+        else:
+            inputs = [_TextRuns(stack, path, header) for path in input_paths]
+            output = stack.enter_context(open_table(output_path, inputs[0].columns or [], "tsv", header=header))
+
+        # Ties keep the order of the inputs, and each input's runs of a guide keep their own order
+        for _, table, run in heapq.merge(*(table.sorted_runs() for table in inputs), key=itemgetter(0)):
+            table.copy(run, output)
+
+
+class _TextRuns:
+    """The runs of consecutive rows of one guide in a text table, as (guide id, start, end) byte
+    ranges. Gzipped rows are copied to a temporary file so they can be read back in any order."""
+
+    def __init__(self, stack: ExitStack, path: str, header: bool):
+        table_file = stack.enter_context(open_binary(path))
+        self.columns = table_file.readline().decode("utf-8").rstrip("\n").split("\t") if header else None
+
+        self.rows_file = table_file
+        position = table_file.tell()
+        if isinstance(table_file, gzip.GzipFile):
+            self.rows_file = stack.enter_context(tempfile.TemporaryFile())
+            position = 0
+
+        self.runs = []
+        for line in table_file:
+            if self.rows_file is not table_file:
+                self.rows_file.write(line)
+            guide_id = line.partition(b"\t")[0].decode("utf-8")
+            if self.runs and self.runs[-1][0] == guide_id:
+                self.runs[-1][2] += len(line)
+            else:
+                self.runs.append([guide_id, position, position + len(line)])
+            position += len(line)
+
+    def sorted_runs(self):
+        for run in sorted(self.runs, key=itemgetter(0)):
+            yield run[0], self, run
+
+    def copy(self, run, output):
+        _, start, end = run
+        self.rows_file.seek(start)
+        rows = self.rows_file.read(end - start).decode("utf-8")
+        output.output_file.write(rows if rows.endswith("\n") else rows + "\n")
+
+
+class _ColumnarRuns:
+    """The runs of consecutive rows of one guide in a columnar table, as (guide id, block offset,
+    start row, end row). Only the guide ids are read to find them."""
+
+    def __init__(self, table_file, path: str):
+        self.table_file = table_file
+        self.columns = _columnar_names(table_file, path)
+        self.block_offset = None
+        self.block = None
+
+        self.runs = []
+        while table_file.peek(1):
+            offset = table_file.tell()
+            guide_ids = np.lib.format.read_array(table_file, allow_pickle=False)
+            for _ in self.columns[1:]:
+                _skip_array(table_file)
+            if len(guide_ids) == 0:
+                continue
+            starts = np.flatnonzero(np.r_[True, guide_ids[1:] != guide_ids[:-1]])
+            ends = np.r_[starts[1:], len(guide_ids)]
+            self.runs.extend(
+                zip(guide_ids[starts].astype(str).tolist(), [offset] * len(starts), starts.tolist(), ends.tolist())
+            )
+
+    def sorted_runs(self):
+        for run in sorted(self.runs, key=itemgetter(0)):
+            yield run[0], self, run
+
+    def copy(self, run, output):
+        _, offset, start, end = run
+        if offset != self.block_offset:
+            self.table_file.seek(offset)
+            self.block = [np.lib.format.read_array(self.table_file, allow_pickle=False) for _ in self.columns]
+            self.block_offset = offset
+        output.write(*(column[start:end] for column in self.block))
+
+
+def _skip_array(array_file):
+    """Move past a .npy array without reading its data"""
+    major, _ = np.lib.format.read_magic(array_file)
+    read_header = np.lib.format.read_array_header_1_0 if major == 1 else np.lib.format.read_array_header_2_0
+    shape, _, dtype = read_header(array_file)
+    array_file.seek(int(np.prod(shape)) * dtype.itemsize, os.SEEK_CUR)
+
+
+def merge_stores(input_paths, output_path):
+    """Merge posterior stores into one store, in guide order"""
+    stores = [PosteriorStore(path) for path in input_paths]
+    guides = sorted(((str(guide_id), store) for store in stores for guide_id in store.guide_ids), key=lambda g: g[0])
+    with PosteriorStoreWriter(output_path) as writer:
+        for guide_id, store in guides:
+            writer.append(guide_id, store.cells(guide_id), store.guide_draws(guide_id).T)
@@ -0,0 +1,162 @@
+"""
+Writers and readers for the sample and posterior tables.
+
+Tables are written a block of rows at a time (e.g. all of a guide's draws or cells), either as
+tab-separated text, gzipped when the file name ends in `.gz`, or in a binary columnar format.
+A columnar file is a magic string and the column names, followed by one `.npy` array per column
+for every block:
+
+    magic (8 bytes) | column names (.npy) | block 1: column 1 (.npy) ... column k (.npy) | block 2 ...
+
+so blocks can be appended as results arrive and read back without any parsing. Both formats can
+be read back a block of rows at a time with `iter_table`, so large tables never have to fit in
+memory.
+"""
+
+import gzip
+import sys
+
+import numpy as np
+
+CHUNK_BYTES = 1 << 24
+COLUMNAR_MAGIC = b"CLNSTBL\x01"
+GZIP_MAGIC = b"\x1f\x8b"
+OUTPUT_FORMATS = ("tsv", "columnar")
+STDOUT = "-"
+
+
+class TsvTable:
+    def __init__(self, output_file, columns: list[str], header: bool = True):
+        self.output_file = output_file
+        self.columns = columns
+        if header:
+            output_file.write("\t".join(columns) + "\n")
+
+    def write(self, *columns):
+        """Write a block of rows. Scalar columns are repeated on every row."""
+        length = max(np.size(column) for column in columns)
+        values = [np.asarray(column).tolist() if np.ndim(column) else [column] * length for column in columns]
+        line = "\t".join(["%s"] * len(values)) + "\n"
+        self.output_file.write("".join(map(line.__mod__, zip(*values))))
+
+    def close(self):
+        if self.output_file is not sys.stdout:
+            self.output_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ColumnarTable:
+    def __init__(self, output_file, columns: list[str]):
+        self.output_file = output_file
+        self.columns = columns
+        output_file.write(COLUMNAR_MAGIC)
+        np.lib.format.write_array(output_file, np.array(columns))
+
+    def write(self, *columns):
+        """Write a block of rows. Scalar columns are repeated on every row."""
+        length = max(np.size(column) for column in columns)
+        for column in columns:
+            column = np.asarray(column)
+            if column.dtype.kind == "U":
+                column = column.astype(np.int64)
+            np.lib.format.write_array(self.output_file, np.broadcast_to(column, length), allow_pickle=False)
+
+    def close(self):
+        if self.output_file is not sys.stdout.buffer:
+            self.output_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_table(path: str, columns: list[str], output_format: str = "tsv", header: bool = True):
+    """Open a table for writing. `path` is a file name or "-" for standard output. Text tables are
+    gzipped when `path` ends in ".gz"; `header` controls whether their first line names the
+    columns."""
+    if output_format == "columnar":
+        return ColumnarTable(sys.stdout.buffer if path == STDOUT else open(path, "wb"), columns)
+    if output_format != "tsv":
+        raise ValueError(f"Unknown output format {output_format}")
+
+    if path == STDOUT:
+        output_file = sys.stdout
+    elif path.endswith(".gz"):
+        output_file = gzip.open(path, "wt", encoding="utf-8")
+    else:
+        output_file = open(path, "w", encoding="utf-8")
+    return TsvTable(output_file, columns, header)
+
+
+def is_columnar(path) -> bool:
+    with open(path, "rb") as table_file:
+        return table_file.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+
+
+def open_binary(path):
+    """Open a (possibly gzipped) file for reading bytes"""
+    with open(path, "rb") as table_file:
+        magic = table_file.read(len(GZIP_MAGIC))
+    return gzip.open(path, "rb") if magic == GZIP_MAGIC else open(path, "rb")
+
+
+def _columnar_names(table_file, path) -> list[str]:
+    if table_file.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError(f"{path} is not a columnar table")
+    return [str(name) for name in np.lib.format.read_array(table_file)]
+
+
+def iter_columnar(path):
+    """Read a columnar table a block at a time, yielding one array per column of each block"""
+    with open(path, "rb") as table_file:
+        names = _columnar_names(table_file, path)
+        while table_file.peek(1):
+            yield {name: np.lib.format.read_array(table_file, allow_pickle=False) for name in names}
+
+
+def read_columnar(path) -> dict[str, np.ndarray]:
+    """Read every block of a columnar table, returning one array per column"""
+    with open(path, "rb") as table_file:
+        names = _columnar_names(table_file, path)
+
+        blocks = [[] for _ in names]
+        while table_file.peek(1):
+            for block in blocks:
+                block.append(np.lib.format.read_array(table_file, allow_pickle=False))
+
+    return {name: np.concatenate(block) if block else np.empty(0) for name, block in zip(names, blocks)}
+
+
+def iter_text(path, header: bool = True, chunk_bytes: int = CHUNK_BYTES):
+    """Read a numeric text table about `chunk_bytes` at a time, yielding (column names, rows) where
+    rows is a 2-D float array. Column names are None without a `header`."""
+    with open_binary(path) as table_file:
+        names = table_file.readline().decode("utf-8").rstrip("\n").split("\t") if header else None
+
+        remainder = b""
+        while True:
+            block = table_file.read(chunk_bytes)
+            text, _, remainder = (remainder + block).rpartition(b"\n") if block else (remainder, b"", b"")
+            if text.strip():
+                num_columns = len(text.lstrip().split(b"\n", 1)[0].split())
+                yield names, np.fromstring(text, dtype=np.float64, sep=" ").reshape(-1, num_columns)
+            if not block:
+                return
+
+
+def iter_table(path, names: list[str], header: bool = True, chunk_bytes: int = CHUNK_BYTES):
+    """Read a table written by `open_table` a block of rows at a time, yielding {column name: array}
+    for each block. Text tables without a `header` get `names` for their leading columns."""
+    if is_columnar(path):
+        yield from iter_columnar(path)
+        return
+
+    for block_names, rows in iter_text(path, header, chunk_bytes):
+        yield dict(zip(block_names or names, rows.T))
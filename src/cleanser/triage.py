@@ -0,0 +1,78 @@
+"""
+Pre-fit triage of degenerate guides.
+
+Many guides of a library leave nothing for MCMC to resolve: every count is 1 or 2, the guide is
+only seen in a handful of cells, or its ambient and native counts are so far apart that no cell's
+assignment is in doubt. Cheap per-guide statistics, computed for all guides at once, pick out
+these candidates. They are fit by the NumPy MAP engine, and each cell's posterior is taken at the
+point estimate. A guide with well separated modes is only triaged if that point estimate leaves
+every cell's posterior within `TRIAGE_MARGIN` of 0 or 1; otherwise it is still sampled.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+# Guides whose counts never exceed this are triaged
+TRIAGE_MAX_COUNT = 2
+# Guides seen in fewer cells than this are triaged
+TRIAGE_MIN_CELLS = 10
+# Guides with a ratio at least this large between consecutive distinct counts may be separated
+TRIAGE_GAP_RATIO = 4.0
+# How close to 0 or 1 every posterior of a separated guide must be
+TRIAGE_MARGIN = 0.01
+
+LOW_COUNTS = "low counts"
+FEW_CELLS = "few cells"
+SEPARATED = "separated"
+
+
+class GuideStats(NamedTuple):
+    "Per-guide statistics of guides' observations, one entry per guide"
+
+    cells: np.ndarray  # Total weight, i.e. the number of cells
+    max_count: np.ndarray
+    gap: np.ndarray  # Largest ratio between consecutive distinct counts
+
+
+def guide_stats(guides) -> GuideStats:
+    """Statistics of (guide id, X, L, W, index) guides, from one pass over all their observations"""
+    sizes = np.array([len(X) for _, X, _, _, _ in guides])
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    guide_index = np.repeat(np.arange(len(guides)), sizes)
+    X = np.concatenate([np.asarray(X, dtype=float) for _, X, _, _, _ in guides])
+    W = np.concatenate([np.asarray(W, dtype=float) for _, _, _, W, _ in guides])
+
+    cells = np.bincount(guide_index, weights=W, minlength=len(guides))
+    max_count = np.maximum.reduceat(X, starts)
+
+    # Ratios of each guide's consecutive sorted counts; the first count of a guide has none
+    sorted_X = X[np.lexsort((X, guide_index))]
+    ratios = np.ones(len(X))
+    ratios[1:] = sorted_X[1:] / np.maximum(sorted_X[:-1], 1)
+    ratios[starts] = 1
+    gap = np.maximum.reduceat(ratios, starts)
+
+    return GuideStats(cells, max_count, gap)
+
+
+def triage_candidates(guides) -> dict[str, str]:
+    """{guide id: reason} of the guides that may not need sampling"""
+    if not guides:
+        return {}
+
+    stats = guide_stats(guides)
+    candidates = {}
+    for (guide_id, _, _, _, _), cells, max_count, gap in zip(guides, stats.cells, stats.max_count, stats.gap):
+        if max_count <= TRIAGE_MAX_COUNT:
+            candidates[guide_id] = LOW_COUNTS
+        elif cells < TRIAGE_MIN_CELLS:
+            candidates[guide_id] = FEW_CELLS
+        elif gap >= TRIAGE_GAP_RATIO:
+            candidates[guide_id] = SEPARATED
+    return candidates
+
+
+def is_decisive(pzi: np.ndarray, margin: float = TRIAGE_MARGIN) -> bool:
+    """Whether every posterior is within `margin` of 0 or 1"""
+    return bool(np.all((pzi <= margin) | (pzi >= 1 - margin)))
@@ -0,0 +1,299 @@
+"""
+End-to-end benchmark of cleanser on a simulated library.
+
+A library is simulated from the chosen model and written as a Matrix Market file, then each stage
+of a cleanser run and a cleanser_qc run on its output is timed on its own: reading the input,
+library size normalization and grouping by guide, fitting, writing the outputs and aggregating
+them for QC. The posteriors are scored against the simulation's true guide assignments.
+
+By default fits use a stub in place of CmdStan (see `cleanser_bench.stub`), so the benchmark
+measures cleanser's own overhead and runs anywhere; `--sampler cmdstan` runs the real models.
+"""
+
+import argparse
+import json
+import os.path
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from importlib.metadata import PackageNotFoundError, version
+
+import numpy as np
+
+from cleanser.constants import (
+    CS_MODEL_FILE,
+    DC_MODEL_FILE,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_CHAINS,
+    DEFAULT_CORES,
+    DEFAULT_INFERENCE,
+    DEFAULT_NORM_LPF,
+    DEFAULT_SAMPLE,
+    DEFAULT_SEED,
+    DEFAULT_WARMUP,
+    ENGINES,
+    INFERENCE_METHODS,
+)
+from cleanser.guide_mixture import fit_guides, mm_counts, normalize, per_guide_counts
+from cleanser.matrix_market import read_mm_arrays
+from cleanser.run import (
+    CS_SAMPLE_COLUMNS,
+    DC_SAMPLE_COLUMNS,
+    posterior_columns,
+    read_mm_file,
+    write_cs_samples,
+    write_dc_samples,
+    write_posteriors,
+)
+from cleanser.tables import OUTPUT_FORMATS, iter_table, open_table
+from cleanser_qc.aggregate import (
+    PREDICTION_COLUMNS,
+    pair_keys,
+    posterior_umi_summary,
+    prediction_counts,
+    sample_moments,
+)
+
+from . import stub
+from .simulate import DEFAULT_AMBIENT_RATE, DEFAULT_CELLS, DEFAULT_GUIDES, DEFAULT_MOI, simulate_library, write_mm
+
+SAMPLERS = ("stub", "cmdstan")
+# Posterior at or above which a guide is called as assigned to a cell
+ASSIGNMENT_THRESHOLD = 0.5
+
+
+class StageTimer:
+    "Wall clock seconds of each stage of a run, in the order the stages ran"
+
+    def __init__(self):
+        self.seconds: dict[str, float] = {}
+
+    @contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+
+
+def read_posteriors(path) -> tuple[np.ndarray, np.ndarray]:
+    """Guide/cell pair keys (see `pair_keys`) and posteriors of a posterior output, in key order"""
+    keys, posteriors = [], []
+    for block in iter_table(path, PREDICTION_COLUMNS, header=False):
+        keys.append(pair_keys(block["guide id"].astype(np.int64), block["cell id"].astype(np.int64)))
+        posteriors.append(block["posterior"].astype(float))
+    keys, posteriors = np.concatenate(keys), np.concatenate(posteriors)
+    order = np.argsort(keys)
+    return keys[order], posteriors[order]
+
+
+def accuracy(posteriors: np.ndarray, library, threshold: float = ASSIGNMENT_THRESHOLD) -> dict[str, float]:
+    """Precision, recall and F1 against the truth of the assignments of posteriors given for every
+    entry of the library, in order"""
+    assigned = posteriors >= threshold
+    called = int(assigned.sum())
+    true_positives = int((assigned & library.assigned).sum())
+    actual = int(library.assigned.sum())
+    precision = true_positives / called if called else float("nan")
+    recall = true_positives / actual if actual else float("nan")
+    f1 = 2 * true_positives / (called + actual) if called + actual else float("nan")
+    return {"precision": precision, "recall": recall, "f1": f1}
+
+
+def run_benchmark(args, output_dir: str) -> dict:
+    uninstall = stub.install() if args.sampler == "stub" else None
+    try:
+        return _run_benchmark(args, output_dir)
+    finally:
+        if uninstall is not None:
+            uninstall()
+
+
+def _run_benchmark(args, output_dir: str) -> dict:
+    model_file = DC_MODEL_FILE if args.model == "dc" else CS_MODEL_FILE
+    sample_columns, write_samples = (
+        (DC_SAMPLE_COLUMNS, write_dc_samples) if args.model == "dc" else (CS_SAMPLE_COLUMNS, write_cs_samples)
+    )
+
+    timer = StageTimer()
+    with timer("simulate"):
+        library = simulate_library(model_file, args.guides, args.cells, args.moi, args.ambient_rate, args.seed)
+    mtx_path = os.path.join(output_dir, "library.mtx")
+    write_mm(mtx_path, library.mm_data, args.guides, args.cells)
+
+    with timer("read_mm_file"):
+        with open(mtx_path, encoding="ascii") as mtx_file:
+            read_mm_file(mtx_file)
+    with timer("read_mm_arrays"):
+        mm_data = read_mm_arrays(mtx_path)
+    with timer("normalize"):
+        library_sizes, groups = mm_counts(mm_data, args.normalization_lpf)
+        per_guide_counts(groups, normalize(library_sizes))
+
+    fit_args = {
+        "chains": args.chains,
+        "normalization_lpf": args.normalization_lpf,
+        "num_samples": args.num_samples,
+        "num_warmup": args.num_warmup,
+        "seed": args.seed,
+        "batch_size": args.batch_size,
+        "engine": args.engine,
+        "inference": args.inference,
+        "keep_pzi_draws": False,
+        "cores": args.cores,
+        "triage": args.triage,
+    }
+    with timer("fit"):
+        fits = list(fit_guides(mm_data, model_file, **fit_args))
+
+    samples_path = os.path.join(output_dir, "samples")
+    posteriors_path = os.path.join(output_dir, "posteriors")
+    with timer("write"):
+        with (
+            open_table(samples_path, sample_columns, args.output_format) as samples_table,
+            open_table(posteriors_path, posterior_columns(), args.output_format, header=False) as posteriors_table,
+        ):
+            for guide_id, samples, cell_info in fits:
+                write_samples(samples_table, guide_id, samples)
+                write_posteriors(posteriors_table, guide_id, samples, cell_info)
+    del fits
+
+    with timer("qc"):
+        prediction_counts(posteriors_path, [ASSIGNMENT_THRESHOLD])
+        sample_moments(samples_path)
+        posterior_umi_summary(posteriors_path, mm_data, ASSIGNMENT_THRESHOLD)
+
+    # Simulated entries are in (guide, cell) order, which is the order of their keys
+    keys, posteriors = read_posteriors(posteriors_path)
+    if not np.array_equal(keys, pair_keys(library.mm_data.guides, library.mm_data.cells)):
+        raise ValueError("The posterior output does not have one row per library entry")
+
+    subsampled = None
+    if args.subsample:
+        # Refit on subsamples, to compare with the full data fit
+        with timer("fit (subsampled)"):
+            fits = list(fit_guides(mm_data, model_file, subsample=args.subsample, **fit_args))
+        subsampled_path = os.path.join(output_dir, "posteriors_subsampled")
+        with open_table(subsampled_path, posterior_columns(), args.output_format, header=False) as posteriors_table:
+            for guide_id, samples, cell_info in fits:
+                write_posteriors(posteriors_table, guide_id, samples, cell_info)
+        del fits
+
+        _, subsampled_posteriors = read_posteriors(subsampled_path)
+        difference = np.abs(subsampled_posteriors - posteriors)
+        subsampled = {
+            "rows": args.subsample,
+            "accuracy": accuracy(subsampled_posteriors, library),
+            "mean posterior difference": float(difference.mean()),
+            "max posterior difference": float(difference.max()),
+        }
+
+    try:
+        package_version = version("CLEANSER")
+    except PackageNotFoundError:
+        package_version = None
+
+    return {
+        "version": package_version,
+        "model": args.model,
+        "engine": args.engine,
+        "sampler": args.sampler,
+        "guides": args.guides,
+        "cells": args.cells,
+        "entries": len(library.mm_data),
+        "seed": args.seed,
+        "seconds": timer.seconds,
+        "accuracy": accuracy(posteriors, library),
+        "subsampled": subsampled,
+    }
+
+
+def report(results: dict) -> str:
+    lines = [
+        f"{results['model']} model, {results['guides']} guides, {results['cells']} cells, "
+        f"{results['entries']} entries ({results['engine']} engine, {results['sampler']} sampler)",
+        "",
+        f"{'stage':<18}seconds",
+    ]
+    lines.extend(f"{stage:<18}{seconds:.3f}" for stage, seconds in results["seconds"].items())
+    lines.append("")
+    lines.extend(f"{name:<18}{value:.3f}" for name, value in results["accuracy"].items())
+    if results["subsampled"] is not None:
+        subsampled = results["subsampled"]
+        lines.append(f"\nFit on subsamples of {subsampled['rows']} rows:")
+        lines.extend(f"{name:<18}{value:.3f}" for name, value in subsampled["accuracy"].items())
+        lines.append(
+            f"Posteriors differ from the full fit's by {subsampled['mean posterior difference']:.4f} on average"
+        )
+        lines.append(f"and by at most {subsampled['max posterior difference']:.4f}")
+    lines.append(f"\nRandom seed: {results['seed']}")
+    return "\n".join(lines)
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+        "cleanser_bench", description="Time each stage of cleanser and cleanser_qc on a simulated library"
+    )
+    model_group = parser.add_mutually_exclusive_group()
+    model_group.add_argument("--cs", action="store_const", const="cs", dest="model", help="CROP-seq model")
+    model_group.add_argument("--dc", action="store_const", const="dc", dest="model", help="Direct capture model")
+    parser.set_defaults(model="cs")
+
+    parser.add_argument("--guides", type=int, default=DEFAULT_GUIDES, help="Number of guides")
+    parser.add_argument("--cells", type=int, default=DEFAULT_CELLS, help="Number of cells")
+    parser.add_argument("--moi", type=float, default=DEFAULT_MOI, help="Mean number of guides infecting each cell")
+    parser.add_argument(
+        "--ambient-rate",
+        type=float,
+        default=DEFAULT_AMBIENT_RATE,
+        help="Mean number of guides with ambient reads in each cell",
+    )
+    parser.add_argument("-s", "--seed", type=int, default=DEFAULT_SEED, help="Seed of the simulation and the fits")
+    parser.add_argument(
+        "--sampler",
+        choices=SAMPLERS,
+        default="stub",
+        help="Fit with a stub of CmdStan that takes MAP draws (default), or with CmdStan",
+    )
+    parser.add_argument("--engine", choices=ENGINES, default="stan", help="Inference engine")
+    parser.add_argument("--inference", choices=INFERENCE_METHODS, default=DEFAULT_INFERENCE)
+    parser.add_argument("-n", "--num-samples", type=int, default=DEFAULT_SAMPLE)
+    parser.add_argument("-w", "--num-warmup", type=int, default=DEFAULT_WARMUP)
+    parser.add_argument("-c", "--chains", type=int, default=DEFAULT_CHAINS)
+    parser.add_argument("--lpf", "--normalization-lpf", dest="normalization_lpf", type=int, default=DEFAULT_NORM_LPF)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--cores", type=int, default=DEFAULT_CORES)
+    parser.add_argument("--triage", action="store_true", help="Fit degenerate guides from point estimates")
+    parser.add_argument(
+        "--subsample",
+        type=int,
+        default=0,
+        metavar="ROWS",
+        help="Also fit guides with more than ROWS observations on subsamples, and compare with the full fit",
+    )
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="tsv")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("--keep", metavar="DIR", help="Keep the simulated library and outputs in this directory")
+
+    return parser.parse_args(argv)
+
+
+def run_cli():
+    args = get_args()
+
+    try:
+        if args.keep:
+            os.makedirs(args.keep, exist_ok=True)
+            results = run_benchmark(args, args.keep)
+        else:
+            with tempfile.TemporaryDirectory() as output_dir:
+                results = run_benchmark(args, output_dir)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+    print(report(results))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=2)
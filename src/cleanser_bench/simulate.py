@@ -0,0 +1,129 @@
+"""
+Synthetic guide libraries drawn from the CLEANSER mixture models.
+
+Every cell has a sequencing depth and is infected by a Poisson(MOI) number of guides, whose counts
+come from the guide's native negative binomial. Each cell also picks up ambient reads of other
+guides, at an average of `ambient_rate` guides per cell, with counts from the model's ambient
+component: Poisson for CROP-seq and negative binomial for direct capture. As in real libraries only
+nonzero counts are recorded, so both components are zero-truncated.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+from cleanser.constants import CS_MODEL_FILE, DC_MODEL_FILE
+from cleanser.matrix_market import MMData
+
+DEFAULT_GUIDES = 200
+DEFAULT_CELLS = 5000
+DEFAULT_MOI = 1.0
+DEFAULT_AMBIENT_RATE = 20.0
+
+
+class Library(NamedTuple):
+    "A simulated library and the truth behind it"
+
+    mm_data: MMData
+    assigned: np.ndarray  # Whether each entry is a true guide assignment
+    params: dict[str, np.ndarray]  # Each guide's model parameters
+    depth: np.ndarray  # Each cell's relative sequencing depth
+
+
+def guide_params(model_file: str, num_guides: int, rng: np.random.Generator) -> dict[str, np.ndarray]:
+    """Parameters of each guide's ambient and native components, spread around the models' priors"""
+    if model_file == CS_MODEL_FILE:
+        return {
+            "lambda": rng.lognormal(np.log(1.1), 0.1, num_guides),
+            "nbMean": rng.lognormal(np.log(40), 0.5, num_guides),
+            "nbDisp": rng.uniform(0.5, 2.0, num_guides),
+        }
+    if model_file == DC_MODEL_FILE:
+        return {
+            "n_nbMean": rng.lognormal(np.log(1.075), 0.1, num_guides),
+            "n_nbDisp": rng.lognormal(np.log(1.1), 0.1, num_guides),
+            "nbMean": rng.lognormal(np.log(100), 0.5, num_guides),
+            "nbDisp": rng.lognormal(np.log(3), 0.3, num_guides),
+        }
+    raise ValueError(f"Unknown model {model_file}")
+
+
+def _negative_binomial(mean: np.ndarray, disp: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    # NumPy's negative binomial counts failures before `n` successes with success probability `p`
+    return rng.negative_binomial(disp, disp / (disp + mean))
+
+
+def _zero_truncated(draw, size: int, rng: np.random.Generator) -> np.ndarray:
+    """Draw from `draw(indices, rng)` again wherever a draw came out as 0"""
+    values = draw(np.arange(size), rng)
+    zeros = np.flatnonzero(values == 0)
+    while len(zeros):
+        values[zeros] = draw(zeros, rng)
+        zeros = zeros[values[zeros] == 0]
+    return values
+
+
+def _pairs(num_cells: int, num_guides: int, rate: float, rng: np.random.Generator):
+    """Guide/cell pairs with about Poisson(rate) guides per cell. Repeated draws of a guide in the
+    same cell are dropped, which matters little when there are far more guides than `rate`."""
+    cells = np.repeat(np.arange(num_cells), rng.poisson(rate, num_cells))
+    keys = np.unique(rng.integers(num_guides, size=len(cells)) * num_cells + cells)
+    return keys // num_cells, keys % num_cells
+
+
+def simulate_library(
+    model_file: str,
+    num_guides: int = DEFAULT_GUIDES,
+    num_cells: int = DEFAULT_CELLS,
+    moi: float = DEFAULT_MOI,
+    ambient_rate: float = DEFAULT_AMBIENT_RATE,
+    seed: int = 0,
+) -> Library:
+    rng = np.random.default_rng(seed)
+    params = guide_params(model_file, num_guides, rng)
+    depth = rng.lognormal(0, 0.3, num_cells)
+
+    native_guides, native_cells = _pairs(num_cells, num_guides, moi, rng)
+    ambient_guides, ambient_cells = _pairs(num_cells, num_guides, ambient_rate, rng)
+
+    # A guide that infected a cell is not counted again as ambient
+    native_keys = native_guides * num_cells + native_cells
+    ambient = ~np.isin(ambient_guides * num_cells + ambient_cells, native_keys)
+    ambient_guides, ambient_cells = ambient_guides[ambient], ambient_cells[ambient]
+
+    native_mean = params["nbMean"][native_guides] * depth[native_cells]
+    native_disp = params["nbDisp"][native_guides]
+    native_counts = _zero_truncated(
+        lambda i, rng: _negative_binomial(native_mean[i], native_disp[i], rng), len(native_guides), rng
+    )
+
+    if model_file == CS_MODEL_FILE:
+        rate = params["lambda"][ambient_guides]
+        ambient_counts = _zero_truncated(lambda i, rng: rng.poisson(rate[i]), len(ambient_guides), rng)
+    else:
+        ambient_mean = params["n_nbMean"][ambient_guides] * depth[ambient_cells]
+        ambient_disp = params["n_nbDisp"][ambient_guides]
+        ambient_counts = _zero_truncated(
+            lambda i, rng: _negative_binomial(ambient_mean[i], ambient_disp[i], rng), len(ambient_guides), rng
+        )
+
+    # Guide and cell ids start at 1, as in Matrix Market files
+    guides = np.concatenate([native_guides, ambient_guides]) + 1
+    cells = np.concatenate([native_cells, ambient_cells]) + 1
+    order = np.lexsort((cells, guides))
+    mm_data = MMData(
+        guides[order].astype(np.int32),
+        cells[order].astype(np.int32),
+        np.concatenate([native_counts, ambient_counts])[order].astype(np.int64),
+    )
+    assigned = np.concatenate([np.ones(len(native_guides), bool), np.zeros(len(ambient_guides), bool)])[order]
+
+    return Library(mm_data, assigned, params, depth)
+
+
+def write_mm(path, mm_data: MMData, num_guides: int, num_cells: int):
+    """Write a library as a Matrix Market file that `cleanser` reads"""
+    with open(path, "w", encoding="ascii") as mtx_file:
+        mtx_file.write("%%MatrixMarket matrix coordinate integer general\n")
+        mtx_file.write(f"{num_guides} {num_cells} {len(mm_data)}\n")
+        np.savetxt(mtx_file, np.column_stack([mm_data.guides, mm_data.cells, mm_data.counts]), fmt="%d")
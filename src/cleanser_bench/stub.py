@@ -0,0 +1,161 @@
+"""
+A stand-in for CmdStan, for benchmarking the Python side of a run without a C++ toolchain.
+
+`StubModel` has the parts of `cmdstanpy.CmdStanModel`'s interface that `cleanser.guide_mixture`
+uses. Instead of running Stan it finds each guide's MAP parameters with the NumPy engine and
+returns draws scattered closely around them, with PZi computed from every draw when the model
+would have generated it. Fits therefore have the shapes, sizes and roughly the values of real
+ones, so reading, reducing and writing them costs what it would with CmdStan. Like CmdStan, fits
+asked to `save_profile` write the time spent in the models' `profile` blocks to `output_dir`.
+
+`install` patches the stub into `cleanser`. Guide fits run in worker processes, which inherit the
+patch when they are forked, so it also makes the process pool fork on every platform until the
+function it returns undoes both.
+"""
+
+import multiprocessing as mp
+import os.path
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+import cleanser.guide_mixture
+from cleanser.constants import BATCH_MODEL_FILES, MODEL_PARAMETERS
+from cleanser.mixture import fit_map, posterior_probability
+
+# Relative spread of the stub's draws around the MAP estimates
+DRAW_SCALE = 0.02
+SINGLE_MODEL_FILES = {batch_file: model_file for model_file, batch_file in BATCH_MODEL_FILES.items()}
+
+
+class StubFit:
+    "The parts of a cmdstanpy fit that cleanser reads"
+
+    def __init__(self, variables: dict[str, np.ndarray], chains: int, num_params: int):
+        self._variables = variables
+        self.chains = chains
+        self.step_size = np.full(chains, 0.5)
+        self.inv_metric = np.ones((chains, num_params))
+        self.metadata = SimpleNamespace(cmdstan_config={"max_depth": 10})
+
+    def stan_variables(self) -> dict[str, np.ndarray]:
+        return dict(self._variables)
+
+    def stan_variable(self, name: str) -> np.ndarray:
+        return self._variables[name]
+
+    @property
+    def column_names(self) -> list[str]:
+        names = []
+        for name, value in self._variables.items():
+            names.extend([name] if value.ndim == 1 else [f"{name}[{i + 1}]" for i in range(value.shape[1])])
+        return names
+
+    def draws(self, concat_chains: bool = True) -> np.ndarray:
+        draws = np.column_stack([value.reshape(len(value), -1) for value in self._variables.values()])
+        if concat_chains:
+            return draws
+        return draws.reshape(self.chains, -1, draws.shape[1]).transpose(1, 0, 2)
+
+    def method_variables(self) -> dict[str, np.ndarray]:
+        shape = (len(next(iter(self._variables.values()))) // self.chains, self.chains)
+        return {"divergent__": np.zeros(shape), "treedepth__": np.full(shape, 3)}
+
+
+def _profile_args(kwargs) -> dict:
+    return {"output_dir": kwargs.get("output_dir"), "save_profile": kwargs.get("save_profile", False)}
+
+
+def write_profile(output_dir: str, model_name: str, seconds: dict[str, float]):
+    """Write block timings in the format of CmdStan's profile files"""
+    path = os.path.join(output_dir, f"{model_name}-{time.time_ns()}-profile.csv")
+    with open(path, "w", encoding="ascii") as profile_file:
+        profile_file.write(
+            "name,thread_id,total_time,forward_time,reverse_time,chain_stack,no_chain_stack,"
+            "autodiff_calls,no_autodiff_calls\n"
+        )
+        for name, total in seconds.items():
+            profile_file.write(f"{name},0,{total},{total},0,0,0,0,1\n")
+
+
+class StubModel:
+    "Stands in for `cmdstanpy.CmdStanModel`. The executable is the name of the Stan model file."
+
+    def __init__(self, stan_file=None, exe_file=None, **kwargs):
+        self.exe_file = str(exe_file or stan_file)
+
+    def _fit(self, data, num_draws: int, chains: int, seed, output_dir=None, save_profile=False) -> StubFit:
+        model_file = Path(self.exe_file).name
+        batched = model_file in SINGLE_MODEL_FILES
+        model_file = SINGLE_MODEL_FILES.get(model_file, model_file)
+
+        X, L, W = (np.asarray(data[name], dtype=float) for name in ("X", "L", "W"))
+        num_guides = data.get("G", 1)
+        guide_index = np.repeat(np.arange(num_guides), data["guide_size"]) if batched else np.zeros(len(X), int)
+
+        start_time = time.perf_counter()
+        estimates = fit_map(model_file, X, L, W, guide_index, num_guides)
+        likelihood_time = time.perf_counter() - start_time
+        rng = np.random.default_rng(seed)
+        draws = {
+            name: estimates[name] * np.exp(rng.normal(0, DRAW_SCALE, (num_draws, num_guides)))
+            for name in MODEL_PARAMETERS[model_file]
+        }
+        draws["r"] = np.minimum(draws["r"], 0.1)
+
+        start_time = time.perf_counter()
+        pzi = np.empty((num_draws, 0))
+        if data.get("generate_pzi", 1):
+            pzi = posterior_probability(
+                model_file, {name: value[:, guide_index] for name, value in draws.items()}, X, L
+            )
+
+        if save_profile and output_dir is not None:
+            write_profile(
+                output_dir,
+                Path(self.exe_file).stem,
+                {"likelihood": likelihood_time, "generated quantities": time.perf_counter() - start_time},
+            )
+
+        variables = {name: value if batched else value[:, 0] for name, value in draws.items()}
+        variables["PZi"] = pzi
+        return StubFit(variables, chains, len(draws) * num_guides)
+
+    def sample(self, data, iter_sampling=1000, chains=4, seed=None, adapt_engaged=True, **kwargs) -> StubFit:
+        fit = self._fit(data, iter_sampling * chains, chains, seed, **_profile_args(kwargs))
+        if not adapt_engaged:
+            # Without adaptation, NUTS samples with the step size and metric it was given
+            fit.step_size = np.full(chains, kwargs["step_size"])
+            fit.inv_metric = np.tile(kwargs["metric"]["inv_metric"], (chains, 1))
+        return fit
+
+    def optimize(self, data, seed=None, **kwargs) -> StubFit:
+        return self._fit(data, 1, 1, seed, **_profile_args(kwargs))
+
+    def laplace_sample(self, data, draws=1000, seed=None, **kwargs) -> StubFit:
+        return self._fit(data, draws, 1, seed, **_profile_args(kwargs))
+
+    pathfinder = variational = laplace_sample
+
+
+def stub_compiled_model(model_file: str, threaded: bool = False, profiled: bool = False) -> str:
+    return model_file
+
+
+def install():
+    """Use the stub for every Stan fit cleanser runs in this process and its workers. Returns a
+    function that puts back CmdStan and the previous start method of the process pools."""
+    patched = {name: getattr(cleanser.guide_mixture, name) for name in ("CmdStanModel", "compiled_model")}
+    start_method = mp.get_start_method(allow_none=True)
+    cleanser.guide_mixture.CmdStanModel = StubModel
+    cleanser.guide_mixture.compiled_model = stub_compiled_model
+    mp.set_start_method("fork", force=True)
+
+    def uninstall():
+        for name, value in patched.items():
+            setattr(cleanser.guide_mixture, name, value)
+        mp.set_start_method(start_method, force=True)
+
+    return uninstall
@@ -0,0 +1,189 @@
+"""
+Streaming aggregation of CLEANSER outputs for QC.
+
+The posterior and sample tables are read a block of rows at a time into NumPy arrays, and every
+statistic is accumulated block by block, so memory use depends on the number of guides and cells
+rather than on the number of rows. Per-guide means and variances combine each block's grouped
+moments with the running ones (Chan et al.'s parallel form of Welford's algorithm), and MOI and
+coverage are counted for every threshold in the same pass. Posteriors are plotted against UMI
+counts as density grids binned block by block, rather than as one point per guide/cell pair.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+from cleanser.matrix_market import MMData
+from cleanser.tables import iter_table
+
+PREDICTION_COLUMNS = ["guide id", "cell id", "posterior"]
+CS_SAMPLE_COLUMNS = ["r", "mu", "Disp", "lambda"]
+DC_SAMPLE_COLUMNS = ["r", "mu", "Disp", "n_nbMean", "n_nbDisp"]
+# Bins along each axis of the posterior × UMI density grids
+DENSITY_BINS = 200
+
+
+class GroupedMoments:
+    """Running count, mean and sum of squared deviations of several columns, per group"""
+
+    def __init__(self, num_columns: int):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.means = np.empty((0, num_columns))
+        self.m2 = np.empty((0, num_columns))
+
+    def update(self, keys: np.ndarray, values: np.ndarray):
+        """Add a block of rows. `values` has one row per key and one column per statistic."""
+        block_keys, index = np.unique(keys, return_inverse=True)
+        counts = np.bincount(index, minlength=len(block_keys))
+        means = (
+            np.column_stack([np.bincount(index, weights=column, minlength=len(block_keys)) for column in values.T])
+            / counts[:, np.newaxis]
+        )
+        deviations = values - means[index]
+        m2 = np.column_stack(
+            [np.bincount(index, weights=column**2, minlength=len(block_keys)) for column in deviations.T]
+        )
+
+        # Move the running moments to the union of the keys seen so far, then merge in the block's
+        all_keys = np.union1d(self.keys, block_keys)
+        running = np.searchsorted(all_keys, self.keys)
+        block = np.searchsorted(all_keys, block_keys)
+        merged_counts = np.zeros(len(all_keys), dtype=np.int64)
+        merged_means = np.zeros((len(all_keys), values.shape[1]))
+        merged_m2 = np.zeros((len(all_keys), values.shape[1]))
+        merged_counts[running] = self.counts
+        merged_means[running] = self.means
+        merged_m2[running] = self.m2
+
+        previous = merged_counts[block][:, np.newaxis]
+        total = previous + counts[:, np.newaxis]
+        delta = means - merged_means[block]
+        merged_means[block] += delta * counts[:, np.newaxis] / total
+        merged_m2[block] += m2 + delta**2 * previous * counts[:, np.newaxis] / total
+        merged_counts[block] = total[:, 0]
+
+        self.keys, self.counts, self.means, self.m2 = all_keys, merged_counts, merged_means, merged_m2
+
+    @property
+    def variances(self) -> np.ndarray:
+        """Sample variances. Groups with a single row have no variance (NaN)."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.counts[:, np.newaxis] > 1, self.m2 / (self.counts[:, np.newaxis] - 1), np.nan)
+
+
+class ThresholdCounts:
+    """Number of guide/cell pairs with a posterior at or above each threshold, and the distinct
+    guides and cells seen"""
+
+    def __init__(self, thresholds):
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self._order = np.argsort(self.thresholds)
+        self.assigned = np.zeros(len(self.thresholds), dtype=np.int64)
+        self.guides = np.empty(0, dtype=np.int64)
+        self.cells = np.empty(0, dtype=np.int64)
+
+    def update(self, guides: np.ndarray, cells: np.ndarray, posteriors: np.ndarray):
+        # A posterior counts for every threshold it reaches, i.e. the sorted thresholds up to its position
+        reached = np.searchsorted(self.thresholds[self._order], posteriors, side="right")
+        counts = np.bincount(reached, minlength=len(self.thresholds) + 1)
+        self.assigned[self._order] += np.cumsum(counts[::-1])[-2::-1]
+        self.guides = np.union1d(self.guides, guides)
+        self.cells = np.union1d(self.cells, cells)
+
+    @property
+    def moi(self) -> np.ndarray:
+        """Mean number of assigned guides per cell, for each threshold"""
+        return self.assigned / len(self.cells)
+
+    @property
+    def coverage(self) -> np.ndarray:
+        """Mean number of assigned cells per guide, for each threshold"""
+        return self.assigned / len(self.guides)
+
+
+def prediction_counts(path, thresholds) -> ThresholdCounts:
+    """Count assignments at each of `thresholds` in a posterior output, in a single pass"""
+    counts = ThresholdCounts(thresholds)
+    for block in iter_table(path, PREDICTION_COLUMNS, header=False):
+        counts.update(
+            block["guide id"].astype(np.int64), block["cell id"].astype(np.int64), block["posterior"].astype(float)
+        )
+    return counts
+
+
+class SampleMoments(NamedTuple):
+    "Per-guide moments of each model parameter of a sample output"
+
+    columns: list[str]
+    moments: GroupedMoments
+
+
+def sample_moments(path) -> SampleMoments:
+    """Per-guide means and variances of a sample output's parameters, in a single pass"""
+    columns = moments = None
+    for block in iter_table(path, []):
+        if moments is None:
+            columns = CS_SAMPLE_COLUMNS if "lambda" in block else DC_SAMPLE_COLUMNS
+            moments = GroupedMoments(len(columns))
+        moments.update(block["guide id"].astype(np.int64), np.column_stack([block[name] for name in columns]))
+
+    if moments is None:
+        raise ValueError("No samples")
+    return SampleMoments(columns, moments)
+
+
+def pair_keys(guides: np.ndarray, cells: np.ndarray) -> np.ndarray:
+    """One int64 key per guide/cell pair, ordered by guide and then cell"""
+    return (np.asarray(guides, dtype=np.int64) << 32) | np.asarray(cells, dtype=np.int64)
+
+
+class PosteriorUmiSummary:
+    """Posterior × UMI density grids (on linear and log2 UMI scales) and a histogram of the UMIs of
+    assigned guide/cell pairs. Each pair's UMI count is found by a binary search of the library's
+    pairs, sorted once."""
+
+    def __init__(self, mm_data: MMData, threshold: float, bins: int = DENSITY_BINS):
+        keys = pair_keys(mm_data.guides, mm_data.cells)
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._umis = np.asarray(mm_data.counts)[order]
+        self.threshold = threshold
+
+        max_umi = max(int(self._umis.max(initial=0)), 2)
+        self.posterior_edges = np.linspace(0, 1, bins + 1)
+        self.umi_edges = np.linspace(0, max_umi, bins + 1)
+        self.log2_umi_edges = np.linspace(0, np.log2(max_umi), bins + 1)
+        self.density = np.zeros((bins, bins), dtype=np.int64)
+        self.log2_density = np.zeros((bins, bins), dtype=np.int64)
+        self.assigned_umis = np.zeros(max_umi + 1, dtype=np.int64)  # Number of assigned pairs with each UMI count
+
+    def umis(self, guides: np.ndarray, cells: np.ndarray) -> np.ndarray:
+        """UMI counts of guide/cell pairs"""
+        keys = pair_keys(guides, cells)
+        index = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        missing = self._keys[index] != keys
+        if missing.any():
+            i = np.argmax(missing)
+            raise KeyError(f"Guide {guides[i]} and cell {cells[i]} are not in the guide counts")
+        return self._umis[index]
+
+    def update(self, guides: np.ndarray, cells: np.ndarray, posteriors: np.ndarray):
+        umis = self.umis(guides, cells)
+        self.density += np.histogram2d(posteriors, umis, [self.posterior_edges, self.umi_edges])[0].astype(np.int64)
+        with np.errstate(divide="ignore"):
+            log2_umis = np.log2(umis)
+        self.log2_density += np.histogram2d(posteriors, log2_umis, [self.posterior_edges, self.log2_umi_edges])[
+            0
+        ].astype(np.int64)
+        self.assigned_umis += np.bincount(umis[posteriors >= self.threshold], minlength=len(self.assigned_umis))
+
+
+def posterior_umi_summary(path, mm_data: MMData, threshold: float) -> PosteriorUmiSummary:
+    """Bin every guide/cell pair of a posterior output by posterior and UMI count, in a single pass"""
+    summary = PosteriorUmiSummary(mm_data, threshold)
+    for block in iter_table(path, PREDICTION_COLUMNS, header=False):
+        summary.update(
+            block["guide id"].astype(np.int64), block["cell id"].astype(np.int64), block["posterior"].astype(float)
+        )
+    return summary
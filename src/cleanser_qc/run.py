@@ -1,124 +1,24 @@
 import argparse
-import csv
-from collections import defaultdict
-from dataclasses import dataclass
+import os
+from concurrent.futures import ProcessPoolExecutor
 from io import StringIO
-from math import log2
 from pathlib import Path
-from statistics import mean, variance
-from typing import cast
 
 import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.colors import LogNorm
 from matplotlib.figure import Figure
 
-from cleanser.run import MMLines, read_mm_file
-
-
-@dataclass
-class DCSampleMetadata:
-    "Direct capture sample information"
-
-    guide_id: str
-    r: float
-    mu: float
-    dispersion: float
-    neg_binom_mean: float
-    neg_binom_dispersion: float
-
-
-@dataclass
-class CSSampleMetadata:
-    "CROP-seq sample information"
-
-    guide_id: str
-    r: float
-    mu: float
-    dispersion: float
-    lamb: float  # lambda
-
-
-@dataclass
-class Prediction:
-    "CLEANSER Prediction for a guide/cell pair"
-    guide_id: str
-    cell_id: str
-    prediction: float
-
-
-def per_guide_sample_stats(
-    samples: list[CSSampleMetadata] | list[DCSampleMetadata],
-) -> tuple[list[CSSampleMetadata] | list[DCSampleMetadata], list[CSSampleMetadata] | list[DCSampleMetadata]]:
-
-    sample_count = len(samples)
-
-    if sample_count == 0:
-        raise ValueError("No samples")
-
-    if isinstance(samples[0], CSSampleMetadata):
-        sample_tallies = defaultdict(lambda: [[], [], [], []])
-        for sample in cast(list[CSSampleMetadata], samples):
-            running_tally = sample_tallies[sample.guide_id]
-            running_tally[0].append(sample.r)
-            running_tally[1].append(sample.mu)
-            running_tally[2].append(sample.dispersion)
-            running_tally[3].append(sample.lamb)
-
-        means = [
-            CSSampleMetadata(guide_id, mean(tally[0]), mean(tally[1]), mean(tally[2]), mean(tally[3]))
-            for guide_id, tally in sample_tallies.items()
-        ]
-
-        variances = [
-            CSSampleMetadata(guide_id, variance(tally[0]), variance(tally[1]), variance(tally[2]), variance(tally[3]))
-            for guide_id, tally in sample_tallies.items()
-        ]
-
-        return means, variances
-
-    if isinstance(samples[0], DCSampleMetadata):
-        sample_tallies = defaultdict(lambda: [[], [], [], [], []])
-        for sample in cast(list[DCSampleMetadata], samples):
-            running_tally = sample_tallies[sample.guide_id]
-            running_tally[0].append(sample.r)
-            running_tally[1].append(sample.mu)
-            running_tally[2].append(sample.dispersion)
-            running_tally[3].append(sample.neg_binom_mean)
-            running_tally[4].append(sample.neg_binom_dispersion)
-
-        means = [
-            DCSampleMetadata(
-                guide_id,
-                mean(tally[0]),
-                mean(tally[1]),
-                mean(tally[2]),
-                mean(tally[3]),
-                mean(tally[4]),
-            )
-            for guide_id, tally in sample_tallies.items()
-        ]
-
-        variances = [
-            DCSampleMetadata(
-                guide_id,
-                variance(tally[0]),
-                variance(tally[1]),
-                variance(tally[2]),
-                variance(tally[3]),
-                variance(tally[4]),
-            )
-            for guide_id, tally in sample_tallies.items()
-        ]
+from cleanser.matrix_market import read_mm_arrays
 
-        return means, variances
+from .aggregate import CS_SAMPLE_COLUMNS, SampleMoments, posterior_umi_summary, prediction_counts, sample_moments
 
-    raise ValueError("Invalid sample type")
 
-
-def plot_hist(values, bin_count, title="", x_label="", y_label="", density=False) -> Figure:
+def plot_hist(values, bin_count, title="", x_label="", y_label="", density=False, weights=None) -> Figure:
     fig, ax = plt.subplots()
 
     # the histogram of the data
-    ax.hist(values, bins=bin_count, density=density)
+    ax.hist(values, bins=bin_count, density=density, weights=weights)
 
     ax.set_xlabel(x_label)
     ax.set_ylabel(y_label)
@@ -130,11 +30,19 @@ def plot_hist(values, bin_count, title="", x_label="", y_label="", density=False
     return fig
 
 
-def plot_scatter(x, y, title="", x_label="", y_label="") -> Figure:
+def plot_density(counts, x_edges, y_edges, title="", x_label="", y_label="") -> Figure:
+    """Draw binned point counts as a single image, which takes the same time for any number of points"""
     fig, ax = plt.subplots()
 
-    # the histogram of the data
-    ax.scatter(x, y, s=0.5)
+    image = ax.imshow(
+        np.ma.masked_equal(counts.T, 0),
+        origin="lower",
+        extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+        aspect="auto",
+        interpolation="nearest",
+        norm=LogNorm(),
+    )
+    fig.colorbar(image, ax=ax, label="guide/cell pairs")
 
     ax.set_xlabel(x_label)
     ax.set_ylabel(y_label)
@@ -146,146 +54,102 @@ def plot_scatter(x, y, title="", x_label="", y_label="") -> Figure:
     return fig
 
 
-def sample_stat_output(statistics: list[CSSampleMetadata] | list[DCSampleMetadata]) -> str:
+def moments_output(moments: SampleMoments, values) -> str:
+    """Tab-separated per-guide `values` (e.g. `moments.moments.means`), with a header of the sample columns"""
     statistic_text = StringIO()
-
-    if isinstance(statistics[0], CSSampleMetadata):
+    if moments.columns == CS_SAMPLE_COLUMNS:
         statistic_text.write("guide\tr\tmu\tdisp\tlambda\n")
-        for ave in cast(list[CSSampleMetadata], statistics):
-            statistic_text.write(f"{ave.guide_id}\t{ave.r}\t{ave.mu}\t{ave.dispersion}\t{ave.lamb}\n")
-
-    if isinstance(statistics[0], DCSampleMetadata):
+    else:
         statistic_text.write("guide\tr\tmu\tdisp\tn_mu\tn_disp\n")
-        for ave in cast(list[DCSampleMetadata], statistics):
-            statistic_text.write(
-                f"{ave.guide_id}\t{ave.r}\t{ave.mu}\t{ave.dispersion}\t{ave.neg_binom_mean}\t{ave.neg_binom_dispersion}\n"
-            )
+
+    for guide_id, row in zip(moments.moments.keys.tolist(), values.tolist()):
+        statistic_text.write("\t".join(map(str, [guide_id, *row])) + "\n")
 
     return statistic_text.getvalue()
 
 
-def sample_mean_histogram(means: list[CSSampleMetadata] | list[DCSampleMetadata]) -> Figure:
-    mean_count = len(means)
+def threshold_output(name: str, thresholds, values) -> str:
+    """One line per threshold, or just the value when there is a single threshold"""
+    if len(thresholds) == 1:
+        return f"{name}: {values[0]}\n"
+    return "".join(f"{name} at threshold {threshold}: {value}\n" for threshold, value in zip(thresholds, values))
+
 
-    if mean_count == 0:
+def sample_mean_histogram(mean_r) -> Figure:
+    if len(mean_r) == 0:
         raise ValueError("No means")
 
-    mean_r = [a.r for a in means]
     fig = plot_hist(mean_r, 30, title="cleanser", x_label="sample mean", y_label="count")
     return fig
 
 
-def assigned_counts_histogram(predictions: list[Prediction], mm_lines: MMLines, threshold: float) -> Figure:
-    thresholded_preds = {(p.guide_id, p.cell_id) for p in predictions if p.prediction >= threshold}
-    umis = [umi for guide_id, cell_id, umi in mm_lines if (guide_id, cell_id) in thresholded_preds]
-    fig = plot_hist(umis, 100, title="cleanser", x_label="UMI", y_label="count")
+def assigned_counts_histogram(assigned_umis) -> Figure:
+    """Histogram of the UMI counts of assigned guide/cell pairs, from the number of pairs with each count"""
+    umis = np.flatnonzero(assigned_umis)
+    fig = plot_hist(umis, 100, title="cleanser", x_label="UMI", y_label="count", weights=assigned_umis[umis])
     return fig
 
 
-def posterior_umi_scatterplot(predictions: list[Prediction], mm_lines: MMLines) -> Figure:
-    umi_keys = [(p.guide_id, p.cell_id) for p in predictions]
-    posteriors = [p.prediction for p in predictions]
-
-    # order the umis to match the posteriors
-    umi_dict = {(guide_id, cell_id): umi for guide_id, cell_id, umi in mm_lines}
-    umis = [umi_dict[k] for k in umi_keys]
-
-    fig = plot_scatter(posteriors, umis, title="cleanser", x_label="Posterior", y_label="UMI")
-
+def posterior_umi_density(density, posterior_edges, umi_edges, y_label="UMI") -> Figure:
+    fig = plot_density(density, posterior_edges, umi_edges, title="cleanser", x_label="Posterior", y_label=y_label)
     return fig
 
 
-def posterior_umi_scatterplot_log2(predictions: list[Prediction], mm_lines: MMLines) -> Figure:
-    umi_keys = [(p.guide_id, p.cell_id) for p in predictions]
-    posteriors = [p.prediction for p in predictions]
-
-    # order the umis to match the posteriors
-    umi_dict = {(guide_id, cell_id): log2(umi) for guide_id, cell_id, umi in mm_lines}
-    umis = [umi_dict[k] for k in umi_keys]
-
-    fig = plot_scatter(posteriors, umis, title="cleanser", x_label="Posterior", y_label="log2(UMI)")
-
-    return fig
-
-
-def calc_moi(predictions: list[Prediction], threshold: float) -> float:
-    cells = set()
-    predict_count = 0
-    for prediction in predictions:
-        cells.add(prediction.cell_id)
-        if prediction.prediction >= threshold:
-            predict_count += 1
-
-    return predict_count / len(cells)
-
-
-def calc_coverage(predictions: list[Prediction], threshold: float) -> float:
-    guides = set()
-    predict_count = 0
-    for prediction in predictions:
-        guides.add(prediction.guide_id)
-        if prediction.prediction >= threshold:
-            predict_count += 1
-
-    return predict_count / len(guides)
-
-
-def read_predictions(input_file) -> list[Prediction]:
-    reader = csv.reader(input_file, delimiter="\t")
-
-    return [Prediction(guide_id=l[0], cell_id=l[1], prediction=float(l[2])) for l in reader]
-
-
-def read_sample_data(sample_data_file) -> list[CSSampleMetadata] | list[DCSampleMetadata]:
-    reader = csv.DictReader(sample_data_file, delimiter="\t")
-    if reader.fieldnames is None:
-        raise ValueError("Invalid sample data file")
-
-    if len(reader.fieldnames) == 5:
-        return [
-            CSSampleMetadata(l["guide id"], float(l["r"]), float(l["mu"]), float(l["Disp"]), float(l["lambda"]))
-            for l in reader
-        ]
-
-    if len(reader.fieldnames) == 6:
-        return [
-            DCSampleMetadata(
-                l["guide id"],
-                float(l["r"]),
-                float(l["mu"]),
-                float(l["Disp"]),
-                float(l["n_nbMean"]),
-                float(l["n_nbDisp"]),
-            )
-            for l in reader
-        ]
-
-    raise ValueError("Invalid sample data file")
-
-
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Generate CLEANSER QC information")
-    parser.add_argument("-i", "--input", type=argparse.FileType(), help="Cleanser posterior output file", required=True)
+    parser.add_argument(
+        "-i", "--input", help="Cleanser posterior output file, as text (possibly gzipped) or columnar", required=True
+    )
     parser.add_argument("-o", "--output-directory", help="Cleanser QC output directory", required=True)
     parser.add_argument(
         "-g",
         "--guide-counts",
-        type=argparse.FileType(),
-        help="Guide count file. Needed for UMI histogram and scatterplots",
+        help="Guide count file. May be gzipped. Needed for UMI histogram and scatterplots",
     )
     parser.add_argument(
         "-s",
         "--samples",
-        type=argparse.FileType(),
-        help="Cleanser sampling data. Needed for sample mean, variance, and mean histogram",
+        help="Cleanser sampling data, as text (possibly gzipped) or columnar. Needed for sample mean, variance, and mean histogram",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        nargs="+",
+        default=[0.0],
+        help="Disregard assignment probabilities below this value. MOI and coverage are reported for every threshold "
+        "given; the UMI histogram uses the first.",
     )
+
     parser.add_argument(
-        "-t", "--threshold", type=float, default=0.0, help="Disregard assignment probabilities below this value"
+        "-p",
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes rendering the figures",
     )
 
     return parser.parse_args()
 
 
+def save_figure(path, plot, *args):
+    fig = plot(*args)
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def save_figures(figures, processes: int):
+    """Render (path, plot function, arguments) figures, each in its own worker process"""
+    if processes <= 1 or len(figures) <= 1:
+        for figure in figures:
+            save_figure(*figure)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(processes, len(figures))) as pool:
+        for future in [pool.submit(save_figure, *figure) for figure in figures]:
+            future.result()
+
+
 def write(output_dir, filename, contents):
     output_file = output_dir / Path(filename)
     with open(output_file, "w", encoding="utf-8") as file:
@@ -301,33 +165,45 @@ def run_cli():
     elif not output_dir.is_dir():
         raise ValueError(f"Output directory {output_dir} must be a directory")
 
-    predictions = read_predictions(args.input)
-    moi = calc_moi(predictions, args.threshold)
-    moi_text = f"MOI: {moi}"
-    print(moi_text)
-    write(output_dir, "moi.txt", moi_text + "\n")
+    # MOI and coverage at every threshold come from one streaming pass over the predictions
+    counts = prediction_counts(args.input, args.threshold)
+    moi_text = threshold_output("MOI", args.threshold, counts.moi.tolist())
+    print(moi_text, end="")
+    write(output_dir, "moi.txt", moi_text)
 
-    coverage = calc_coverage(predictions, args.threshold)
-    coverage_text = f"Coverage: {coverage}"
-    print(coverage_text)
-    write(output_dir, "coverage.txt", coverage_text + "\n")
+    coverage_text = threshold_output("Coverage", args.threshold, counts.coverage.tolist())
+    print(coverage_text, end="")
+    write(output_dir, "coverage.txt", coverage_text)
 
+    # Figures only need binned data, so they are drawn at the end, in parallel
+    figures = []
     if args.guide_counts is not None:
-        mm_lines = read_mm_file(args.guide_counts)
-        assigned_counts_histogram(predictions, mm_lines, args.threshold)
-        plt.savefig(output_dir / Path("umi_hist.png"))
-
-        posterior_umi_scatterplot(predictions, mm_lines)
-        plt.savefig(output_dir / Path("umi_count_scatter.png"))
-
-        posterior_umi_scatterplot_log2(predictions, mm_lines)
-        plt.savefig(output_dir / Path("umi_count_scatter_log2.png"))
+        summary = posterior_umi_summary(args.input, read_mm_arrays(args.guide_counts), args.threshold[0])
+        figures.append((output_dir / Path("umi_hist.png"), assigned_counts_histogram, summary.assigned_umis))
+        figures.append(
+            (
+                output_dir / Path("umi_count_scatter.png"),
+                posterior_umi_density,
+                summary.density,
+                summary.posterior_edges,
+                summary.umi_edges,
+            )
+        )
+        figures.append(
+            (
+                output_dir / Path("umi_count_scatter_log2.png"),
+                posterior_umi_density,
+                summary.log2_density,
+                summary.posterior_edges,
+                summary.log2_umi_edges,
+                "log2(UMI)",
+            )
+        )
 
     if args.samples is not None:
-        samples = read_sample_data(args.samples)
-        assert len(samples) > 0
-        means, variances = per_guide_sample_stats(samples)
-        write(output_dir, "sample_mean.txt", sample_stat_output(means))
-        write(output_dir, "sample_variance.txt", sample_stat_output(variances))
-        sample_mean_histogram(means)
-        plt.savefig(output_dir / Path("sample_mean_hist.png"))
+        moments = sample_moments(args.samples)
+        write(output_dir, "sample_mean.txt", moments_output(moments, moments.moments.means))
+        write(output_dir, "sample_variance.txt", moments_output(moments, moments.moments.variances))
+        figures.append((output_dir / Path("sample_mean_hist.png"), sample_mean_histogram, moments.moments.means[:, 0]))
+
+    save_figures(figures, args.processes)
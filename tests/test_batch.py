@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from cleanser.batch import ManifestEntry, read_manifest
+from cleanser.constants import CS_MODEL_FILE
+from cleanser.guide_mixture import fit_guides, fit_libraries
+from cleanser_bench import stub
+from cleanser_bench.simulate import simulate_library
+
+
+def test_read_manifest(tmp_path):
+    manifest = tmp_path / "manifest.tsv"
+    manifest.write_text(
+        "input\tsamples\tposteriors\ttriage\na.mtx\ta.samples\ta.post\t\nb.mtx\tb.samples\tb.post\tb.tri\n"
+    )
+    assert read_manifest(manifest) == [
+        ManifestEntry("a.mtx", "a.post", "a.samples"),
+        ManifestEntry("b.mtx", "b.post", "b.samples", triage="b.tri"),
+    ]
+
+    manifest.write_text("input\tposteriors\na.mtx\ta.post\n")
+    with pytest.raises(ValueError, match="no samples column"):
+        read_manifest(manifest)
+
+    manifest.write_text("input\tposteriors\tsamples\na.mtx\tout\ta.samples\nb.mtx\tout\tb.samples\n")
+    with pytest.raises(ValueError, match="share outputs: out"):
+        read_manifest(manifest)
+
+
+def test_fit_libraries(request):
+    request.addfinalizer(stub.install())
+
+    libraries = [
+        simulate_library(CS_MODEL_FILE, num_guides=4, num_cells=300, moi=1.0, ambient_rate=5, seed=seed).mm_data
+        for seed in (1, 2)
+    ]
+    options = {"num_samples": 20, "num_warmup": 20, "seed": 7, "cores": 1}
+
+    fits = {
+        (library, guide_id): samples.draws["PZi"]
+        for library, guide_id, samples, _ in fit_libraries(libraries, CS_MODEL_FILE, **options)
+    }
+
+    # Each library is fit as it would be alone
+    for library, mm_data in enumerate(libraries):
+        for guide_id, samples, _ in fit_guides(mm_data, CS_MODEL_FILE, **options):
+            assert np.array_equal(fits.pop((library, guide_id)), samples.draws["PZi"])
+    assert not fits
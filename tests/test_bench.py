@@ -0,0 +1,37 @@
+import numpy as np
+
+from cleanser.constants import CS_MODEL_FILE, DC_MODEL_FILE
+from cleanser_bench.run import get_args, run_benchmark
+from cleanser_bench.simulate import simulate_library
+
+
+def test_simulate_library():
+    for model_file in (CS_MODEL_FILE, DC_MODEL_FILE):
+        library = simulate_library(model_file, num_guides=50, num_cells=2000, moi=1.5, ambient_rate=10, seed=1)
+        mm_data = library.mm_data
+
+        assert np.all(mm_data.counts > 0)
+        assert mm_data.guides.min() >= 1 and mm_data.guides.max() <= 50
+        assert mm_data.cells.min() >= 1 and mm_data.cells.max() <= 2000
+        # Entries are unique and in (guide, cell) order
+        keys = mm_data.guides.astype(np.int64) * 2001 + mm_data.cells
+        assert np.all(np.diff(keys) > 0)
+        assert 1.3 < library.assigned.sum() / 2000 < 1.6
+        assert 8 < (~library.assigned).sum() / 2000 < 11
+
+
+def test_run_benchmark(tmp_path):
+    args = get_args(["--guides", "10", "--cells", "500", "-n", "50", "-w", "50", "--cores", "1", "-s", "3"])
+
+    results = run_benchmark(args, str(tmp_path))
+
+    assert list(results["seconds"]) == [
+        "simulate",
+        "read_mm_file",
+        "read_mm_arrays",
+        "normalize",
+        "fit",
+        "write",
+        "qc",
+    ]
+    assert results["accuracy"]["f1"] > 0.8
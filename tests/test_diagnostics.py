@@ -0,0 +1,70 @@
+import numpy as np
+
+from cleanser.diagnostics import (
+    Adaptation,
+    ConvergenceTargets,
+    Diagnostics,
+    bulk_ess,
+    combine_adaptations,
+    split_rhat,
+    tail_ess,
+    warm_start_failed,
+)
+from cleanser_bench.stub import StubFit
+
+
+def test_split_rhat():
+    rng = np.random.default_rng(0)
+    mixed = rng.normal(size=(1000, 4))
+    stuck = mixed + np.array([0, 0, 0, 5])
+
+    assert abs(split_rhat(mixed) - 1) < 0.01
+    assert split_rhat(stuck) > 1.5
+
+
+def test_combine_adaptations():
+    adaptations = [Adaptation(0.1, np.array([1.0, 4.0])), Adaptation(0.3, np.array([3.0, 2.0]))]
+    combined = combine_adaptations(adaptations)
+
+    assert combined.step_size == 0.2
+    assert list(combined.inv_metric) == [2.0, 3.0]
+    assert combine_adaptations([]) is None
+
+
+def test_ess():
+    rng = np.random.default_rng(0)
+    independent = rng.normal(size=(1000, 4))
+    correlated = np.zeros((1000, 4))
+    for t in range(1, 1000):
+        correlated[t] = 0.9 * correlated[t - 1] + rng.normal(size=4)
+
+    assert 3000 < bulk_ess(independent) < 5000
+    assert 3000 < tail_ess(independent) < 5000
+    # An AR(1) chain with coefficient 0.9 has an ESS of about 4000 * 0.1 / 1.9
+    assert 100 < bulk_ess(correlated) < 400
+    assert np.isnan(bulk_ess(independent[:5]))
+
+
+def test_convergence_targets():
+    targets = ConvergenceTargets(max_rhat=1.01, min_ess=400, max_divergences=0, max_samples=4000)
+    converged = Diagnostics(4000, 1.001, 1500.0, 900.0, 0, 0)
+
+    assert targets.met(converged)
+    assert not targets.met(converged._replace(max_rhat=1.05))
+    assert not targets.met(converged._replace(min_ess_tail=100.0))
+    assert not targets.met(converged._replace(divergences=1))
+    assert not targets.met(converged._replace(max_rhat=np.nan))
+
+
+def test_warm_start_failed():
+    rng = np.random.default_rng(0)
+    independent = rng.normal(size=(1000, 4))
+    # A chain stuck on a poor metric: it mixes, but each draw barely moves
+    slow = np.zeros((1000, 4))
+    for t in range(1, 1000):
+        slow[t] = 0.99 * slow[t - 1] + rng.normal(size=4)
+
+    for draws, failed in ((independent, False), (slow, True)):
+        # StubFit takes each chain's draws one after the other
+        fit = StubFit({"mu": draws.T.reshape(-1)}, chains=4, num_params=1)
+        assert warm_start_failed(fit, ["mu"], draws.size) == failed
@@ -0,0 +1,220 @@
+import asyncio
+
+import numpy as np
+
+import cleanser.guide_mixture
+from cleanser.constants import CS_MODEL_FILE, MODEL_PARAMETERS
+from cleanser.diagnostics import Adaptation, ConvergenceTargets
+from cleanser.guide_mixture import (
+    FitOptions,
+    GuideSamples,
+    compress_observations,
+    extend_fit,
+    fit_model,
+    fit_guides,
+    mm_counts,
+    normalize,
+    pack_guides,
+    per_guide_counts,
+    run,
+    subsample_observations,
+)
+from cleanser.matrix_market import MMData
+from cleanser.mixture import posterior_probability
+from cleanser_bench import stub
+from cleanser_bench.simulate import simulate_library
+
+
+def test_compress_observations():
+    X = [1, 2, 1, 1, 2]
+    L = [0.5, 0.5, 0.5, 1.5, 0.5]
+    unique_X, unique_L, weights, index = compress_observations(X, L)
+
+    assert len(unique_X) == 3
+    assert weights.sum() == len(X)
+    assert np.array_equal(unique_X[index], X)
+    assert np.array_equal(unique_L[index], L)
+
+
+def test_compress_observations_tolerance():
+    X = [1, 1, 1]
+    L = [1.0, 1.01, 2.0]
+    unique_X, unique_L, weights, index = compress_observations(X, L, tolerance=0.1)
+
+    assert list(unique_X) == [1, 1]
+    assert list(weights) == [2, 1]
+    assert np.allclose(unique_L, [1.005, 2.0])
+    assert list(index) == [0, 0, 1]
+
+
+def test_subsample_observations():
+    rng = np.random.default_rng(0)
+    X = np.concatenate([rng.poisson(1.1, 20000) + 1, rng.integers(20, 400, 100)])
+    L = rng.lognormal(0, 0.3, len(X))
+    W = np.ones(len(X))
+
+    sub_X, sub_L, sub_W = subsample_observations(X, L, W, 2000, seed=1)
+
+    assert len(sub_X) < 4000
+    # Every count keeps its total weight, and the rare large counts are all kept
+    for count in (1, 2, 3):
+        assert np.isclose(sub_W[sub_X == count].sum(), (X == count).sum())
+    assert np.isclose(sub_W.sum(), W.sum())
+    assert np.sort(sub_X[sub_X >= 20]).tolist() == np.sort(X[X >= 20]).tolist()
+    assert subsample_observations(X, L, W, len(X), seed=1)[0] is X
+
+
+def test_pack_guides():
+    guides = [(str(i), [1] * size, [1.0] * size, [1] * size, None) for i, size in enumerate([5, 50, 3, 2, 4])]
+
+    single, batches = pack_guides(guides, batch_size=2, batch_max_cells=10)
+    assert [guide_id for guide_id, *_ in single] == ["1"]
+    assert [[guide_id for guide_id, *_ in batch] for batch in batches] == [["0", "2"], ["3", "4"]]
+
+    single, batches = pack_guides(guides, batch_size=1, batch_max_cells=10)
+    assert len(single) == len(guides)
+    assert not batches
+
+
+def test_mm_counts():
+    mm_data = MMData.from_lines([("2", "1", 1), ("10", "3", 5), ("2", "3", 2), ("10", "1", 2), ("2", "4", 3)])
+    library_sizes, groups = mm_counts(mm_data, 2)
+
+    # Cells 1, 3 and 4; cell 4's only count is above the filter so its size is clamped to 1
+    assert list(library_sizes) == [3, 2, 1]
+    assert [str(guide) for guide in groups.guide_ids] == ["10", "2"]
+
+    guide_counts = per_guide_counts(groups, normalize(library_sizes))
+    assert list(guide_counts) == ["10", "2"]
+    assert list(guide_counts["10"].cells) == [1, 3]
+    assert list(guide_counts["10"].counts) == [2, 5]
+    assert np.allclose(guide_counts["2"].lib_sizes, [1.5, 1.0, 0.5])
+
+
+def test_pzi_chunks_from_draws():
+    draws = {"lambda": np.array([1.0, 1.5]), "r": np.array([0.05, 0.02]), "nbMean": np.array([40.0, 60.0])}
+    draws["nbDisp"] = np.array([0.5, 0.3])
+    X = np.array([1, 3, 50, 80, 2])
+    L = np.array([1.0, 0.8, 1.2, 0.9, 1.1])
+    samples = GuideSamples(draws, CS_MODEL_FILE)
+
+    pzi = np.hstack(list(samples.pzi_chunks(X, L, chunk_values=4)))
+    expected = [posterior_probability(CS_MODEL_FILE, {k: v[d] for k, v in draws.items()}, X, L) for d in range(2)]
+    assert np.allclose(pzi, expected)
+
+
+def test_reduced_samples():
+    rng = np.random.default_rng(0)
+    draws = {"r": rng.uniform(size=20), "PZi": rng.uniform(size=(20, 3))}
+    index = np.array([2, 0, 0, 1, 2])
+    samples = GuideSamples(draws, CS_MODEL_FILE, index)
+
+    reduced = samples.reduced(np.zeros(3), np.ones(3), quantiles=(0.1, 0.9))
+    medians, quantiles, pzi = next(reduced.pzi_summaries(np.zeros(5), np.ones(5)))
+
+    assert pzi is None
+    assert set(reduced.draws) == {"r"}
+    assert np.allclose(medians, np.median(samples.stan_variable("PZi"), axis=0))
+    assert np.allclose(quantiles, np.quantile(samples.stan_variable("PZi"), [0.1, 0.9], axis=0).T)
+
+
+def test_run_async(request):
+    request.addfinalizer(stub.install())
+
+    mm_data = simulate_library(CS_MODEL_FILE, num_guides=4, num_cells=300, moi=1.0, ambient_rate=5, seed=3).mm_data
+    options = {"num_samples": 20, "num_warmup": 20, "seed": 7, "cores": 1}
+    events = []
+
+    fits = asyncio.run(run(mm_data, CS_MODEL_FILE, progress=events.append, **options))
+
+    assert list(fits) == sorted(fits)
+    for guide_id, samples, _ in fit_guides(mm_data, CS_MODEL_FILE, **options):
+        assert np.array_equal(fits[guide_id][0].draws["PZi"], samples.draws["PZi"])
+    assert [event.done for event in events] == [1, 2, 3, 4]
+    assert all(event.total == 4 for event in events)
+    assert events[-1].eta == 0
+
+
+def test_warm_fits_keep_pilot_adaptation(tmp_path, monkeypatch, request):
+    request.addfinalizer(stub.install())
+
+    rng = np.random.default_rng(0)
+    X = np.concatenate([rng.poisson(1, 200), rng.poisson(80, 20)])
+    data = {"N": len(X), "X": X, "L": np.ones(len(X)), "W": np.ones(len(X)), "grainsize": 1, "generate_pzi": 0}
+    model = cleanser.guide_mixture.CmdStanModel(exe_file=CS_MODEL_FILE)
+    pilot = Adaptation(0.3, np.linspace(0.5, 2.0, len(MODEL_PARAMETERS[CS_MODEL_FILE])))
+
+    fit = fit_model(model, data, "nuts", 20, 50, 2, seed=1, output_dir=str(tmp_path), warm_start=pilot)
+    assert np.allclose(fit.step_size, pilot.step_size)
+    assert np.allclose(fit.inv_metric, pilot.inv_metric)
+
+    # Targets that are never met extend the fit up to max_samples, 50 -> 100 -> 200 draws per chain
+    targets = ConvergenceTargets(max_rhat=1.0, min_ess=1e9, max_divergences=0, max_samples=200)
+    options = FitOptions(CS_MODEL_FILE, "nuts", 20, 50, 2, 1, False, True, (), warm_warmup=10, targets=targets)
+    fit, diagnostics, fit_adaptation = extend_fit(fit, model, data, options, 1, str(tmp_path), fit_adaptation=pilot)
+
+    assert diagnostics.rounds == 3
+    assert fit_adaptation is pilot
+    assert np.allclose(fit.step_size, pilot.step_size)
+    assert np.allclose(fit.inv_metric, pilot.inv_metric)
+
+    # Without an adaptation to reuse, refits run full warmup but still start from the previous means
+    calls = []
+    sample = model.sample
+    monkeypatch.setattr(model, "sample", lambda **kwargs: calls.append(kwargs) or sample(**kwargs))
+    fit = fit_model(model, data, "nuts", 20, 50, 2, seed=1, output_dir=str(tmp_path))
+    fit.inv_metric = None
+    fit, diagnostics, fit_adaptation = extend_fit(fit, model, data, options, 1, str(tmp_path))
+
+    assert fit_adaptation is None
+    assert len(calls) == 3 and calls[0]["inits"] is None
+    assert all(set(call["inits"]) == set(MODEL_PARAMETERS[CS_MODEL_FILE]) for call in calls[1:])
+    assert not any("adapt_engaged" in call for call in calls)
+
+
+def test_batched_fits_match_single_fits(request):
+    request.addfinalizer(stub.install())
+
+    mm_data = simulate_library(CS_MODEL_FILE, num_guides=6, num_cells=300, moi=1.0, ambient_rate=5, seed=4).mm_data
+    options = {"num_samples": 50, "num_warmup": 20, "seed": 7, "cores": 1, "batch_max_cells": 1000}
+
+    single = {guide_id: samples for guide_id, samples, _ in fit_guides(mm_data, CS_MODEL_FILE, **options)}
+    batched = {
+        guide_id: samples for guide_id, samples, _ in fit_guides(mm_data, CS_MODEL_FILE, batch_size=3, **options)
+    }
+
+    # Batched guides share one run's step size and metric, but each keeps its own posterior
+    assert set(batched) == set(single)
+    for guide_id, samples in single.items():
+        for name in MODEL_PARAMETERS[CS_MODEL_FILE]:
+            assert np.isclose(
+                np.median(batched[guide_id].stan_variable(name)), np.median(samples.stan_variable(name)), rtol=0.05
+            )
+        assert np.allclose(
+            np.median(batched[guide_id].stan_variable("PZi"), axis=0),
+            np.median(samples.stan_variable("PZi"), axis=0),
+            atol=0.05,
+        )
+
+
+def test_fit_tally_counts_pilots(request, capsys):
+    request.addfinalizer(stub.install())
+
+    mm_data = simulate_library(CS_MODEL_FILE, num_guides=4, num_cells=300, moi=1.0, ambient_rate=5, seed=3).mm_data
+    # No fit can reach this ESS, so every guide is extended, including the warm start's pilots
+    targets = ConvergenceTargets(max_rhat=2.0, min_ess=1e9, max_divergences=0, max_samples=40)
+    fits = list(
+        fit_guides(
+            mm_data,
+            CS_MODEL_FILE,
+            num_samples=20,
+            num_warmup=20,
+            cores=1,
+            warm_start=True,
+            pilot_guides=2,
+            targets=targets,
+        )
+    )
+
+    assert len(fits) == 4
+    assert "Adaptive sampling: 4 guides were extended, 4 did not meet the targets" in capsys.readouterr().err
@@ -1,20 +1,29 @@
 import io
 
-from cleanser.lib_per import mm_counts
+import numpy as np
+
+from cleanser.guide_mixture import mm_counts, normalize
+from cleanser.matrix_market import MMData
+from cleanser.run import read_mm_file
 
 
 def test_normalize():
-    mm_file = io.StringIO(
-        r"""%% 1
+    mm_file = io.StringIO(r"""%% 1
 % 2
 % 3
 3 3 4
 1 0 1
 1 1 2
 2 0 2
-3 1 3"""
-    )
+3 1 3""")
+    mm_data = MMData.from_lines(read_mm_file(mm_file))
+
+    library_sizes, groups = mm_counts(mm_data, 0)
+    assert library_sizes.tolist() == [3, 5]
+    assert groups.guide_ids.tolist() == [1, 2, 3]
+    assert np.add.reduceat(groups.counts, groups.offsets[:-1]).tolist() == [3, 2, 3]
+    assert normalize(library_sizes).tolist() == [0.75, 1.25]
 
-    assert mm_counts(mm_file, 0) == {"1": 3, "2": 2, "3": 3}
-    mm_file.seek(0)  # "rewind" the file
-    assert mm_counts(mm_file, 1) == {"0": 3, "1": 5}
+    # Only counts up to the cutoff are included, and empty libraries count as 1
+    library_sizes, _ = mm_counts(mm_data, 1)
+    assert library_sizes.tolist() == [1, 1]
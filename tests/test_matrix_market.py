@@ -0,0 +1,53 @@
+import gzip
+import io
+
+import numpy as np
+import pytest
+
+from cleanser.matrix_market import parse_mm, read_mm_arrays, sidecar_path
+
+MTX = b"""%%MatrixMarket matrix coordinate integer general
+% comment
+3 3 4
+1 1 4
+1 2 1
+2 1 2
+3 3 7
+"""
+
+
+def test_parse_mm():
+    data = parse_mm(io.BytesIO(MTX), chunk_bytes=7)
+
+    assert list(data.guides) == [1, 1, 2, 3]
+    assert list(data.cells) == [1, 2, 1, 3]
+    assert list(data.counts) == [4, 1, 2, 7]
+    assert data.lines() == [("1", "1", 4), ("1", "2", 1), ("2", "1", 2), ("3", "3", 7)]
+
+
+def test_parse_mm_malformed():
+    with pytest.raises(ValueError, match="must be integers"):
+        parse_mm(io.BytesIO(MTX.replace(b"2 1 2", b"2 x 2")))
+    # Fields missing from one line and extra on the next still add up to whole entries
+    with pytest.raises(ValueError, match="exactly three columns"):
+        parse_mm(io.BytesIO(MTX.replace(b"1 2 1\n2 1 2", b"1 2\n1 2 1 2")))
+    with pytest.raises(ValueError, match="3 of the 4 entries"):
+        parse_mm(io.BytesIO(MTX.replace(b"3 3 7\n", b"")))
+    with pytest.raises(ValueError, match="more than the 4 entries"):
+        parse_mm(io.BytesIO(MTX + b"3 1 1\n"))
+
+
+def test_read_mm_arrays_gzip_sidecar(tmp_path):
+    mtx_file = tmp_path / "matrix.mtx.gz"
+    with gzip.open(mtx_file, "wb") as mtx:
+        mtx.write(MTX)
+
+    data = read_mm_arrays(mtx_file, cache=True)
+    assert list(data.counts) == [4, 1, 2, 7]
+    assert np.array_equal(read_mm_arrays(io.BytesIO(gzip.compress(MTX))).counts, data.counts)
+
+    cached = read_mm_arrays(mtx_file)
+    assert isinstance(cached.counts, np.memmap)
+    assert np.array_equal(cached.guides, data.guides)
+    assert (tmp_path / "matrix.mtx.gz.npy").exists()
+    assert sidecar_path(mtx_file) == str(tmp_path / "matrix.mtx.gz.npy")
@@ -0,0 +1,29 @@
+import numpy as np
+
+from cleanser.constants import CS_MODEL_FILE, DC_MODEL_FILE
+from cleanser.mixture import fit_map, posterior_probability
+
+
+def simulate(model_file, num_guides, cells_per_guide, rng):
+    guide_index = np.repeat(np.arange(num_guides), cells_per_guide)
+    L = rng.lognormal(0, 0.3, len(guide_index))
+    native = rng.random(len(guide_index)) < 0.05
+    if model_file == CS_MODEL_FILE:
+        ambient = rng.poisson(1.1, len(L))
+    else:
+        ambient = rng.negative_binomial(1.1, 1.1 / (1.1 + 1.075 * L))
+    X = np.where(native, rng.negative_binomial(3, 3 / (3 + 60 * L)), ambient)
+    observed = X > 0
+
+    return X[observed], L[observed], guide_index[observed], native[observed]
+
+
+def test_fit_map():
+    rng = np.random.default_rng(0)
+    for model_file in (CS_MODEL_FILE, DC_MODEL_FILE):
+        X, L, guide_index, native = simulate(model_file, 5, 2000, rng)
+        params = fit_map(model_file, X, L, np.ones(len(X)), guide_index, 5)
+        pzi = posterior_probability(model_file, params, X, L, guide_index)
+
+        assert np.all(params["r"] > 0.03) and np.all(params["r"] < 0.1)
+        assert np.mean((pzi > 0.5) == native) > 0.99
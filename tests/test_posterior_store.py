@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from cleanser.posterior_store import PosteriorStore, PosteriorStoreWriter
+
+
+def test_posterior_store(tmp_path):
+    path = tmp_path / "posteriors.draws"
+    rng = np.random.default_rng(1)
+    first = rng.uniform(size=(5, 4))
+    second = rng.uniform(size=(3, 2))
+    with PosteriorStoreWriter(path) as writer:
+        # The first guide is written in two blocks of cells
+        writer.append("10", [7, 2], first[:, :2])
+        writer.append("10", [30, 4], first[:, 2:])
+        writer.append("2", [5, 1], second)
+
+    with PosteriorStore(path) as store:
+        assert list(store.guide_ids) == [10, 2]
+        assert list(store.cells("10")) == [7, 2, 30, 4]
+        assert np.array_equal(store.guide_draws("10"), first.T)
+        assert np.array_equal(store.draws("10", 30), first[:, 2])
+        assert np.array_equal(store.draws(2, 1), second[:, 1])
+        with pytest.raises(KeyError):
+            store.draws("10", 5)
+
+
+def test_incomplete_posterior_store(tmp_path):
+    path = tmp_path / "posteriors.draws"
+    writer = PosteriorStoreWriter(path)
+    writer.append("1", [1], np.zeros((2, 1)))
+    writer._file.flush()
+
+    with pytest.raises(ValueError):
+        PosteriorStore(path)
+    writer.close()
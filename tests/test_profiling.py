@@ -0,0 +1,37 @@
+import json
+
+from cleanser.profiling import Profiler, stan_profile, trace_path
+from cleanser.scheduler import TaskTiming
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler()
+    with profiler.stage("fit"):
+        with profiler.stage("compile"):
+            pass
+    assert list(profiler.timed_iter("write", [1, 2])) == [1, 2]
+    profiler.add_task(TaskTiming(10.0, 11.0, 14.0, 14.5, 3.0, 123), [("7", 100, 40, {"timings": {"sample": 2.5}})])
+
+    path = str(tmp_path / "profile.json")
+    profiler.write(path)
+    with open(path) as profile_file:
+        profile = json.load(profile_file)
+    fit, compile_ = profile["stages"]["fit"], profile["stages"]["compile"]
+    assert abs(fit["self"] - (fit["wall"] - compile_["wall"])) < 1e-9
+    assert profile["stages"]["write"]["calls"] == 3  # Including the wait that found the end
+    guide = profile["guides"][0]
+    assert (guide["queue wait"], guide["run"], guide["transfer"], guide["sample"]) == (1.0, 3.0, 0.5, 2.5)
+
+    with open(trace_path(path)) as trace_file:
+        names = [event["name"] for event in json.load(trace_file)["traceEvents"]]
+    assert {"fit", "compile", "write", "7", "sample"} <= set(names)
+
+
+def test_stan_profile(tmp_path):
+    header = "name,thread_id,total_time,forward_time,reverse_time,chain_stack,no_chain_stack,autodiff_calls,no_autodiff_calls\n"
+    for chain in (1, 2):
+        (tmp_path / f"model-202401010000-profile-{chain}.csv").write_text(
+            header + "likelihood,1,0.5,0.2,0.3,0,0,100,0\ngenerated quantities,1,0.25,0.25,0,0,0,0,10\n"
+        )
+
+    assert stan_profile(str(tmp_path)) == {"likelihood": 1.0, "generated quantities": 0.5}
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from cleanser.matrix_market import MMData
+from cleanser_qc.aggregate import GroupedMoments, PosteriorUmiSummary, ThresholdCounts
+
+
+def test_grouped_moments():
+    rng = np.random.default_rng(0)
+    keys = rng.integers(1, 6, size=1000)
+    values = rng.normal(size=(1000, 2)) * keys[:, np.newaxis]
+
+    moments = GroupedMoments(2)
+    for start in range(0, 1000, 300):
+        moments.update(keys[start : start + 300], values[start : start + 300])
+
+    assert list(moments.keys) == [1, 2, 3, 4, 5]
+    for i, key in enumerate(moments.keys):
+        assert np.allclose(moments.means[i], values[keys == key].mean(axis=0))
+        assert np.allclose(moments.variances[i], values[keys == key].var(axis=0, ddof=1))
+
+
+def test_threshold_counts():
+    counts = ThresholdCounts([0.9, 0.5])
+    counts.update(np.array([1, 1, 2]), np.array([10, 11, 10]), np.array([0.95, 0.6, 0.1]))
+    counts.update(np.array([3]), np.array([12]), np.array([0.5]))
+
+    assert list(counts.assigned) == [1, 3]
+    assert list(counts.moi) == [1 / 3, 1.0]
+    assert list(counts.coverage) == [1 / 3, 1.0]
+
+
+def test_posterior_umi_summary():
+    mm_data = MMData(np.array([2, 1, 1], dtype=np.int32), np.array([5, 7, 5], dtype=np.int32), np.array([8, 3, 4]))
+    summary = PosteriorUmiSummary(mm_data, threshold=0.5, bins=4)
+
+    assert list(summary.umis(np.array([1, 2, 1]), np.array([5, 5, 7]))) == [4, 8, 3]
+    with pytest.raises(KeyError):
+        summary.umis(np.array([2]), np.array([7]))
+
+    summary.update(np.array([1, 2, 1]), np.array([5, 5, 7]), np.array([0.9, 0.1, 0.6]))
+    assert summary.density.sum() == 3
+    assert summary.density[3, 2] == 1  # Posterior 0.9 and 4 UMIs, with 4 bins up to 8 UMIs
+    assert list(np.flatnonzero(summary.assigned_umis)) == [3, 4]
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+
+from cleanser.constants import CS_MODEL_FILE
+from cleanser.diagnostics import Adaptation
+from cleanser.guide_mixture import FitOptions
+from cleanser.result_cache import ResultCache, result_key
+
+
+def test_result_key():
+    guide = ("1", np.array([1, 5]), np.array([0.5, 1.5]), np.array([1, 1]), None)
+    key = result_key(CS_MODEL_FILE, ("nuts", 300, 1000), 7, [guide])
+
+    assert key == result_key(CS_MODEL_FILE, ("nuts", 300, 1000), 7, [guide])
+    assert key != result_key(CS_MODEL_FILE, ("nuts", 300, 1000), 8, [guide])
+    assert key != result_key(CS_MODEL_FILE, ("nuts", 300, 1000), 7, [(guide[0], np.array([1, 6]), *guide[2:])])
+
+    # Warm-start metrics are keyed by their values; the repr of a large array elides its middle
+    metric = np.linspace(0.5, 2.0, 4000)
+    changed = metric.copy()
+    changed[2000] += 1
+    warm_key = result_key(CS_MODEL_FILE, ("nuts", Adaptation(0.3, metric)), 7, [guide])
+    assert warm_key == result_key(CS_MODEL_FILE, ("nuts", Adaptation(0.3, metric[::-1][::-1])), 7, [guide])
+    assert warm_key != result_key(CS_MODEL_FILE, ("nuts", Adaptation(0.3, changed)), 7, [guide])
+
+    # Profiling doesn't change a fit, so profiled and unprofiled runs share cached fits
+    options = FitOptions(CS_MODEL_FILE, "nuts", 300, 1000, 4, 1, True, True, ())
+    assert result_key(CS_MODEL_FILE, options, 7, [guide]) == result_key(
+        CS_MODEL_FILE, options._replace(profile=True), 7, [guide]
+    )
+    assert result_key(CS_MODEL_FILE, options, 7, [guide]) != result_key(
+        CS_MODEL_FILE, options._replace(num_samples=500), 7, [guide]
+    )
+
+
+def test_result_cache_eviction(tmp_path):
+    cache = ResultCache(tmp_path, max_bytes=None)
+    for i, key in enumerate(["aa01", "bb02", "cc03"]):
+        cache.put(key, ("guide", np.zeros(100)))
+        os.utime(cache._path(key), (i, i))
+    assert cache.get("zz00") is None
+
+    # Using an entry makes it the most recently used
+    assert cache.get("aa01")[0] == "guide"
+    cache.max_bytes = 2 * cache._path("aa01").stat().st_size
+    cache.evict()
+
+    assert cache.get("bb02") is None
+    assert cache.get("aa01") is not None
+    assert cache.get("cc03") is not None
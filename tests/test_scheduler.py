@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from cleanser.scheduler import Task, aiter_tasks, lpt_makespan, run_tasks, worker_count
+
+
+def test_worker_count():
+    assert worker_count(64, 4, 1000) == 16
+    assert worker_count(64, 4, 3) == 3
+    assert worker_count(2, 4, 1000) == 1
+
+
+def test_lpt_makespan():
+    assert lpt_makespan([5, 4, 3, 3, 3], 2) == 10
+    assert lpt_makespan([10, 1, 1], 4) == 10
+    assert lpt_makespan([], 2) == 0
+
+
+def _square(x):
+    return x * x
+
+
+def test_run_tasks():
+    tasks = [Task(_square, i, cost) for i, cost in enumerate([3, 1, 4, 1, 5])]
+    results, report = run_tasks(tasks, workers=2)
+
+    assert sorted(results) == [0, 1, 4, 9, 16]
+    assert report.tasks == 5
+
+
+def test_aiter_tasks():
+    tasks = [Task(_square, i, cost) for i, cost in enumerate([3, 1, 4, 1, 5])]
+    reports = []
+
+    async def results():
+        return [result async for result in aiter_tasks(tasks, workers=2, on_report=reports.append)]
+
+    assert sorted(asyncio.run(results())) == [0, 1, 4, 9, 16]
+    assert [report.tasks for report in reports] == [5]
+    assert len(reports[0].timings) == 5
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_schedule_report():
+    # The cost model gets the fits' sizes backwards, so longest-first runs the long fit last
+    tasks = [Task(_sleep, seconds, cost) for seconds, cost in ((0.05, 3), (0.05, 2), (0.3, 1))]
+    _, report = run_tasks(tasks, workers=2)
+
+    # Predicted: half the total cost on each worker, i.e. half of the 0.4s the fits ran for
+    assert 0.2 <= report.predicted_makespan < 0.25
+    assert report.actual_makespan > report.predicted_makespan + 0.1
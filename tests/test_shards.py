@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from cleanser.shards import merge_tables, parse_shard, shard_of
+from cleanser.tables import open_table, read_columnar
+
+
+def test_shard_of():
+    shards = [shard_of(str(guide_id), 3) for guide_id in range(1, 301)]
+
+    # Assignment must be the same in every process, so it can't depend on hash randomization
+    assert shards[:5] == [3, 2, 2, 2, 2]
+    assert set(shards) == {1, 2, 3}
+    assert all(shards.count(shard) > 50 for shard in (1, 2, 3))
+    assert parse_shard("2/3") == (2, 3)
+    with pytest.raises(ValueError):
+        parse_shard("0/3")
+
+
+def test_merge_tables(tmp_path):
+    shard_1, shard_2, merged = tmp_path / "1.tsv", tmp_path / "2.tsv", str(tmp_path / "merged.tsv")
+    shard_1.write_text("guide id\tr\n2\t0.1\n2\t0.2\n10\t0.5\n")
+    shard_2.write_text("guide id\tr\n1\t0.3\n3\t0.4\n")
+
+    merge_tables([str(shard_1), str(shard_2)], merged)
+
+    with open(merged) as merged_file:
+        assert merged_file.read() == "guide id\tr\n1\t0.3\n10\t0.5\n2\t0.1\n2\t0.2\n3\t0.4\n"
+
+
+def test_merge_columnar_tables(tmp_path):
+    shard_1, shard_2, merged = str(tmp_path / "1.col"), str(tmp_path / "2.col"), str(tmp_path / "merged.col")
+    # Shards write their guides in completion order, one block per guide
+    with open_table(shard_1, ["guide id", "r"], "columnar") as table:
+        table.write("3", [0.1, 0.2])
+        table.write("1", 0.3)
+    with open_table(shard_2, ["guide id", "r"], "columnar") as table:
+        table.write(np.array([2, 2, 4]), [0.4, 0.5, 0.6])
+
+    merge_tables([shard_1, shard_2], merged)
+
+    table = read_columnar(merged)
+    assert table["guide id"].tolist() == [1, 2, 2, 3, 3, 4]
+    assert table["r"].tolist() == [0.3, 0.4, 0.5, 0.1, 0.2, 0.6]
@@ -0,0 +1,40 @@
+import gzip
+
+import numpy as np
+
+from cleanser.tables import is_columnar, iter_table, open_table, read_columnar
+
+
+def test_tsv_table(tmp_path):
+    path = str(tmp_path / "samples.tsv.gz")
+    r = np.array([0.1, 1e-05])
+    with open_table(path, ["guide id", "r", "mu"], "tsv") as table:
+        table.write("7", r, np.array([12.5, 3.0]))
+
+    with gzip.open(path, "rt") as table_file:
+        assert table_file.read() == "guide id\tr\tmu\n7\t0.1\t12.5\n7\t1e-05\t3.0\n"
+
+
+def test_columnar_table(tmp_path):
+    path = str(tmp_path / "posteriors.bin")
+    with open_table(path, ["guide id", "cell id", "posterior"], "columnar") as table:
+        table.write("7", np.array([1, 2]), np.array([0.5, 0.25]))
+        table.write("10", np.array([3]), np.array([1.0]))
+
+    assert is_columnar(path)
+    columns = read_columnar(path)
+    assert list(columns) == ["guide id", "cell id", "posterior"]
+    assert list(columns["guide id"]) == [7, 7, 10]
+    assert list(columns["cell id"]) == [1, 2, 3]
+    assert list(columns["posterior"]) == [0.5, 0.25, 1.0]
+
+
+def test_iter_table(tmp_path):
+    path = tmp_path / "posteriors.tsv"
+    path.write_text("7\t1\t0.5\n7\t2\t0.25\n10\t3\t1.0\n")
+
+    blocks = list(iter_table(path, ["guide id", "cell id", "posterior"], header=False, chunk_bytes=10))
+
+    assert len(blocks) > 1
+    assert list(np.concatenate([block["cell id"] for block in blocks])) == [1, 2, 3]
+    assert list(np.concatenate([block["posterior"] for block in blocks])) == [0.5, 0.25, 1.0]
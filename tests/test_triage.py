@@ -0,0 +1,56 @@
+import numpy as np
+
+from cleanser.constants import CS_MODEL_FILE
+from cleanser.guide_mixture import fit_guides
+from cleanser.matrix_market import MMData
+from cleanser.triage import FEW_CELLS, LOW_COUNTS, SEPARATED, guide_stats, triage_candidates
+
+
+def _guide(guide_id, X):
+    X = np.asarray(X)
+    return guide_id, X, np.ones(len(X)), np.ones(len(X)), None
+
+
+def test_triage_candidates():
+    rng = np.random.default_rng(0)
+    guides = [
+        _guide("1", rng.integers(1, 3, 100)),
+        _guide("2", [1, 5, 2]),
+        _guide("3", np.concatenate([rng.integers(1, 3, 100), rng.integers(60, 100, 10)])),
+        _guide("4", rng.integers(1, 20, 100)),
+    ]
+
+    stats = guide_stats(guides)
+    assert stats.cells.tolist() == [100, 3, 110, 100]
+    assert stats.max_count[:2].tolist() == [2, 5]
+    assert stats.gap[1] == 2.5
+
+    assert triage_candidates(guides) == {"1": LOW_COUNTS, "2": FEW_CELLS, "3": SEPARATED}
+
+
+def test_fit_guides_triage():
+    rng = np.random.default_rng(1)
+    ambient = rng.integers(1, 3, 200)
+    native = rng.integers(200, 300, 20)
+    counts = np.concatenate([ambient, native, [1, 2, 1]])
+    guides = np.repeat([1, 2], [220, 3])
+    cells = np.concatenate([np.arange(1, 221), np.arange(1, 4)])
+
+    fits = {
+        guide_id: (samples, cell_info)
+        for guide_id, samples, cell_info in fit_guides(
+            MMData(guides.astype(np.int32), cells.astype(np.int32), counts), CS_MODEL_FILE, triage=True
+        )
+    }
+
+    # Both guides are triaged, so Stan is never run
+    assert {guide_id: samples.info["triage"] for guide_id, (samples, _) in fits.items()} == {
+        "1": SEPARATED,
+        "2": LOW_COUNTS,
+    }
+    samples, cell_info = fits["1"]
+    posteriors = np.concatenate(
+        [medians for medians, _, _ in samples.pzi_summaries(cell_info.counts, cell_info.lib_sizes)]
+    )
+    assert np.all(posteriors[cell_info.counts >= 200] > 0.99)
+    assert np.all(posteriors[cell_info.counts <= 2] < 0.01)